@@ -0,0 +1,73 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchLoader:
+    """
+    DataLoader-style batching across threads: keys requested within `window` seconds of the
+    first one are handed to batch_fn together (at most max_batch per call), and each caller
+    gets the value for its own key. batch_fn(keys) returns a dict; keys missing from it load as None.
+    A key requested again while its batch is pending shares that batch's result.
+    """
+    batch_fn: Callable
+    window: float = 0.005
+    max_batch: int = 25
+    pending: dict = field(default_factory=dict, repr=False)
+    timer: threading.Timer = field(default=None, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def load(self, key, timeout=None):
+        return self.submit(key).result(timeout)
+
+    def load_many(self, keys, timeout=None):
+        futures = [self.submit(key) for key in keys]
+        return [future.result(timeout) for future in futures]
+
+    def submit(self, key):
+        batch = None
+        with self.lock:
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = Future()
+                if len(self.pending) >= self.max_batch:
+                    batch = self.take()
+                elif self.timer is None:
+                    self.timer = threading.Timer(self.window, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        # A full batch goes out right away from the thread that filled it
+        if batch:
+            self.dispatch(batch)
+
+        return future
+
+    def take(self):
+        batch, self.pending = self.pending, {}
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        return batch
+
+    def flush(self):
+        with self.lock:
+            batch = self.take()
+        if batch:
+            self.dispatch(batch)
+
+    def dispatch(self, batch):
+        try:
+            results = self.batch_fn(list(batch))
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} key(s) failed: {e}")
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for key, future in batch.items():
+            future.set_result(results.get(key))
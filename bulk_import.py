@@ -0,0 +1,278 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+import httpx
+import json
+import os
+import logging
+from dotenv import load_dotenv
+from converter import csv_to_jsonl
+from shopifyapi import ShopifyApp
+import webhooks
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STATE_DIR = 'data/bulk_import'
+FINISHED_DIR = os.path.join(STATE_DIR, 'finished')
+
+# Operation name -> ShopifyApp method running the bulk mutation for a staged upload
+BULK_MUTATIONS = {
+    'create_products': ShopifyApp.create_products,
+    'update_products': ShopifyApp.update_products,
+    'create_variants': ShopifyApp.create_variants,
+    'update_variants': ShopifyApp.update_variants,
+    'publish_unpublish': ShopifyApp.publish_unpublish,
+}
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _operation_key(bulk_operation_id):
+    # gid://shopify/BulkOperation/123 -> 123
+    return str(bulk_operation_id).rsplit('/', 1)[-1]
+
+
+def write_json_atomic(path, data):
+    """Writes JSON to a temp file and swaps it in so a crash never leaves a half-written file."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+@webhooks.handler('bulk_operations/finish')
+def record_bulk_finish(payload):
+    """Drops a marker for a finished bulk operation so a waiting importer can stop polling."""
+    if not isinstance(payload, dict) or not payload.get('admin_graphql_api_id'):
+        logger.warning(f"bulk_operations/finish payload without an operation id ignored: {payload!r}")
+        return
+    os.makedirs(FINISHED_DIR, exist_ok=True)
+    key = _operation_key(payload['admin_graphql_api_id'])
+    write_json_atomic(os.path.join(FINISHED_DIR, f'{key}.json'), payload)
+
+
+def row_identity(row):
+    """Best identifier for a bulk input row, used to report which record a user error belongs to."""
+    product_input = row.get('input') or {}
+    for value in (product_input.get('handle'), product_input.get('id'), row.get('productId'), row.get('id')):
+        if value:
+            return value
+    return None
+
+
+@dataclass
+class BulkImport:
+    app: ShopifyApp
+    client: httpx.Client
+    name: str
+    operation: str = 'create_products'
+    csv_filename: str = None
+    jsonl_filename: str = None
+    mode: str = 'pc'
+    shard_rows: int = 10000
+    shard_bytes: int = 20 * 1024 * 1024
+    callback_url: str = None
+    min_poll_interval: float = 2
+    max_poll_interval: float = 60
+    state: dict = field(default_factory=dict)
+
+    @property
+    def job_dir(self):
+        return os.path.join(STATE_DIR, self.name)
+
+    @property
+    def state_path(self):
+        return os.path.join(self.job_dir, 'state.json')
+
+    # State
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as file:
+                self.state = json.load(file)
+            print(f'Resuming bulk import {self.name}...')
+        else:
+            self.state = {'name': self.name, 'operation': self.operation, 'created_at': _now(), 'shards': []}
+
+        return self.state
+
+    def save_state(self):
+        os.makedirs(self.job_dir, exist_ok=True)
+        self.state['updated_at'] = _now()
+        write_json_atomic(self.state_path, self.state)
+
+    # Prepare
+    def prepare(self):
+        """Converts the csv (if given) and splits the JSONL into shards small enough for one staged upload."""
+        if self.state.get('shards'):
+            return self.state['shards']
+
+        os.makedirs(self.job_dir, exist_ok=True)
+        jsonl_filename = self.jsonl_filename
+        if self.csv_filename:
+            jsonl_filename = os.path.join(self.job_dir, 'bulk_op_vars.jsonl')
+            csv_to_jsonl(csv_filename=self.csv_filename, jsonl_filename=jsonl_filename, mode=self.mode)
+
+        print('Splitting bulk data into shards...')
+        shards = []
+        shard_file = None
+        rows = size = 0
+        with open(jsonl_filename, 'rb') as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                if shard_file is None or rows >= self.shard_rows or size + len(line) > self.shard_bytes:
+                    if shard_file:
+                        shard_file.close()
+                        shards[-1]['rows'] = rows
+                    path = os.path.join(self.job_dir, f'shard_{len(shards):04d}.jsonl')
+                    shard_file = open(path, 'wb')
+                    shards.append({'index': len(shards), 'path': path, 'status': 'pending'})
+                    rows = size = 0
+                shard_file.write(line if line.endswith(b'\n') else line + b'\n')
+                rows += 1
+                size += len(line)
+        if shard_file:
+            shard_file.close()
+            shards[-1]['rows'] = rows
+
+        self.state['shards'] = shards
+        self.save_state()
+        print(f'{len(shards)} shard(s) prepared')
+
+        return shards
+
+    def subscribe_webhook(self):
+        if not self.callback_url or self.state.get('webhook_subscription_id'):
+            return
+        response = self.app.webhook_subscription(self.client, callback_url=self.callback_url)
+        subscription = response.get('data', {}).get('webhookSubscriptionCreate', {}).get('webhookSubscription')
+        if subscription:
+            self.state['webhook_subscription_id'] = subscription['id']
+            self.save_state()
+
+    # Lifecycle
+    def stage(self, shard):
+        staged_target = self.app.generate_staged_target(self.client)
+        self.app.upload_jsonl(staged_target=staged_target, jsonl_path=shard['path'])
+        shard['staged_target'] = staged_target
+        shard['status'] = 'uploaded'
+        self.save_state()
+
+    def start(self, shard):
+        response = BULK_MUTATIONS[self.operation](self.app, self.client, staged_target=shard['staged_target'])
+        result = response.get('data', {}).get('bulkOperationRunMutation') or {}
+        user_errors = result.get('userErrors') or []
+        if user_errors or not result.get('bulkOperation'):
+            # A staged upload can expire between a crash and the resume, so stage it again next time
+            shard['status'] = 'pending'
+            shard['errors'] = user_errors or response.get('errors')
+            self.save_state()
+            raise RuntimeError(f"Bulk mutation for shard {shard['index']} was rejected: {shard['errors']}")
+
+        shard['bulk_operation_id'] = result['bulkOperation']['id']
+        shard['status'] = 'running'
+        shard['started_at'] = _now()
+        self.save_state()
+
+    def read_finish_marker(self, bulk_operation_id):
+        path = os.path.join(FINISHED_DIR, f'{_operation_key(bulk_operation_id)}.json')
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    return json.load(file)
+            except ValueError as e:
+                # Polling still finds the operation's status
+                logger.warning(f"Unreadable bulk finish marker {path}: {e}")
+        return None
+
+    def wait(self, shard):
+        """Waits for the webhook marker, polling with a growing interval as a fallback."""
+        bulk_operation_id = shard['bulk_operation_id']
+        interval = self.min_poll_interval
+        if self.state.get('webhook_subscription_id'):
+            # Webhook is the primary signal; poll only as a safety net
+            interval = self.max_poll_interval / 4
+
+        return self.app.wait_bulk_operation(
+            self.client,
+            bulk_operation_id,
+            min_poll_interval=interval,
+            max_poll_interval=self.max_poll_interval,
+            finished_hint=lambda: self.read_finish_marker(bulk_operation_id)
+        )
+
+    def reconcile(self, shard, operation):
+        """Downloads the result JSONL and records the input rows that came back with errors."""
+        with open(shard['path'], 'r', encoding='utf-8') as file:
+            identities = [row_identity(json.loads(line)) for line in file]
+
+        errors_path = shard['path'].replace('.jsonl', '.errors.jsonl')
+        error_count = 0
+        result_url = operation.get('url') or operation.get('partialDataUrl')
+        with open(errors_path, 'w', encoding='utf-8') as errors_file:
+            if result_url:
+                for result in self.app.iter_bulk_mutation_results(result_url):
+                    if not result.errors:
+                        continue
+                    line_number = result.line_number
+                    identity = identities[line_number] if line_number is not None and line_number < len(identities) else None
+                    json.dump({'line': line_number, 'identity': identity, 'errors': result.errors}, errors_file)
+                    errors_file.write('\n')
+                    error_count += 1
+
+        shard['status'] = 'done' if operation['status'] == 'COMPLETED' else 'failed'
+        shard['error_code'] = operation.get('errorCode')
+        shard['object_count'] = operation.get('objectCount')
+        shard['error_rows'] = error_count
+        shard['errors_path'] = errors_path
+        shard['completed_at'] = _now()
+        self.save_state()
+
+    def run(self, retry_failed=False):
+        self.load_state()
+        self.prepare()
+        self.subscribe_webhook()
+
+        for shard in self.state['shards']:
+            if shard['status'] == 'failed' and retry_failed:
+                shard['status'] = 'pending'
+            if shard['status'] in ('done', 'failed'):
+                continue
+
+            print(f"Processing shard {shard['index'] + 1}/{len(self.state['shards'])}...")
+            if shard['status'] == 'pending':
+                self.stage(shard)
+            if shard['status'] == 'uploaded':
+                self.start(shard)
+            if shard['status'] == 'running':
+                operation = self.wait(shard)
+                self.reconcile(shard, operation)
+
+        summary = {
+            'shards': len(self.state['shards']),
+            'done': sum(1 for s in self.state['shards'] if s['status'] == 'done'),
+            'failed': sum(1 for s in self.state['shards'] if s['status'] == 'failed'),
+            'error_rows': sum(s.get('error_rows', 0) for s in self.state['shards']),
+        }
+        print(f'Bulk import {self.name} finished: {summary}')
+
+        return summary
+
+
+if __name__ == '__main__':
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version='2025-01')
+    client = s.create_session()
+
+    job = BulkImport(
+        app=s,
+        client=client,
+        name='create_products',
+        operation='create_products',
+        csv_filename='data/create_products_with_images.csv',
+        mode='pc',
+        callback_url=os.getenv('BULK_WEBHOOK_URL')
+    )
+    job.run()
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass, field
+from time import monotonic
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Background loads started by get_within_budget keep running here after the caller has answered
+revalidate_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='revalidate')
+
+_missing = object()
+
+
+@dataclass
+class TTLCache:
+    """
+    Thread-safe in-process cache with per-entry expiry and LRU eviction.
+
+    Entries are fresh for ttl seconds and may still be served as stale for another
+    stale_ttl seconds by get_within_budget while a background load refreshes them.
+    """
+    ttl: float = 300
+    maxsize: int = 1024
+    stale_ttl: float = 0
+    entries: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    inflight: dict = field(default_factory=dict, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def lookup(self, key, allow_stale=False):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _missing
+            value, fresh_until, stale_until = entry
+            now = monotonic()
+            if now > stale_until:
+                del self.entries[key]
+                return _missing
+            if now > fresh_until and not allow_stale:
+                return _missing
+            self.entries.move_to_end(key)
+
+            return value
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return default if value is _missing else value
+
+    def get_stale(self, key, default=None):
+        """Returns the entry even if it is past its ttl, as long as it is within stale_ttl."""
+        value = self.lookup(key, allow_stale=True)
+        return default if value is _missing else value
+
+    def set(self, key, value, ttl=None):
+        fresh_until = monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (value, fresh_until, fresh_until + self.stale_ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value, calling loader() and caching its result on a miss."""
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = loader()
+            self.set(key, value)
+
+        return value
+
+    def load(self, key, loader):
+        """Starts (or joins) a background load of key that stores its result when done."""
+        def run():
+            try:
+                value = loader()
+                self.set(key, value)
+                return value
+            finally:
+                with self.lock:
+                    self.inflight.pop(key, None)
+
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = revalidate_executor.submit(run)
+                self.inflight[key] = future
+
+        return future
+
+    def get_within_budget(self, key, loader, budget=None):
+        """
+        Returns (value, served) without waiting on loader() for longer than budget seconds.
+
+        served is 'cache' for a fresh hit, 'live' when the load finished in time, 'stale' when
+        an expired entry was returned while the load goes on in the background, and 'pending'
+        (value None) when there was nothing to fall back on. Load errors propagate unless a
+        stale entry can be served instead.
+        """
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value, 'cache'
+
+        future = self.load(key, loader)
+        try:
+            return future.result(timeout=budget), 'live'
+        except TimeoutError:
+            served = 'stale'
+        except Exception as e:
+            logger.warning(f"Load of {key} failed: {e}")
+            served = 'error'
+
+        value = self.get_stale(key, _missing)
+        if value is not _missing:
+            return value, 'stale'
+        if served == 'error':
+            return future.result(), 'live'
+
+        return None, 'pending'
@@ -0,0 +1,333 @@
+from concurrent.futures import TimeoutError
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from time import time
+import bisect
+import copy
+import os
+import sqlite3
+import threading
+import logging
+from cache import revalidate_executor
+
+logger = logging.getLogger(__name__)
+
+RATE_TABLE_PATH = 'data/carrier_rates.db'
+
+# Upper bound (lbs) of each weight band; a shipment is rated at its band's upper bound
+WEIGHT_BANDS = (50, 100, 150, 250, 500, 750, 1000, 1500, 2000, 3000, 5000)
+GRAMS_PER_POUND = 453.592
+
+# Piece dimensions (inches) used for every rating, as in /get-shipping-options
+PIECE_DIMENSIONS = {"Length": "61", "Width": "40", "Height": "24"}
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS rates (
+        origin_zip TEXT,
+        zip3 TEXT,
+        weight_band INTEGER,
+        service_code TEXT,
+        service_name TEXT,
+        total_quote REAL,
+        transit_days INTEGER,
+        sample_zip TEXT,
+        refreshed_at REAL,
+        PRIMARY KEY (origin_zip, zip3, weight_band, service_code)
+    );
+    CREATE TABLE IF NOT EXISTS unrated (
+        origin_zip TEXT,
+        zip3 TEXT,
+        weight_band INTEGER,
+        sample_zip TEXT,
+        refreshed_at REAL,
+        PRIMARY KEY (origin_zip, zip3, weight_band)
+    );
+'''
+
+
+def weight_band(pounds):
+    """Upper bound of the band a shipment weight falls in, or None above the largest band."""
+    index = bisect.bisect_left(WEIGHT_BANDS, max(pounds, 1))
+    return WEIGHT_BANDS[index] if index < len(WEIGHT_BANDS) else None
+
+
+def shipment_pounds(items):
+    """Total weight of a carrier-service rate request's items, in lbs."""
+    grams = sum((item.get('grams') or 0) * (item.get('quantity') or 1) for item in items)
+    return grams / GRAMS_PER_POUND
+
+
+def zip5(postal_code):
+    return (postal_code or '').strip()[:5]
+
+
+def transit_days(quote):
+    try:
+        delivery = datetime.fromisoformat(quote['DeliveryDate']).date()
+    except (KeyError, TypeError, ValueError):
+        return None
+    return max((delivery - date.today()).days, 0)
+
+
+def quote_rows(quotes, origin_zip, zip3, band, sample_zip):
+    """Table rows from the dsQuote.Quote list of a get_rating_rest response."""
+    now = time()
+    rows = []
+    for quote in quotes or []:
+        if quote.get('TotalQuote') is None or str(quote.get('AbleToCalculate', 'true')).lower() == 'false':
+            continue
+        rows.append({
+            'origin_zip': origin_zip,
+            'zip3': zip3,
+            'weight_band': band,
+            'service_code': quote.get('Service') or quote.get('DisplayService'),
+            'service_name': quote.get('DisplayService') or quote.get('Service'),
+            'total_quote': float(quote['TotalQuote']),
+            'transit_days': transit_days(quote),
+            'sample_zip': sample_zip,
+            'refreshed_at': now,
+        })
+
+    return rows
+
+
+def shopify_rates(rows, currency='USD'):
+    """Rows as the {"rates": [...]} body Shopify expects from a carrier service (prices in cents)."""
+    rates = []
+    for row in sorted(rows, key=lambda row: row['total_quote']):
+        rate = {
+            'service_name': f"Maersk {row['service_name']}",
+            'service_code': row['service_code'],
+            'total_price': str(round(row['total_quote'] * 100)),
+            'currency': currency,
+        }
+        if row['transit_days'] is not None:
+            delivery = (date.today() + timedelta(days=row['transit_days'])).isoformat()
+            rate['min_delivery_date'] = delivery
+            rate['max_delivery_date'] = delivery
+        rates.append(rate)
+
+    return {'rates': rates}
+
+
+@dataclass
+class CarrierRateTable:
+    """
+    Maersk rates by origin zip, destination zip3 and weight band, kept in SQLite so the
+    /carrier-rates callback answers checkout from disk.
+
+    A cell missing from the table is rated live, but the caller only waits live_deadline
+    seconds; a late answer still lands in the table for the next checkout. Cells older than
+    max_age are served as they are and re-rated in the background. A cell Maersk gave no usable
+    quote for is remembered as unrated, answers no rates and is retried after unrated_max_age.
+    """
+    maersk: object
+    path: str = RATE_TABLE_PATH
+    live_deadline: float = None
+    max_age: float = None
+    unrated_max_age: float = None
+    rating_timeout: float = 30
+    quote_template: dict = field(default=None, repr=False)
+    refreshing: dict = field(default_factory=dict, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    connection: sqlite3.Connection = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.live_deadline is None:
+            self.live_deadline = float(os.getenv('CARRIER_RATE_DEADLINE', 2.5))
+        if self.max_age is None:
+            self.max_age = float(os.getenv('CARRIER_RATE_MAX_AGE', 24 * 3600))
+        if self.unrated_max_age is None:
+            self.unrated_max_age = float(os.getenv('CARRIER_RATE_UNRATED_MAX_AGE', 3600))
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    # Table
+    def lookup(self, origin_zip, zip3, band):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT * FROM rates WHERE origin_zip = ? AND zip3 = ? AND weight_band = ?',
+                (origin_zip, zip3, band)
+            ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def unrated_at(self, origin_zip, zip3, band):
+        """When a cell was last rated without a usable quote, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT refreshed_at FROM unrated WHERE origin_zip = ? AND zip3 = ? AND weight_band = ?',
+                (origin_zip, zip3, band)
+            ).fetchone()
+
+        return row['refreshed_at'] if row else None
+
+    def store(self, origin_zip, zip3, band, rows, sample_zip=None):
+        """Replaces a cell's rows; no rows marks the cell unrated."""
+        cell = (origin_zip, zip3, band)
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM rates WHERE origin_zip = ? AND zip3 = ? AND weight_band = ?', cell)
+            self.connection.execute('DELETE FROM unrated WHERE origin_zip = ? AND zip3 = ? AND weight_band = ?', cell)
+            self.connection.executemany(
+                '''
+                INSERT INTO rates (origin_zip, zip3, weight_band, service_code, service_name, total_quote, transit_days, sample_zip, refreshed_at)
+                VALUES (:origin_zip, :zip3, :weight_band, :service_code, :service_name, :total_quote, :transit_days, :sample_zip, :refreshed_at)
+                ''',
+                rows
+            )
+            if not rows:
+                self.connection.execute(
+                    'INSERT INTO unrated (origin_zip, zip3, weight_band, sample_zip, refreshed_at) VALUES (?, ?, ?, ?, ?)',
+                    (*cell, sample_zip, time())
+                )
+
+    def cells(self):
+        """Every (origin_zip, zip3, weight_band, sample_zip) in the table, rated or unrated."""
+        with self.lock:
+            rows = self.connection.execute(
+                '''
+                SELECT origin_zip, zip3, weight_band, MAX(sample_zip) AS sample_zip FROM rates GROUP BY origin_zip, zip3, weight_band
+                UNION
+                SELECT origin_zip, zip3, weight_band, sample_zip FROM unrated
+                '''
+            ).fetchall()
+
+        return [tuple(row) for row in rows]
+
+    # Maersk
+    def new_quote(self):
+        """A copy of the blank GetNewQuote object, fetched once."""
+        if self.quote_template is None:
+            response = self.maersk.get_new_quote_rest(timeout=self.rating_timeout)
+            if response is None:
+                raise RuntimeError("Maersk GetNewQuote failed")
+            self.quote_template = self.maersk.quote_to_dict(response.text)
+
+        return copy.deepcopy(self.quote_template)
+
+    def rate(self, origin_zip, destination_zip, band):
+        """Rates one cell with Maersk and stores it. Returns the stored rows."""
+        data = {
+            "Rating": {
+                "LocationID": os.getenv('LOCATIONID'),
+                "Shipper": {"Zipcode": origin_zip},
+                "Consignee": {"Zipcode": destination_zip},
+                "LineItems": [{"Pieces": "1", "Weight": str(band), "Description": "Freight", **PIECE_DIMENSIONS}],
+                "TariffHeaderID": os.getenv('TARIFFHEADERID')
+            }
+        }
+        response = self.maersk.get_rating_rest(self.new_quote(), data, timeout=self.rating_timeout)
+        if response is None:
+            raise RuntimeError(f"Maersk rating failed for {origin_zip} -> {destination_zip} at {band} lbs")
+        quotes = response['dsQuote']['Quote']
+        rows = quote_rows(quotes if isinstance(quotes, list) else [quotes], origin_zip, destination_zip[:3], band, destination_zip)
+        if not rows:
+            logger.info(f"Maersk returned no usable quote for {origin_zip} -> {destination_zip} at {band} lbs")
+        self.store(origin_zip, destination_zip[:3], band, rows, sample_zip=destination_zip)
+
+        return rows
+
+    def refresh_in_background(self, origin_zip, destination_zip, band):
+        """Re-rates a cell on the shared background executor; a cell already being re-rated shares that run."""
+        cell = (origin_zip, destination_zip[:3], band)
+        with self.lock:
+            future = self.refreshing.get(cell)
+            if future is not None:
+                return future
+            future = self.refreshing[cell] = revalidate_executor.submit(self.rate, origin_zip, destination_zip, band)
+
+        def done(future):
+            with self.lock:
+                self.refreshing.pop(cell, None)
+            if future.exception():
+                logger.warning(f"Maersk rating for {destination_zip} at {band} lbs failed: {future.exception()}")
+
+        future.add_done_callback(done)
+
+        return future
+
+    # Checkout
+    def rates_for(self, origin_zip, destination_zip, pounds):
+        """Rate rows for a shipment: from the table, or live within live_deadline, else none."""
+        band = weight_band(pounds)
+        if band is None:
+            logger.info(f"No carrier rates for {destination_zip}: {pounds:.0f} lbs is over the {WEIGHT_BANDS[-1]} lb table")
+            return []
+        if len(destination_zip) < 3:
+            return []
+        rows = self.lookup(origin_zip, destination_zip[:3], band)
+        if rows:
+            if time() - min(row['refreshed_at'] for row in rows) > self.max_age:
+                self.refresh_in_background(origin_zip, destination_zip, band)
+            return rows
+        unrated_at = self.unrated_at(origin_zip, destination_zip[:3], band)
+        if unrated_at is not None:
+            if time() - unrated_at > self.unrated_max_age:
+                self.refresh_in_background(origin_zip, destination_zip, band)
+            return []
+
+        try:
+            return self.refresh_in_background(origin_zip, destination_zip, band).result(timeout=self.live_deadline)
+        except TimeoutError:
+            logger.warning(f"Live Maersk rating for {destination_zip} at {band} lbs missed the {self.live_deadline}s deadline")
+        except Exception:
+            pass  # logged by refresh_in_background
+
+        return []
+
+    def answer(self, rate_request):
+        """Shopify carrier-service callback body for a {"rate": {...}} request."""
+        rate = rate_request.get('rate') or {}
+        destination = rate.get('destination') or {}
+        if destination.get('country', 'US') != 'US':
+            return {'rates': []}
+        origin_zip = zip5((rate.get('origin') or {}).get('postal_code')) or os.getenv('SHIPPER_ZIPCODE', '91710')
+        rows = self.rates_for(origin_zip, zip5(destination.get('postal_code')), shipment_pounds(rate.get('items') or []))
+
+        return shopify_rates(rows, currency=rate.get('currency') or 'USD')
+
+    def build(self, origin_zip, destination_zips, bands=WEIGHT_BANDS):
+        """Rates every zip3 (one sample zip each) in every weight band, e.g. from order mirror zips."""
+        samples = {}
+        for destination_zip in destination_zips:
+            destination_zip = zip5(destination_zip)
+            if len(destination_zip) == 5 and destination_zip.isdigit():
+                samples.setdefault(destination_zip[:3], destination_zip)
+        print(f'Rating {len(samples)} zip3 area(s) x {len(bands)} weight band(s)...')
+        count = 0
+        for destination_zip in samples.values():
+            for band in bands:
+                try:
+                    count += len(self.rate(origin_zip, destination_zip, band))
+                except Exception as e:
+                    logger.error(e)
+        print(f'{count} rate(s) stored')
+
+        return count
+
+    def refresh_stale(self):
+        """Re-rates every cell older than max_age and every unrated cell older than unrated_max_age."""
+        now = time()
+        for origin_zip, zip3, band, sample_zip in self.cells():
+            rows = self.lookup(origin_zip, zip3, band)
+            unrated_at = self.unrated_at(origin_zip, zip3, band)
+            if ((rows and now - min(row['refreshed_at'] for row in rows) > self.max_age)
+                    or (unrated_at is not None and now - unrated_at > self.unrated_max_age)):
+                try:
+                    self.rate(origin_zip, sample_zip, band)
+                except Exception as e:
+                    logger.error(e)
+
+
+if __name__ == '__main__':
+    from maersk import MaerskApi
+    from order_mirror import shared_mirror
+
+    # Seeds the table with the destination zips of mirrored orders
+    table = CarrierRateTable(MaerskApi())
+    with shared_mirror().lock:
+        zips = [row[0] for row in shared_mirror().connection.execute('SELECT DISTINCT zip FROM orders WHERE zip IS NOT NULL')]
+    table.build(os.getenv('SHIPPER_ZIPCODE', '91710'), zips)
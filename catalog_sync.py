@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+INDEX_PATH = 'data/sync_index.json'
+
+# Column groups of the to_shopify output (data/temp.csv) that are hashed separately.
+# Product columns are read from the first row of a handle, image columns from all of its rows
+PRODUCT_COLUMNS = [
+    'Title', 'Body (HTML)', 'Vendor', 'Product Category', 'Type', 'Tags',
+    'Option1 Name', 'Option2 Name', 'Option3 Name',
+    'SEO Title', 'SEO Description', 'Status',
+    'enable_best_price (product.metafields.custom.enable_best_price)',
+]
+IMAGE_COLUMNS = ['Image Src', 'Image Alt Text']
+VARIANT_COLUMNS = [
+    'Option1 Value', 'Option2 Value', 'Option3 Value', 'Variant Grams', 'Variant Weight Unit',
+    'Variant Inventory Tracker', 'Variant Inventory Policy', 'Variant Requires Shipping',
+    'Variant Taxable', 'Variant Barcode', 'Variant Image',
+]
+PRICE_COLUMNS = ['Variant Price', 'Variant Compare At Price', 'Cost per item']
+INVENTORY_COLUMN = 'Variant Inventory Qty'
+
+# Kinds of change a row is checked for, each against its own hash
+CHANGE_KINDS = ('product', 'variant', 'price', 'inventory')
+
+
+def content_hash(df, columns):
+    present = [column for column in columns if column in df.columns]
+    joined = df[present].astype(str).agg('\x1f'.join, axis=1)
+
+    return joined.map(lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+
+
+def product_hashes(df):
+    """One hash per handle, so rows of the same product (variants, extra images) share it."""
+    rows = pd.DataFrame({
+        'Handle': df['Handle'],
+        'product': content_hash(df, PRODUCT_COLUMNS),
+        'images': content_hash(df, IMAGE_COLUMNS),
+    })
+    handles = rows.groupby('Handle', sort=False).agg(product=('product', 'first'), images=('images', '\x1f'.join))
+
+    return (handles['product'] + handles['images']).map(lambda x: hashlib.sha1(x.encode('utf-8')).hexdigest())
+
+
+def pending_path(index_path):
+    """Where sync_changes stages the index for index_path until commit_sync."""
+    root, extension = os.path.splitext(index_path)
+
+    return f'{root}.pending{extension}'
+
+
+def load_index(path=INDEX_PATH):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    return {'products': {}, 'variants': {}}
+
+
+def hash_catalog(df):
+    hashed_df = df[['Handle', 'Variant SKU']].copy()
+    hashed_df['product_hash'] = df['Handle'].map(product_hashes(df)) if len(df) else ''
+    hashed_df['variant_hash'] = content_hash(df, VARIANT_COLUMNS)
+    hashed_df['price_hash'] = content_hash(df, PRICE_COLUMNS)
+    hashed_df['inventory'] = df[INVENTORY_COLUMN].astype(str) if INVENTORY_COLUMN in df.columns else ''
+
+    return hashed_df
+
+
+def build_index(hashed_df):
+    products = dict(zip(hashed_df['Handle'], hashed_df['product_hash']))
+    variants = {
+        str(sku): {'variant': variant_hash, 'price': price_hash, 'inventory': inventory}
+        for sku, variant_hash, price_hash, inventory in zip(
+            hashed_df['Variant SKU'], hashed_df['variant_hash'], hashed_df['price_hash'], hashed_df['inventory']
+        )
+    }
+
+    return {'products': products, 'variants': variants}
+
+
+def classify_change(row, index):
+    """
+    Every kind of change of a catalog row against the index, comma separated in CHANGE_KINDS
+    order ('' when unchanged). A handle or SKU missing from the index counts as changed in full.
+    """
+    known = index['variants'].get(str(row['Variant SKU'])) or {}
+    changed = {
+        'product': index['products'].get(row['Handle']) != row['product_hash'],
+        'variant': known.get('variant') != row['variant_hash'],
+        'price': known.get('price') != row['price_hash'],
+        'inventory': known.get('inventory') != row['inventory'],
+    }
+
+    return ','.join(kind for kind in CHANGE_KINDS if changed[kind])
+
+
+def changed(df, *kinds):
+    """Mask of the rows whose change column names any of the kinds."""
+    return df['change'].map(lambda change: any(kind in change.split(',') for kind in kinds))
+
+
+def diff_catalog(df, index):
+    hashed_df = hash_catalog(df)
+    changes = hashed_df.apply(lambda x: classify_change(x, index), axis=1) if len(hashed_df) else pd.Series(dtype=str)
+
+    return changes, hashed_df
+
+
+def sync_changes(temp_csv='data/temp.csv', product_ids_csv='data/product_ids.csv', index_path=INDEX_PATH):
+    """
+    Splits the supplier catalog into only what changed since the last committed sync:
+    data/create_products.csv (handles Shopify doesn't have), and for the others
+    data/update_products.csv (product fields), data/update_variants.csv (variant fields or prices)
+    and data/inventory_changes.csv (QOH). A row with several kinds of change goes to each file.
+    The new index is staged next to index_path (see pending_path) until commit_sync() is called.
+    """
+    print('Computing catalog changes...')
+    shopify_df = pd.read_csv(temp_csv)
+    shopify_df.fillna('', inplace=True)
+    index = load_index(index_path)
+    changes, hashed_df = diff_catalog(shopify_df, index)
+    shopify_df['change'] = changes.values
+
+    product_ids_df = pd.read_csv(product_ids_csv) if os.path.exists(product_ids_csv) else pd.DataFrame(columns=['handle', 'id'])
+    merged_df = pd.merge(shopify_df, product_ids_df, how='left', left_on='Handle', right_on='handle')
+    merged_df.fillna('', inplace=True)
+
+    # Whether a changed row is created or updated depends on Shopify knowing the handle, not on the index
+    create_df = merged_df[(merged_df['id'] == '') & (merged_df['change'] != '')]
+    update_df = merged_df[(merged_df['id'] != '') & changed(merged_df, 'product')]
+    variant_df = merged_df[(merged_df['id'] != '') & changed(merged_df, 'variant', 'price')]
+    inventory_df = merged_df[(merged_df['id'] != '') & changed(merged_df, 'inventory')]
+
+    create_df.to_csv('data/create_products.csv', index=False)
+    update_df.to_csv('data/update_products.csv', index=False)
+    variant_df.to_csv('data/update_variants.csv', index=False)
+    inventory_df[['Handle', 'Variant SKU', INVENTORY_COLUMN]].to_csv('data/inventory_changes.csv', index=False)
+
+    pending_index = build_index(hashed_df)
+    with open(pending_path(index_path), 'w', encoding='utf-8') as file:
+        json.dump(pending_index, file)
+
+    summary = {
+        'rows': len(shopify_df),
+        'create': len(create_df),
+        'update_products': len(update_df),
+        'update_variants': len(variant_df),
+        'inventory': len(inventory_df),
+        'unchanged': int((shopify_df['change'] == '').sum()),
+        'removed': len(set(index['products']) - set(shopify_df['Handle'])),
+    }
+    print(f'Catalog changes: {summary}')
+
+    return summary
+
+
+def commit_sync(index_path=INDEX_PATH):
+    """Promotes the pending index once the bulk operations for a sync have succeeded."""
+    if os.path.exists(pending_path(index_path)):
+        os.replace(pending_path(index_path), index_path)
+        print('Catalog sync index committed')
+
+
+if __name__ == '__main__':
+    pass
+    # to_shopify('data/All_Products_PWHSL.xlsx')
+    # sync_changes()
+    # BulkImport(app=s, client=client, name='daily_create', operation='create_products', csv_filename='data/create_products.csv', mode='pc').run()
+    # commit_sync()
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from time import monotonic
+import threading
+import logging
+from shopify import ShopifyApi
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ClientRegistry:
+    """
+    Long-lived ShopifyApi clients keyed by shop, each with its own pooled requests session.
+
+    Clients are reused across requests and worker threads, rebuilt when the shop's token
+    changes, and closed once idle for idle_ttl seconds or when more than max_clients shops
+    are active (least recently used first).
+    """
+    version: str = '2025-01'
+    max_clients: int = 32
+    idle_ttl: float = 15 * 60
+    clients: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get(self, shop, access_token):
+        """Returns the ShopifyApi for a shop (e.g. 'my-store.myshopify.com'), creating it on first use."""
+        now = monotonic()
+        with self.lock:
+            entry = self.clients.get(shop)
+            if entry and entry['access_token'] == access_token:
+                entry['last_used'] = now
+                self.clients.move_to_end(shop)
+                return entry['api']
+
+            api = ShopifyApi(store_name=shop.split('.')[0], access_token=access_token, version=self.version)
+            api.create_session()
+            if entry:
+                self.close(entry)
+            self.clients[shop] = {'api': api, 'access_token': access_token, 'last_used': now}
+            self.clients.move_to_end(shop)
+            self.evict(now)
+
+            return api
+
+    def evict(self, now):
+        for shop in list(self.clients):
+            entry = self.clients[shop]
+            if len(self.clients) > self.max_clients or now - entry['last_used'] > self.idle_ttl:
+                del self.clients[shop]
+                self.close(entry)
+                logger.info(f"Closed Shopify client for {shop}")
+
+    def close(self, entry):
+        if entry['api'].session is not None:
+            entry['api'].session.close()
+
+    def discard(self, shop):
+        with self.lock:
+            entry = self.clients.pop(shop, None)
+            if entry:
+                self.close(entry)
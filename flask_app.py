@@ -3,12 +3,31 @@ import os
 import logging
 import requests
 from dotenv import load_dotenv
-from shopify import ShopifyApi
-from shopifyapi import ShopifyApp
+from shopifyapi import ShopifyApp, orders_per_query
 from maersk import MaerskApi
+import webhooks
+from cache import TTLCache, revalidate_executor
+from batch_loader import BatchLoader
+import queries
+from token_store import TokenStore
+from client_registry import ClientRegistry
+import bulk_import  # registers the bulk_operations/finish webhook handler
+from sku_index import shared_index  # also registers the products/* webhook handlers
+from order_mirror import shared_mirror  # also registers the orders/* webhook handlers
+from carrier_rates import CarrierRateTable
+from webhook_queue import WebhookQueue
+import resilience
+from resilience import DependencyUnavailable, mailer_dependency
+from order_projection import compile_projection, to_sentence
+from product_summaries import normalize_graphql_product, page_summary, render, store_summary
 from barcode import Code128
 from barcode.writer import SVGWriter
 import io
+import time
+from urllib.parse import urlparse
+import base64
+import hashlib
+import hmac
 import json
 from flask_cors import CORS
 import smtplib
@@ -25,7 +44,10 @@ logger = logging.getLogger(__name__)
 env = Environment(loader=FileSystemLoader("templates"))
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+# The session resolves the shop, so every worker and restart must sign cookies with the same key
+app.secret_key = os.getenv('FLASK_SECRET_KEY')
+if not app.secret_key:
+    raise RuntimeError("FLASK_SECRET_KEY is not set")
 # Allow all domains (or restrict to Shopify)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, allow_headers=["Authorization", "Content-Type"])
 
@@ -33,15 +55,238 @@ SHOPIFY_CLIENT_ID = os.getenv('P_API_KEY')
 SHOPIFY_CLIENT_SECRET = os.getenv('P_API_SECRET')
 SHOPIFY_SCOPE = "read_orders,read_products,read_customers"
 REDIRECT_URI = os.getenv('P_REDIRECT_URI')
-api = None
 maerskapi = MaerskApi()
+carrier_rate_table = CarrierRateTable(maerskapi)
+webhook_queue = WebhookQueue()
+webhook_queue.start()  # also resumes deliveries left queued by a previous run
+token_store = TokenStore()
+clients = ClientRegistry()
+order_mirror = shared_mirror()
+sku_index = shared_index()
+# get_product_details_by_query responses keyed by search query, shared by /getproduct and /product-email
+product_cache = TTLCache(ttl=int(os.getenv('PRODUCT_CACHE_TTL', 300)), maxsize=2048, stale_ttl=int(os.getenv('STALE_CACHE_TTL', 3600)))
+# get_orders responses keyed by order name
+order_cache = TTLCache(ttl=int(os.getenv('ORDER_CACHE_TTL', 120)), maxsize=2048, stale_ttl=int(os.getenv('STALE_CACHE_TTL', 3600)))
+
+# Seconds a RetellAI tool call may wait on Shopify before a stale or holding answer is returned
+LATENCY_BUDGETS = {
+    'getorder': float(os.getenv('GETORDER_LATENCY_BUDGET', 2.0)),
+    'getproduct': float(os.getenv('GETPRODUCT_LATENCY_BUDGET', 2.0)),
+}
+HOLD_MESSAGE = "I'm still looking that up. Please give me a moment and ask me again."
+# Phone numbers whose recent orders were prefetched lately, so repeated call starts don't refetch
+prefetched_phones = TTLCache(ttl=int(os.getenv('ORDER_CACHE_TTL', 120)), maxsize=1024)
+# Seconds an SMTP connect/command may take before send_email gives up
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 15))
+# Seconds an admin launch URL's timestamp may be off from now
+LAUNCH_MAX_AGE = 5 * 60
+
+
+def session_token_shop():
+    """
+    Shop of a verified Shopify session token (Authorization: Bearer <jwt> from App Bridge), or None.
+    The token is an HS256 JWT signed with the app secret, issued for this app (aud) and naming the shop in dest.
+    """
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer ') or not SHOPIFY_CLIENT_SECRET:
+        return None
+    try:
+        signing_input, signature = header[len('Bearer '):].strip().rsplit('.', 1)
+        digest = hmac.new(SHOPIFY_CLIENT_SECRET.encode('utf-8'), signing_input.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii'), signature):
+            return None
+        header_part, payload_part = signing_input.split('.')
+        if json.loads(base64.urlsafe_b64decode(header_part + '=' * (-len(header_part) % 4))).get('alg') != 'HS256':
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload_part + '=' * (-len(payload_part) % 4)))
+    except (ValueError, UnicodeError):
+        return None
+    now = time.time()
+    # Shopify allows a few seconds of clock skew either way
+    if claims.get('aud') != SHOPIFY_CLIENT_ID or claims.get('exp', 0) < now - 5 or claims.get('nbf', 0) > now + 5:
+        return None
+
+    return urlparse(claims.get('dest') or '').hostname
+
+
+def launch_shop():
+    """
+    Shop of an admin launch request (/index?shop=...&hmac=...&timestamp=...) whose query hmac checks
+    out and whose timestamp is recent, so a captured launch URL cannot be replayed later, or None.
+    """
+    params = request.args.to_dict()
+    signature = params.pop('hmac', None)
+    if not signature or not SHOPIFY_CLIENT_SECRET:
+        return None
+    try:
+        if abs(time.time() - int(params.get('timestamp', ''))) > LAUNCH_MAX_AGE:
+            return None
+    except ValueError:
+        return None
+    message = '&'.join(f'{key}={value}' for key, value in sorted(params.items()))
+    digest = hmac.new(SHOPIFY_CLIENT_SECRET.encode('utf-8'), message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    return params.get('shop') if hmac.compare_digest(digest, signature) else None
+
 
+def get_shop_api():
+    """The pooled ShopifyApi of the OAuth session's shop or of a verified session token's shop, or None."""
+    shop = session.get('shop')
+    access_token = session.get('access_token') if shop else None
+    if not shop:
+        shop = session_token_shop()
+        access_token = token_store.get(shop) if shop else None
+    if not shop or not access_token:
+        return None
+
+    return clients.get(shop, access_token)
 
-def get_order_id(order_name):
-    global api
-    response = api.orders(order_name=order_name)
 
-    return response['data']['orders']['edges'][0]['node']['id']
+def order_row(node):
+    """One row of the /index order table."""
+    return {
+        "no": node['name'],
+        "date": node['createdAt'],
+        "customer": f"{node['customer']['firstName']} {node['customer']['lastName']}" if node['customer'] else "Guest",
+        "totalPrice": f"${node['totalPriceSet']['shopMoney']['amount']}",
+        "paymentStatus": node['displayFinancialStatus'],
+        "fulfillmentStatus": node['displayFulfillmentStatus'],
+        "shippingAddress": (
+            f"{node['shippingAddress']['address1']}, {node['shippingAddress']['city']}, {node['shippingAddress']['country']}, {node['shippingAddress']['zip']}"
+            if node['shippingAddress'] else "No Address"
+        ),
+        "actions": "View"
+    }
+
+
+def mirror_row(header):
+    """order_row for an order_mirror search hit."""
+    return {
+        "no": header['name'],
+        "date": header['created_at'],
+        "customer": header['customer_name'] or "Guest",
+        "totalPrice": f"${header['total_price']}",
+        "paymentStatus": header['financial_status'],
+        "fulfillmentStatus": header['fulfillment_status'],
+        "shippingAddress": header['shipping_address'] or "No Address",
+        "actions": "View"
+    }
+
+
+def get_order_id(api, order_name):
+    return api.order_id(order_name)
+
+
+def latency_budget(endpoint):
+    """The endpoint's latency budget, tightened by the caller's X-Latency-Budget-Ms header if sent."""
+    budget = LATENCY_BUDGETS[endpoint]
+    try:
+        budget = min(budget, float(request.headers['X-Latency-Budget-Ms']) / 1000)
+    except (KeyError, ValueError):
+        pass
+
+    return budget
+
+
+def served_response(payload, served):
+    """JSON response reporting which path (cache, live, stale or pending) answered the call."""
+    response = jsonify({**payload, "served": served})
+    response.headers['X-Served-By'] = served
+
+    return response, 200
+
+
+def get_product_json(query, budget=None):
+    """
+    Product details (including onlineStoreUrl) for a products search query and the path that served them.
+    With a budget, a slow Shopify call is left to finish in the background (see TTLCache.get_within_budget).
+    """
+    def load():
+        s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
+        client = s.create_session()
+        try:
+            return s.get_product_details_by_query(client=client, variables={"query": query}).json()
+        finally:
+            client.close()
+
+    return product_cache.get_within_budget(query, load, budget)
+
+
+def load_orders(order_numbers):
+    """get_orders responses for the order names order_loader collected, fetched with aliased queries."""
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
+    client = s.create_session()
+    try:
+        return s.batch_get_orders(client, order_numbers)
+    finally:
+        client.close()
+
+
+# Order lookups from concurrent calls within a few ms share one Shopify request
+order_loader = BatchLoader(load_orders, window=float(os.getenv('ORDER_BATCH_WINDOW', 0.005)), max_batch=orders_per_query())
+
+
+def get_order_json(order_number, budget=None):
+    """get_orders response for an order name and the path that served it, cached like get_product_json."""
+    return order_cache.get_within_budget(order_number, lambda: order_loader.load(order_number), budget)
+
+
+def get_tracking_json(order_number):
+    """get_tracking_link response for an order name (tracking urls only)."""
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
+    client = s.create_session()
+    try:
+        return s.get_tracking_link(client, order_number).json()
+    finally:
+        client.close()
+
+
+def prefetch_orders(phone):
+    """Warms order_cache (order details and tracking links) with the caller's most recent orders."""
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
+    client = s.create_session()
+    try:
+        orders = s.get_recent_orders_by_phone(client, phone)
+    finally:
+        client.close()
+    for node in orders:
+        # Same shape as a get_orders response, so /getorder and /order-email read it as is
+        order_cache.set(node['name'], {'data': {'orders': {'edges': [{'node': node}]}}})
+    logger.info(f"Prefetched {len(orders)} order(s) for caller {phone}")
+
+    return len(orders)
+
+
+# Registered first, so the order mirror and SKU index still hold what a delete or update replaces
+@webhooks.handler('orders/updated', first=True)
+@webhooks.handler('orders/delete', first=True)
+def invalidate_cached_order(payload):
+    """Drops an order from order_cache, under its name with and without the leading #."""
+    name = payload.get('name')
+    if not name:
+        # orders/delete only carries the id
+        mirrored = order_mirror.get(payload.get('admin_graphql_api_id') or f"gid://shopify/Order/{payload.get('id')}")
+        name = mirrored and mirrored['name']
+    if name:
+        order_cache.delete(name)
+        order_cache.delete(name.lstrip('#'))
+
+
+@webhooks.handler('products/update', first=True)
+@webhooks.handler('products/delete', first=True)
+def invalidate_cached_product(payload):
+    """Drops the product's sku: and title: searches from product_cache, for its current and previous SKUs and title."""
+    product_id = payload.get('admin_graphql_api_id') or f"gid://shopify/Product/{payload.get('id')}"
+    skus = {variant['sku'] for variant in payload.get('variants') or [] if variant.get('sku')}
+    skus.update(sku_index.product_skus(product_id))
+    titles = {payload.get('title')}
+    stored = sku_index.get_summary(product_id=product_id)
+    if stored:
+        titles.add(stored['title'])
+    for sku in skus:
+        product_cache.delete("sku:{}".format(sku))
+    for title in titles - {None, ''}:
+        product_cache.delete("title:{}".format(title))
 
 
 def send_email(html_content, customerEmail, subjectNumber, mode, receiver_phone=None):
@@ -70,12 +315,17 @@ def send_email(html_content, customerEmail, subjectNumber, mode, receiver_phone=
         msg["Subject"] = "No Subject"
     msg.attach(MIMEText(html_content, "html"))
 
-    try:
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
+    def deliver():
+        with smtplib.SMTP("smtp.gmail.com", 587, timeout=SMTP_TIMEOUT) as server:
             server.starttls()
             server.login(sender_email, password)
             server.sendmail(sender_email, receiver_email, msg.as_string())
+
+    try:
+        mailer_dependency().call(deliver)
         print("Email sent successfully!")
+    except DependencyUnavailable:
+        raise
     except Exception as e:
         print(f"Error sending email: {e}")
 
@@ -116,83 +366,6 @@ def send_email(html_content, customerEmail, subjectNumber, mode, receiver_phone=
 
 #     return summary
 
-def summarize_product(product_data: dict) -> str:
-    """Summarizes product data with proper error handling for missing fields."""
-    try:
-        # Safely access nested data with error handling
-        product = product_data.get('data', {}).get('products', {}).get('edges', [{}])[0].get('node', {})
-        if not product:
-            return "Error: No product data found"
-
-        variants = product.get('variants', {}).get('edges', [])
-
-        # Extract variant details with fallbacks
-        colors = list(set(
-            v['node']['selectedOptions'][0]['optionValue']['name']
-            for v in variants
-            if v.get('node', {}).get('selectedOptions', [{}])[0].get('optionValue', {}).get('name')
-        )) if variants else []
-
-        available_colors = [
-            v['node']['selectedOptions'][0]['optionValue']['name']
-            for v in variants
-            if v.get('node', {}).get('availableForSale', False) and
-               v.get('node', {}).get('selectedOptions', [{}])[0].get('optionValue', {}).get('name')
-        ]
-
-        # Handle price calculations safely
-        prices = [float(v['node']['price']) for v in variants if v.get('node', {}).get('price')]
-        price_range = (
-            f"${min(prices):.2f}-${max(prices):.2f}"
-            if prices
-            else "Price not available"
-        )
-
-        # Safely get compareAtPrice with fallback
-        compare_at_price = (
-            f"${float(variants[0]['node']['compareAtPrice']):.2f}"
-            if variants and variants[0].get('node', {}).get('compareAtPrice')
-            else "Not available"
-        )
-
-        # Build summary with all fallbacks
-        summary = (
-            f"Product: {product.get('title', 'N/A')}\n"
-            f"Vendor: {product.get('vendor', 'N/A')}\n"
-            f"Description: {product.get('description', 'N/A')[:200]}...\n"
-            f"Total Inventory: {product.get('totalInventory', 0)}\n"
-            f"Variants Count: {product.get('variantsCount', {}).get('count', 0)} "
-            f"({product.get('variantsCount', {}).get('precision', 'N/A')})\n"
-            f"Available Colors: {', '.join(available_colors) if available_colors else 'N/A'} "
-            f"({len(available_colors)} of {len(colors)})\n"
-            f"Price Range: {price_range} (Compare at: {compare_at_price})\n"
-        )
-
-        if variants:
-            summary += "Variant Details:\n"
-            for i, variant in enumerate(variants, 1):
-                v = variant.get('node', {})
-                measurement = v.get('inventoryItem', {}).get('measurement', {})
-
-                summary += (
-                    f"  {i}. {v.get('displayName', 'N/A')}\n"
-                    f"     SKU: {v.get('sku', 'N/A')}\n"
-                    f"     Price: ${float(v.get('price', 0)):.2f}\n"
-                    f"     Available: {'Yes' if v.get('availableForSale', False) else 'No'}\n"
-                    f"     Inventory: {v.get('inventoryQuantity', 0)}\n"
-                    f"     Weight: {measurement.get('weight', {}).get('value', 'N/A')} "
-                    f"{measurement.get('weight', {}).get('unit', '')}\n"
-                    f"     Requires Shipping: {'Yes' if v.get('inventoryItem', {}).get('requiresShipping', False) else 'No'}\n\n"
-                )
-        else:
-            summary += "No variants available\n"
-
-        return summary
-
-    except Exception as e:
-        return f"Error generating product summary: {str(e)}"
-
-
 @app.after_request
 def add_headers(response):
     response.headers['X-Frame-Options'] = 'ALLOWALL'
@@ -245,17 +418,7 @@ def callback():
     if response.status_code == 200:
         access_token = response.json().get('access_token')
         logger.info(f"Access token retrieved for {shop}")
-        token_file_path = "shopify_tokens.json"
-
-        if os.path.exists(token_file_path):
-            with open(token_file_path, "r") as token_file:
-                all_tokens = json.load(token_file)
-        else:
-            all_tokens = {}
-
-        all_tokens[shop] = access_token
-        with open(token_file_path, "w") as token_file:
-            json.dump(all_tokens, token_file, indent=4)
+        token_store.set(shop, access_token)
 
         session['shop'] = shop
         session['access_token'] = access_token
@@ -267,96 +430,80 @@ def callback():
 
 @app.route('/index')
 def index():
-    global api
-
     shop = session.get('shop')
     access_token = session.get('access_token')
 
     if not shop or not access_token:
-        token_file_path = "shopify_tokens.json"
-        if os.path.exists(token_file_path):
-            with open(token_file_path, "r") as token_file:
-                all_tokens = json.load(token_file)
-                shop = request.args.get('shop')
-                access_token = all_tokens.get(shop)
+        # An admin launch signed by Shopify, for a shop that completed OAuth before
+        shop = launch_shop()
+        access_token = token_store.get(shop) if shop else None
 
     if not shop or not access_token:
         return "Unauthorized", 401
 
-    # Fetch orders from Shopify
-    api = ShopifyApi(store_name=shop.split('.')[0], access_token=access_token, version='2025-01')
-    api.create_session()
+    # Later /search_order, /order-details and /get-shipping-options calls resolve the client from this
+    session['shop'] = shop
+    session['access_token'] = access_token
+    # Fetch the first page of orders; static/index.js loads the rest from /api/orders while scrolling
+    api = clients.get(shop, access_token)
     orders_data = api.orders()
+    orders = [order_row(edge['node']) for edge in orders_data['data']['orders']['edges']]
+    page_info = orders_data['data']['orders']['pageInfo']
+
+    return render_template('index.html', shop=shop, orders=orders, next_cursor=page_info['endCursor'] if page_info['hasNextPage'] else '')
 
-    orders = []
-    for edge in orders_data['data']['orders']['edges']:
-        node = edge['node']
-        orders.append({
-            "no": node['name'],
-            "date": node['createdAt'],
-            "customer": f"{node['customer']['firstName']} {node['customer']['lastName']}" if node['customer'] else "Guest",
-            "totalPrice": f"${node['totalPriceSet']['shopMoney']['amount']}",
-            "paymentStatus": node['displayFinancialStatus'],
-            "fulfillmentStatus": node['displayFulfillmentStatus'],
-            "shippingAddress": (
-                f"{node['shippingAddress']['address1']}, {node['shippingAddress']['city']}, {node['shippingAddress']['country']}, {node['shippingAddress']['zip']}"
-                if node['shippingAddress'] else "No Address"
-            ),
-            "actions": "View"
-        })
-
-    return render_template('index.html', shop=shop, orders=orders, )
+
+@app.route('/api/orders')
+def list_orders():
+    """Next page of the /index order list as JSON: {"orders": [...], "nextCursor": "..." or null}."""
+    api = get_shop_api()
+    if api is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    cursor = request.args.get('cursor') or None
+    first = min(max(request.args.get('first', default=25, type=int), 1), 100)
+    orders_data = api.orders(cursor=cursor, first=first)
+    page_info = orders_data['data']['orders']['pageInfo']
+
+    return jsonify({
+        "orders": [order_row(edge['node']) for edge in orders_data['data']['orders']['edges']],
+        "nextCursor": page_info['endCursor'] if page_info['hasNextPage'] else None
+    })
+
+
+@app.route('/api/query-costs')
+def query_costs():
+    """Estimated and observed Shopify query cost of every registered query (see queries.py)."""
+    if get_shop_api() is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    return jsonify({"queries": queries.cost_report()})
 
 
 @app.route('/search_order')
 def search_order():
-    global api
-
-    token_file_path = "shopify_tokens.json"
-    if os.path.exists(token_file_path):
-        with open(token_file_path, "r") as token_file:
-            data = json.load(token_file)
-            for key, value in data.items():
-                shop = key
-                access_token = value
+    api = get_shop_api()
+    if api is None:
+        return "Unauthorized", 401
+    shop = f"{api.store_name}.myshopify.com"
 
-    order_name = request.args.get('orderid')
+    search_text = request.args.get('orderid')
 
-    if not order_name:
+    if not search_text:
         return jsonify({"error": "Order ID is required"}), 400
 
     try:
-        order_id = get_order_id(order_name)
-        response = api.order(order_id, mode='search')  # Assuming you have a method to get a specific order
-
-        order_data = response['data']['order']
-        if not order_data:
+        # Order name, customer name, email, phone or zip, answered from the local mirror
+        if order_mirror.count(shop):
+            orders = [mirror_row(header) for header in order_mirror.search(shop, search_text)]
+        else:
+            # Mirror not seeded for this shop yet: exact order name lookup on Shopify
+            orders_data = api.orders(order_name=search_text)
+            orders = [order_row(edge['node']) for edge in orders_data['data']['orders']['edges']]
+        if not orders:
             return jsonify({"error": "Order not found"}), 404
 
-        # Prepare the order data for rendering
-        order = {
-            "no": order_data['name'],
-            "date": order_data['createdAt'],
-            "customer": f"{order_data['customer']['firstName']} {order_data['customer']['lastName']}" if order_data['customer'] else "Guest",
-            "totalPrice": f"${order_data['totalPriceSet']['shopMoney']['amount']}",
-            "paymentStatus": order_data['displayFinancialStatus'],
-            "fulfillmentStatus": order_data['displayFulfillmentStatus'],
-            "shippingAddress": (
-                f"{order_data['shippingAddress']['address1']}, {order_data['shippingAddress']['city']}, {order_data['shippingAddress']['country']}, {order_data['shippingAddress']['zip']}"
-                if order_data['shippingAddress'] else "No Address"
-            ),
-            "detailAddress": {
-                "address1": order_data['shippingAddress']['address1'],
-                "address2": order_data['shippingAddress']['address2'],
-                "city": order_data['shippingAddress']['city'],
-                "country": order_data['shippingAddress']['country'],
-                "zip": order_data['shippingAddress']['zip'],
-            },
-            "actions": "View"
-        }
-
-        # Render the index.html with the specific order data
-        return render_template('index.html', shop=shop, orders=[order])  # Pass the order as a list
+        return render_template('index.html', shop=shop, orders=orders)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -368,7 +515,10 @@ def order_details():
     if not order_name:
         return jsonify({'error': 'Order ID is required'}), 400
 
-    order_id = get_order_id(order_name)
+    api = get_shop_api()
+    if api is None:
+        return "Unauthorized", 401
+    order_id = get_order_id(api, order_name)
     json_data = api.order(order_id, mode='details')
     order_data = json_data['data']['order']
 
@@ -423,14 +573,16 @@ def order_details():
 @app.route('/get-shipping-options')
 def get_shipping_options():
     global maerskapi
-    global api
 
     zipcode = request.args.get('zipcode', '91710')  # Default ZIP code if not provided
     ordername = request.args.get('ordername', '')
 
-    order_id = get_order_id(ordername)
+    api = get_shop_api()
+    if api is None:
+        return "Unauthorized", 401
+    order_id = get_order_id(api, ordername)
     # order_id = ordername
-    json_data = api.order(order_id, mode='details')
+    json_data = api.order(order_id, mode='shipping')
     order_data = json_data['data']['order']
 
     quote = maerskapi.get_new_quote_rest()
@@ -569,73 +721,24 @@ def get_label():
 @app.route("/getorder", methods=['POST'])
 def get_order_status():
     try:
-        # Define Shopify App
-        s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
-        client = s.create_session()
-
         data = request.get_json()
         orderNumber = data['args']['orderNumber']
 
-        response = s.get_orders(client, orderNumber)
+        order_data, served = get_order_json(orderNumber, budget=latency_budget('getorder'))
+        if served == 'pending':
+            return served_response({"result": HOLD_MESSAGE}, served)
 
-        order_data = response.json()
         order = order_data['data']['orders']['edges'][0]['node']
-        order_number = order['name']
-
-        if orderNumber == order_number:
-            # Extract all relevant information
-            line_items = order['lineItems']['edges']
-            subtotal_quantity = order['currentSubtotalLineItemsQuantity']
-            subtotal_price = order['currentSubtotalPriceSet']['shopMoney']['amount']
-            currency = order['lineItems']['edges'][0]['node']['originalUnitPriceSet']['shopMoney']['currencyCode']
-            total_weight = order['currentTotalWeight']
-            payment_gateway = order['paymentGatewayNames'][0]
-            shipping_method = order['shippingLines']['edges'][0]['node']['title']
-            shipping_cost = order['shippingLines']['edges'][0]['node']['currentDiscountedPriceSet']['shopMoney']['amount']
-            financial_status = order['displayFinancialStatus']
-            fulfillment_status = order['fulfillments'][0]['displayStatus']
-            return_status = order['returnStatus']
-            cancellation = order['cancellation']
-            cancel_reason = order['cancelReason']
-            cancelled_at = order['cancelledAt']
-            created_at = order['createdAt']
-            closed_at = order['closedAt']
-            fulfillment = order['fulfillments'][0]
-            tracking_company = fulfillment['trackingInfo'][0]['company'] if fulfillment['trackingInfo'] else None
-            tracking_number = fulfillment['trackingInfo'][0]['number'] if fulfillment['trackingInfo'] else None
-
-            # Format the list of items
-            items_list = []
-            for item in line_items:
-                item_name = item['node']['name']
-                item_quantity = item['node']['currentQuantity']
-                item_price = item['node']['originalUnitPriceSet']['shopMoney']['amount']
-                items_list.append(f"{item_quantity} {item_name} for {currency}{item_price}")
-
-            # Join the items into a natural-sounding sentence
-            if len(items_list) == 1:
-                items_description = items_list[0]
-            elif len(items_list) == 2:
-                items_description = f"{items_list[0]} and {items_list[1]}"
-            else:
-                items_description = ", ".join(items_list[:-1]) + f", and {items_list[-1]}"
-
-            responseMessage = (
-                f"Your order #{order_number} includes {items_description}. "
-                f"The subtotal for {subtotal_quantity} item(s) is {currency}{subtotal_price}, and the total weight is {total_weight} lbs. "
-                f"It was paid via {payment_gateway} and {fulfillment_status.lower()} via {shipping_method} for {currency}{shipping_cost}. "
-                f"The financial status is {financial_status.lower()}, and the return status is {return_status.lower().replace('_', ' ')}. "
-                f"The order was created on {created_at.split('T')[0]} and completed on {closed_at.split('T')[0]}. "
-                f"{'The order was not cancelled.' if cancellation is None else 'The order was cancelled.'} "
-                f"{'No cancellation reason was provided.' if cancel_reason is None else f'The cancellation reason was: {cancel_reason}.'} "
-                f'''{'No cancellation date was recorded.' if cancelled_at is None else f'The order was cancelled on {cancelled_at.split("T")[0]}.'} '''
-                f"The fulfillment status is {fulfillment_status.lower()}, and the tracking company is {tracking_company if tracking_company else 'not available'}, with tracking number {tracking_number if tracking_number else 'not available'}."
-                f"{'The order was delivered on ' + fulfillment['deliveredAt'].split('T')[0] + '.' if fulfillment_status == 'DELIVERED' else 'The estimated delivery date is ' + fulfillment['estimatedDeliveryAt'].split('T')[0] + '.'}"
-            )
-
-            return jsonify({"result": responseMessage}), 200
+        projection = compile_projection()(order)
+
+        if orderNumber == projection['order_number']:
+            responseMessage = to_sentence(projection)
+
+            return served_response({"result": responseMessage}, served)
         else:
             abort(404, description="Order not found")
+    except DependencyUnavailable:
+        raise  # answered 503 by dependency_unavailable
     except Exception as e:
         logger.error(f"Failed to parse request body: {e}")
         abort(400, description="Invalid request body")
@@ -644,23 +747,36 @@ def get_order_status():
 @app.route("/getproduct", methods=['POST'])
 def get_product_details():
     try:
-        # Define Shopify App
-        s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
-        client = s.create_session()
-
         data = request.get_json()
         productName = data['args']['productName']
         itemNumber = data['args']['itemNumber']
+        page = data['args'].get('page', 1)
 
+        # Summaries are precomputed when the catalog index is refreshed and on products/update webhooks
         if itemNumber:
-            variables = {"query": "sku:{}".format(itemNumber)}
-            response = s.get_product_details_by_query(client=client, variables=variables)
+            query = "sku:{}".format(itemNumber)
+            stored = sku_index.get_summary(sku=itemNumber)
         elif (not itemNumber) and (productName):
-            variables = {"query": "title:{}".format(productName)}
-            response = s.get_product_details_by_query(client=client, variables=variables)
+            query = "title:{}".format(productName)
+            stored = sku_index.get_summary(title=productName)
         else:
             abort(404, description="Product not found")
-        data = response.json()
+
+        served = 'cache'
+        if stored is None:
+            data, served = get_product_json(query, budget=latency_budget('getproduct'))
+            if served == 'pending':
+                return served_response({"result": HOLD_MESSAGE}, served)
+            edges = data.get('data', {}).get('products', {}).get('edges', [])
+            if not edges:
+                return served_response({"result": "Error: No product data found"}, served)
+            product = normalize_graphql_product(edges[0]['node'])
+            if product['variants_count'] <= len(product['variants']):
+                header, variants = store_summary(product, sku_index)
+            else:
+                # The live query only returns the first variants, so don't store an incomplete summary
+                header, variants = render(product)
+            stored = {'header': header, 'variants': variants}
         # product_data = data['data']['products']['edges'][0]['node']
 
         # responseMessage = f"""
@@ -673,10 +789,12 @@ def get_product_details():
         #     Selected options include {', '.join([option['name'] for option in product_data['selectedOptions']])}.
         # """
 
-        responseMessage = summarize_product(data)
+        responseMessage, page, pages = page_summary(stored['header'], stored['variants'], page)
 
-        return jsonify({"result": responseMessage}), 200
+        return served_response({"result": responseMessage, "page": page, "pages": pages}, served)
 
+    except DependencyUnavailable:
+        raise  # answered 503 by dependency_unavailable
     except Exception as e:
         logger.error(f"Failed to parse request body: {e}")
         abort(400, description="Invalid request body")
@@ -863,22 +981,15 @@ def send_order_email():
         # Get tracking link from Shopify if order number exists
         if order_data['orderNumber'] != 'N/A':
             try:
-                s = ShopifyApp(
-                    store_name=os.getenv('TRENDTIME_STORE_NAME'),
-                    access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'),
-                    api_version=os.getenv('API_VERSION')
-                )
-                client = s.create_session()
-                response = s.get_tracking_link(client, order_data['orderNumber'])
-
-                if response.status_code == 200:
-                    order_response = response.json()
-                    order_node = order_response.get('data', {}).get('orders', {}).get('edges', [{}])[0].get('node', {})
-                    if order_node:
-                        fulfillments = order_node.get('fulfillments', [])
-                        if fulfillments:
-                            tracking_info = fulfillments[0].get('trackingInfo', [{}])[0]
-                            order_data['trackingLink'] = tracking_info.get('url')
+                # An order fetched by /getorder or a call-start prefetch already has its tracking urls;
+                # otherwise only the tracking urls are fetched
+                order_response = order_cache.get(order_data['orderNumber']) or get_tracking_json(order_data['orderNumber'])
+                order_node = order_response.get('data', {}).get('orders', {}).get('edges', [{}])[0].get('node', {})
+                if order_node:
+                    fulfillments = order_node.get('fulfillments', [])
+                    if fulfillments:
+                        tracking_info = fulfillments[0].get('trackingInfo', [{}])[0]
+                        order_data['trackingLink'] = tracking_info.get('url')
             except Exception as shopify_error:
                 logger.warning(f"Failed to get tracking link: {shopify_error}")
 
@@ -892,10 +1003,14 @@ def send_order_email():
                 "result": "Order details sent successfully",
                 "orderNumber": order_data['orderNumber']
             }), 200
+        except DependencyUnavailable:
+            raise  # answered 503 by dependency_unavailable
         except Exception as email_error:
             logger.error(f"Failed to send email: {email_error}")
             abort(500, description="Failed to send email")
 
+    except DependencyUnavailable:
+        raise  # answered 503 by dependency_unavailable
     except Exception as e:
         logger.error(f"Unexpected error in send_details_email: {str(e)}", exc_info=True)
         abort(500, description="Internal server error")
@@ -936,27 +1051,21 @@ def send_product_email():
             "onlineStoreUrl": None
         }
 
-        # Get tracking link from Shopify if order number exists
+        # Get product details (with the online store url) if an item number was given
+        product_json = {'data': {'products': {'edges': []}}}
         if product_data['itemNumber'] != 'N/A':
             try:
-                s = ShopifyApp(
-                    store_name=os.getenv('TRENDTIME_STORE_NAME'),
-                    access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'),
-                    api_version=os.getenv('API_VERSION')
-                )
-                client = s.create_session()
-                variables = {"query": "sku:{}".format(product_data['itemNumber'])}
-                product_response = s.get_product_details_by_query(client=client, variables=variables)
-                product_json = product_response.json()
-                online_url_response = s.get_online_store_url(client, product_data['itemNumber'])
-
-                if online_url_response.status_code == 200:
-                    online_url_data = online_url_response.json()
-                    online_url_node = online_url_data.get('data', {}).get('products', {}).get('edges', [{}])[0].get('node', {})
-                    if online_url_node:
-                        product_json['data']['products']['edges'][0]['onlineStoreUrl'] = online_url_node.get('onlineStoreUrl', '')
+                # Same cache entry as /getproduct, so asking about a product first makes this free
+                product_json, _ = get_product_json("sku:{}".format(product_data['itemNumber']))
+            except DependencyUnavailable:
+                raise
             except Exception as shopify_error:
-                logger.warning(f"Failed to get online store url: {shopify_error}")
+                logger.warning(f"Failed to get product details: {shopify_error}")
+            # A product without an online store url in the response falls back to the SKU index, without a Shopify call
+            edges = (product_json.get('data') or {}).get('products', {}).get('edges') or []
+            if edges and not edges[0]['node'].get('onlineStoreUrl'):
+                indexed = sku_index.get(product_data['itemNumber'])
+                edges[0]['node']['onlineStoreUrl'] = (indexed or {}).get('online_store_url') or ''
 
         # Send email
         try:
@@ -968,15 +1077,107 @@ def send_product_email():
                 "result": "Product details sent successfully",
                 "itemNumber": product_data['itemNumber']
             }), 200
+        except DependencyUnavailable:
+            raise  # answered 503 by dependency_unavailable
         except Exception as email_error:
             logger.error(f"Failed to send email: {email_error}")
             abort(500, description="Failed to send email")
 
+    except DependencyUnavailable:
+        raise  # answered 503 by dependency_unavailable
     except Exception as e:
         logger.error(f"Unexpected error in send_product_email: {str(e)}", exc_info=True)
         abort(500, description="Internal server error")
 
 
+## Call Started
+@app.route("/call-started", methods=['POST'])
+def call_started():
+    """RetellAI call webhook: prefetches the caller's recent orders while the agent greets them."""
+    if not webhooks.verify_retell_signature(request.get_data(), request.headers.get('X-Retell-Signature')):
+        abort(401, description="Invalid RetellAI signature")
+    data = request.get_json(silent=True) or {}
+    if data.get('event', 'call_started') != 'call_started':
+        return '', 204
+
+    call = data.get('call', {})
+    phone = call.get('from_number') or data.get('args', {}).get('phone_number')
+    if phone and prefetched_phones.get(phone) is None:
+        prefetched_phones.set(phone, True)
+        revalidate_executor.submit(prefetch_orders, phone).add_done_callback(
+            lambda future: future.exception() and logger.warning(f"Order prefetch for {phone} failed: {future.exception()}")
+        )
+
+    return '', 204
+
+
+# Carrier service
+@app.route('/carrier-rates', methods=['POST'])
+def carrier_rates():
+    """
+    Shopify checkout rate callback (the callbackUrl of ShopifyApi.create_carrier_service).
+    Answers from the precomputed Maersk rate table; see CarrierRateTable for the live fallback.
+    """
+    body = request.get_data()
+    if not webhooks.verify_hmac(body, request.headers.get('X-Shopify-Hmac-Sha256')):
+        abort(401, description="Invalid carrier service signature")
+
+    try:
+        rate_request = json.loads(body or b'{}')
+    except ValueError:
+        abort(400, description="Rate request body is not valid JSON")
+    if not isinstance(rate_request, dict):
+        abort(400, description="Rate request body must be a JSON object")
+
+    return jsonify(carrier_rate_table.answer(rate_request))
+
+
+# Webhooks
+@app.route('/webhooks', methods=['POST'])
+def receive_webhook():
+    body = request.get_data()
+    if not webhooks.verify_hmac(body, request.headers.get('X-Shopify-Hmac-Sha256')):
+        abort(401, description="Invalid webhook signature")
+
+    # Handlers parse the body on a worker thread, so a body that is not JSON is turned away here
+    try:
+        json.loads(body)
+    except ValueError:
+        abort(400, description="Webhook body is not valid JSON")
+
+    topic = request.headers.get('X-Shopify-Topic')
+    if not webhooks.HANDLERS.get((topic or '').lower()):
+        logger.info(f"No handler registered for webhook topic {topic}")
+        return '', 200
+
+    # Handlers run on the queue's worker threads; a redelivered webhook id is acknowledged and dropped
+    webhook_id = request.headers.get('X-Shopify-Webhook-Id') or hashlib.sha256(body).hexdigest()
+    if not webhook_queue.enqueue(webhook_id, topic, request.headers.get('X-Shopify-Shop-Domain'), body):
+        logger.info(f"Duplicate webhook {webhook_id} ({topic}) ignored")
+
+    return '', 200
+
+
+@app.route('/metrics')
+def metrics():
+    """Circuit breaker and bulkhead state of each dependency, plus the webhook queue backlog."""
+    return jsonify({
+        "dependencies": resilience.metrics(),
+        "webhook_queue": webhook_queue.counts(),
+    })
+
+
+@app.errorhandler(DependencyUnavailable)
+def dependency_unavailable(error):
+    """A circuit breaker or bulkhead turned the call away: answer 503 right away."""
+    logger.warning(str(error))
+    response = jsonify({"error": str(error)})
+    if error.retry_after:
+        response.headers['Retry-After'] = str(max(int(error.retry_after), 1))
+
+    return response, 503
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     """
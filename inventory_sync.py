@@ -0,0 +1,234 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from time import sleep, monotonic
+import httpx
+import json
+import os
+import threading
+import logging
+import pandas as pd
+from dotenv import load_dotenv
+from bulk_import import write_json_atomic
+from shopifyapi import ShopifyApp
+from sku_index import SkuIndex, shared_index
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUANTITIES_PATH = 'data/inventory_quantities.json'
+
+# inventorySetQuantities accepts at most 250 quantities per call and its cost does not grow
+# with the list, so full batches are the cheapest way to push a feed
+MAX_BATCH_SIZE = 250
+
+# (sku column, quantity column) pairs understood by read_feed, in order of preference
+FEED_COLUMNS = [('Sku', 'QOH'), ('Variant SKU', 'Variant Inventory Qty')]
+
+
+@dataclass
+class ThrottleBudget:
+    """Client-side copy of the shop's GraphQL cost bucket, shared by concurrent workers."""
+    maximum: float = 1000
+    restore_rate: float = 50
+    available: float = None
+    updated_at: float = field(default_factory=monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        if self.available is None:
+            self.available = self.maximum
+
+    def refill(self):
+        now = monotonic()
+        self.available = min(self.maximum, self.available + (now - self.updated_at) * self.restore_rate)
+        self.updated_at = now
+
+    def acquire(self, cost):
+        """Blocks until the bucket can pay for a request of the given cost, then spends it."""
+        while True:
+            with self.lock:
+                self.refill()
+                if self.available >= cost:
+                    self.available -= cost
+                    return
+                delay = (cost - self.available) / self.restore_rate
+            sleep(delay)
+
+    def update(self, data):
+        """Resyncs with the throttleStatus Shopify reports in extensions.cost."""
+        throttle = ((data.get('extensions') or {}).get('cost') or {}).get('throttleStatus') or {}
+        if 'currentlyAvailable' not in throttle:
+            return
+        with self.lock:
+            self.maximum = throttle.get('maximumAvailable') or self.maximum
+            self.restore_rate = throttle.get('restoreRate') or self.restore_rate
+            self.available = throttle['currentlyAvailable']
+            self.updated_at = monotonic()
+
+
+def read_feed(path):
+    """Reads a QOH feed (supplier xlsx/csv or inventory_changes.csv) into {sku: quantity}."""
+    df = pd.read_excel(path, dtype=str) if path.endswith(('.xlsx', '.xls')) else pd.read_csv(path, dtype=str)
+    for sku_column, quantity_column in FEED_COLUMNS:
+        if sku_column in df.columns and quantity_column in df.columns:
+            break
+    else:
+        raise ValueError(f'{path} has no SKU/quantity columns, expected one of {FEED_COLUMNS}')
+
+    df = df[[sku_column, quantity_column]].dropna(subset=[sku_column])
+    quantities = pd.to_numeric(df[quantity_column], errors='coerce').fillna(0).clip(lower=0).astype(int)
+
+    return dict(zip(df[sku_column].str.strip(), quantities))
+
+
+def error_indexes(user_errors):
+    """Positions in the quantities list that userErrors point at (field like ['input', 'quantities', '3', ...])."""
+    indexes = set()
+    for error in user_errors:
+        path = error.get('field') or []
+        if 'quantities' in path and path.index('quantities') + 1 < len(path):
+            position = path[path.index('quantities') + 1]
+            if str(position).isdigit():
+                indexes.add(int(position))
+
+    return indexes
+
+
+@dataclass
+class InventorySync:
+    app: ShopifyApp
+    client: httpx.Client
+    location_id: str = None
+    sku_index: SkuIndex = None
+    quantities_path: str = QUANTITIES_PATH
+    index_max_age: float = 24 * 60 * 60
+    batch_size: int = MAX_BATCH_SIZE
+    max_workers: int = 4
+    budget: ThrottleBudget = field(default_factory=ThrottleBudget)
+
+    def __post_init__(self):
+        if self.sku_index is None:
+            self.sku_index = shared_index()
+
+    # SKU index
+    def load_sku_index(self, refresh=False):
+        """Returns {sku: inventory item id}, refreshing the shared index when empty or older than index_max_age."""
+        age = self.sku_index.age()
+        if refresh or age is None or age > self.index_max_age:
+            self.sku_index.refresh(self.app, self.client)
+
+        return self.sku_index.inventory_items()
+
+    def resolve_location(self):
+        if not self.location_id:
+            edges = self.app.query_locations(self.client)['data']['locations']['edges']
+            self.location_id = edges[0]['node']['id']
+
+        return self.location_id
+
+    # Known quantities
+    def load_quantities(self):
+        if os.path.exists(self.quantities_path):
+            with open(self.quantities_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+
+        return {}
+
+    def save_quantities(self, quantities):
+        os.makedirs(os.path.dirname(self.quantities_path) or '.', exist_ok=True)
+        write_json_atomic(self.quantities_path, quantities)
+
+    # Push
+    def diff(self, feed, index, known):
+        """Returns [(sku, quantity)] that differ from the last pushed quantity, plus SKUs missing from the index."""
+        changes = [(sku, qty) for sku, qty in feed.items() if sku in index and known.get(sku) != qty]
+        unknown = [sku for sku in feed if sku not in index]
+
+        return changes, unknown
+
+    def push_batch(self, batch, index, cost):
+        quantities = [
+            {'inventoryItemId': index[sku], 'locationId': self.location_id, 'quantity': qty}
+            for sku, qty in batch
+        ]
+        self.budget.acquire(cost)
+        data = self.app.update_inventories(self.client, quantities)
+        self.budget.update(data)
+        result = (data.get('data') or {}).get('inventorySetQuantities') or {}
+        user_errors = result.get('userErrors') or []
+        if data.get('errors'):
+            raise RuntimeError(f"inventorySetQuantities failed: {data['errors']}")
+
+        failed = error_indexes(user_errors)
+        if user_errors and not failed:
+            # Errors that cannot be tied to a row reject the whole batch
+            failed = set(range(len(batch)))
+
+        return data, user_errors, failed
+
+    def push(self, changes, index, known):
+        batch_size = min(self.batch_size, MAX_BATCH_SIZE)
+        batches = [changes[i:i + batch_size] for i in range(0, len(changes), batch_size)]
+        if not batches:
+            return {'batches': 0, 'updated': 0, 'failed': 0, 'errors': []}
+
+        # The first batch runs alone to learn the real cost of the mutation
+        data, user_errors, failed = self.push_batch(batches[0], index, cost=10)
+        cost = ((data.get('extensions') or {}).get('cost') or {}).get('requestedQueryCost') or 10
+        results = [(batches[0], user_errors, failed)]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.push_batch, batch, index, cost): batch for batch in batches[1:]}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    _, user_errors, failed = future.result()
+                except Exception as e:
+                    logger.error(f'Inventory batch of {len(batch)} failed: {e}')
+                    user_errors, failed = [{'message': str(e)}], set(range(len(batch)))
+                results.append((batch, user_errors, failed))
+
+        summary = {'batches': len(batches), 'updated': 0, 'failed': 0, 'errors': []}
+        for batch, user_errors, failed in results:
+            for i, (sku, qty) in enumerate(batch):
+                if i in failed:
+                    summary['failed'] += 1
+                else:
+                    known[sku] = qty
+                    summary['updated'] += 1
+            summary['errors'].extend(user_errors)
+
+        return summary
+
+    def run(self, feed_path, refresh_index=False):
+        """Pushes the quantities in a QOH feed that changed since the last run."""
+        feed = read_feed(feed_path)
+        index = self.load_sku_index(refresh=refresh_index)
+        self.resolve_location()
+        known = self.load_quantities()
+
+        changes, unknown = self.diff(feed, index, known)
+        if unknown and not refresh_index and len(unknown) > len(feed) * 0.01:
+            # Enough unknown SKUs that the cached index is probably behind the catalog
+            index = self.load_sku_index(refresh=True)
+            changes, unknown = self.diff(feed, index, known)
+
+        print(f'Pushing {len(changes)} inventory change(s)...')
+        try:
+            summary = self.push(changes, index, known)
+        finally:
+            self.save_quantities(known)
+
+        summary['unchanged'] = len(feed) - len(changes) - len(unknown)
+        summary['unknown_skus'] = len(unknown)
+        print(f"Inventory sync finished: { {k: v for k, v in summary.items() if k != 'errors'} }")
+
+        return summary
+
+
+if __name__ == '__main__':
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version='2025-01')
+    client = s.create_session()
+
+    InventorySync(app=s, client=client, location_id=os.getenv('SHOPIFY_LOCATION_ID')).run('data/inventory_changes.csv')
@@ -11,6 +11,7 @@ import json
 import logging
 from datetime import datetime
 import base64
+from resilience import DependencyUnavailable, GuardedAdapter, maersk_dependency
 
 # logging.basicConfig(level=logging.DEBUG)
 load_dotenv()
@@ -20,6 +21,16 @@ load_dotenv()
 class MaerskApi():
 	base_api_url: str = 'https://pilotws.pilotdelivers.com'
 	session: requests.Session = field(default_factory=requests.Session)
+	timeout: float = float(os.getenv('MAERSK_TIMEOUT', 20))
+
+	def rest_session(self):
+		"""Session for the Pilot/Maersk REST calls, behind the 'maersk' circuit breaker and bulkhead."""
+		session = requests.Session()
+		adapter = GuardedAdapter(maersk_dependency(), timeout=self.timeout)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+
+		return session
 
 	def save_pdf_from_xml(self, xml_string, output_filename):
 		# Parse the XML string
@@ -63,14 +74,16 @@ class MaerskApi():
 			print("Error:", e)
 			return None
 
-	def get_new_quote_rest(self):
+	def get_new_quote_rest(self, timeout=None):
 		endpoint = 'https://ws.pilotair.com/tms2.1/tms/PilotServiceRequest.asmx/GetNewQuote'
 
 		try:
-			with requests.Session() as client:
-				response = client.get(endpoint, verify=False)
+			with self.rest_session() as client:
+				response = client.get(endpoint, verify=False, timeout=timeout)
 			response.raise_for_status()
 			return response
+		except DependencyUnavailable:
+			raise
 		except Exception as e:
 			print(f"Error occurred: {e}")
 			return None
@@ -130,7 +143,8 @@ class MaerskApi():
 			</soap12:Envelope>
 		"""
 
-		response = requests.post(url, data=soap_envelope, headers=headers, verify=False)
+		with self.rest_session() as client:
+			response = client.post(url, data=soap_envelope, headers=headers, verify=False)
 
 		return response
 
@@ -209,7 +223,7 @@ class MaerskApi():
 		except Exception as e:
 			print("Error:", e)
 
-	def get_rating_rest(self, ratingRootObject, data):
+	def get_rating_rest(self, ratingRootObject, data, timeout=None):
 		rating_data = data['Rating']
 		ratingRootObject['Rating']['LocationID'] = rating_data['LocationID']
 		ratingRootObject['Rating']['Shipper']['Zipcode'] = rating_data['Shipper']['Zipcode']
@@ -227,11 +241,13 @@ class MaerskApi():
 		}
 
 		try:
-			with requests.Session() as client:
+			with self.rest_session() as client:
 				client.headers.update(headers)
-				response = client.post(endpoint, verify=False, json=payload)
+				response = client.post(endpoint, verify=False, json=payload, timeout=timeout)
 			response.raise_for_status()
 			return response.json()
+		except DependencyUnavailable:
+			raise
 		except Exception as e:
 			print(f"Error occurred: {e}")
 			return None
@@ -807,11 +823,13 @@ class MaerskApi():
 		print(f'payload: {payload}')
 
 		try:
-			with requests.Session() as client:
+			with self.rest_session() as client:
 				client.headers.update(headers)
 				response = client.post(endpoint, verify=False, json=payload)
 			response.raise_for_status()
 			return response.json()
+		except DependencyUnavailable:
+			raise
 		except Exception as e:
 			print(f"Error occurred: {e}")
 			return None
@@ -836,11 +854,13 @@ class MaerskApi():
 		}
 
 		try:
-			with requests.Session() as client:
+			with self.rest_session() as client:
 				client.headers.update(headers)
 				response = client.post(endpoint, verify=False, json=payload)
 			response.raise_for_status()
 			return response
+		except DependencyUnavailable:
+			raise
 		except Exception as e:
 			print(f"Error occurred: {e}")
 			return None
@@ -855,10 +875,12 @@ class MaerskApi():
 		}
 
 		try:
-			with requests.Session() as client:
+			with self.rest_session() as client:
 				response = client.get(endpoint, verify=False, params=params)
 			response.raise_for_status()
 			return response
+		except DependencyUnavailable:
+			raise
 		except Exception as e:
 			print(f"Error occurred: {e}")
 			return None
@@ -6,7 +6,12 @@ import datetime
 import logging
 import json
 import uvicorn
-from shopifyapi import ShopifyApp
+from shopifyapi import ShopifyApp, orders_per_query
+from order_projection import FIELDS, VOICE_FIELDS, compile_projection, to_payload
+from singleflight import AsyncSingleFlight, request_key
+from batch_loader import BatchLoader
+from itertools import groupby
+import asyncio
 import os
 
 app = FastAPI()
@@ -16,6 +21,28 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def load_orders(keys):
+    """get_orders responses for (order number, fields) keys, one aliased query per distinct fields."""
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
+    client = s.create_session()
+    results = {}
+    try:
+        for fields, group in groupby(sorted(keys, key=lambda key: key[1]), key=lambda key: key[1]):
+            order_numbers = [order_number for order_number, _ in group]
+            for order_number, response in s.batch_get_orders(client, order_numbers, fields=fields).items():
+                results[(order_number, fields)] = response
+    finally:
+        client.close()
+
+    return results
+
+
+# Concurrent calls for the same order await one lookup, run off the event loop;
+# lookups for different orders within a few ms are batched into one request
+order_flight = AsyncSingleFlight()
+order_loader = BatchLoader(load_orders, window=float(os.getenv('ORDER_BATCH_WINDOW', 0.005)), max_batch=orders_per_query())
+
+
 # Mock database for orders, products, and shipments
 orders_db = {
     "12345": {
@@ -68,118 +95,47 @@ shipments_db = {
     }
 }
 
+def requested_fields(args):
+    """
+    The projection fields a /getorder call asked for, sorted so every ordering shares one
+    cache entry (order_number is always included, it confirms the match), or VOICE_FIELDS.
+    """
+    fields = args.get('fields')
+    if not fields:
+        return VOICE_FIELDS
+    if not isinstance(fields, list) or not all(isinstance(name, str) for name in fields):
+        raise HTTPException(status_code=400, detail="fields must be a list of field names")
+    unknown = sorted(set(fields) - set(FIELDS))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown order fields: {', '.join(unknown)}")
+
+    return tuple(sorted({'order_number', *fields}))
+
+
 # Custom function: Get order status
 @app.post("/getorder")
 async def get_order_status(request: Request):
     try:
-        # Define Shopify App
-        s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version=os.getenv('API_VERSION'))
-        client = s.create_session()
-
         data = await request.json()
         orderNumber = data['args']['orderNumber']
+        fields = requested_fields(data['args'])
 
-        response = s.get_orders(client, orderNumber)
-
-        order_data = response.json()
+        order_data = await order_flight.do(
+            request_key('get_orders', orderNumber, variables={'fields': fields}),
+            lambda: asyncio.to_thread(order_loader.load, (orderNumber, fields))
+        )
         order = order_data['data']['orders']['edges'][0]['node']
-        order_number = order['name']
+        projection = compile_projection(fields)(order)
 
-        if orderNumber == order_number:
-            # Extract all relevant information
-            line_items = order['lineItems']['edges']
-            subtotal_quantity = order['currentSubtotalLineItemsQuantity']
-            subtotal_price = order['currentSubtotalPriceSet']['shopMoney']['amount']
-            currency = order['lineItems']['edges'][0]['node']['originalUnitPriceSet']['shopMoney']['currencyCode']
-            total_weight = order['currentTotalWeight']
-            payment_gateway = order['paymentGatewayNames'][0]
-            shipping_method = order['shippingLines']['edges'][0]['node']['title']
-            shipping_cost = order['shippingLines']['edges'][0]['node']['currentDiscountedPriceSet']['shopMoney']['amount']
-            financial_status = order['displayFinancialStatus']
-            fulfillment_status = order['fulfillments'][0]['displayStatus']
-            return_status = order['returnStatus']
-            cancellation = order['cancellation']
-            cancel_reason = order['cancelReason']
-            cancelled_at = order['cancelledAt']
-            created_at = order['createdAt']
-            closed_at = order['closedAt']
-            fulfillment = order['fulfillments'][0]
-            tracking_company = fulfillment['trackingInfo'][0]['company'] if fulfillment['trackingInfo'] else None
-            tracking_number = fulfillment['trackingInfo'][0]['number'] if fulfillment['trackingInfo'] else None
-
-            # Format the list of items
-            items_list = []
-            for item in line_items:
-                item_name = item['node']['name']
-                item_quantity = item['node']['currentQuantity']
-                item_price = item['node']['originalUnitPriceSet']['shopMoney']['amount']
-                items_list.append(f"{item_quantity} {item_name} for {currency}{item_price}")
-
-            # Join the items into a natural-sounding sentence
-            if len(items_list) == 1:
-                items_description = items_list[0]
-            elif len(items_list) == 2:
-                items_description = f"{items_list[0]} and {items_list[1]}"
-            else:
-                items_description = ", ".join(items_list[:-1]) + f", and {items_list[-1]}"
-
-            # Format the response using f-string with natural language
-            # responseMessage = (
-            #     f"Your order #{order_number} includes {items_description}. "
-            #     f"The subtotal for {subtotal_quantity} item(s) is {currency}{subtotal_price}, and the total weight is {total_weight} lbs. "
-            #     f"It was paid via {payment_gateway} and {fulfillment_status.lower()} via {shipping_method} for {currency}{shipping_cost}. "
-            #     f"The financial status is {financial_status.lower()}, and the return status is {return_status.lower().replace('_', ' ')}. "
-            #     f"The order was created on {created_at.split('T')[0]} and completed on {closed_at.split('T')[0]}. "
-            #     f"{'The order was not cancelled.' if cancellation is None else 'The order was cancelled.'} "
-            #     f"{'No cancellation reason was provided.' if cancel_reason is None else f'The cancellation reason was: {cancel_reason}.'} "
-            #     f'''{'No cancellation date was recorded.' if cancelled_at is None else f'The order was cancelled on {cancelled_at.split("T")[0]}.'} '''
-            #     f"The fulfillment status is {fulfillment_status.lower()}, and the tracking company is {tracking_company if tracking_company else 'not available'}, with tracking number {tracking_number if tracking_number else 'not available'} and tracking link {tracking_link if tracking_link else 'not available'}. "
-            #     f"{'The order was delivered on ' + fulfillment['deliveredAt'].split('T')[0] + '.' if fulfillment_status == 'DELIVERED' else 'The estimated delivery date is ' + fulfillment['estimatedDeliveryAt'].split('T')[0] + '.'}"
-            # )
-
-            # Add confirmation question
-            # responseMessage += "\n\nDoes this answer your question, or would you like additional information?"
-            result = {
-                "data": {
-                    "order_number": order_number,
-                    "items_description": items_description,
-                    "subtotal": {
-                        "quantity": subtotal_quantity,
-                        "subtotal_price": subtotal_price
-                    },
-                    "weight": {
-                        "total": total_weight,
-                        "unit": 'lbs'
-                    },
-                    "payment_gateway": payment_gateway,
-                    "fulfillment": {
-                        "status": fulfillment_status,
-                        "delivered_at": fulfillment['deliveredAt'],
-                        "estimated_delivery_at": fulfillment['estimatedDeliveryAt']
-                    },
-                    "shipping": {
-                        "method": shipping_method,
-                        "shipping_cost": shipping_cost
-                    },
-                    "financial_status": financial_status,
-                    "return_status": return_status,
-                    "cancellation": cancellation,
-                    "tracking": {
-                        "company": tracking_company,
-                        "number": tracking_number
-                    },
-                    "cancel_reason": cancel_reason,
-                    "cancelled_at": cancelled_at,
-                    "created_at": created_at,
-                    "closed_at": closed_at,
-                    "currency": currency
-                }
-
-            }
+        if orderNumber == projection['order_number']:
+            # A caller naming fields gets just those, flat; otherwise the full nested payload
+            result = projection if data['args'].get('fields') else to_payload(projection)
 
             return JSONResponse(status_code=200, content={"result": result})
         else:
             raise HTTPException(status_code=404, detail="Order not found")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to parse request body: {e}")
         raise HTTPException(status_code=400, detail="Invalid request body")
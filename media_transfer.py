@@ -0,0 +1,390 @@
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from time import sleep
+from typing import Callable
+from urllib.parse import unquote, urlparse
+import asyncio
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import httpx
+
+logging.basicConfig(level=logging.INFO)
+
+# 4xx responses that are worth another attempt
+RETRYABLE_STATUS = (408, 425, 429)
+
+
+@dataclass
+class MediaTransfer:
+    """Downloads media files and uploads them to staged targets over one shared connection pool."""
+    max_workers: int = 8
+    retries: int = 3
+    chunk_size: int = 1024 * 1024
+    timeout: float = 60
+    client: httpx.Client = None
+
+    def __post_init__(self):
+        if self.client is None:
+            self.client = httpx.Client(
+                timeout=httpx.Timeout(self.timeout, connect=10),
+                limits=httpx.Limits(max_connections=self.max_workers * 2, max_keepalive_connections=self.max_workers * 2),
+                follow_redirects=True
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.client.close()
+
+    # Support
+    def retry(self, func, *args, **kwargs):
+        for attempt in range(1, self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                if (status < 500 and status not in RETRYABLE_STATUS) or attempt == self.retries:
+                    raise
+                logging.warning(f"{func.__name__} got HTTP {status} on attempt {attempt}/{self.retries}")
+            except (httpx.TransportError, ValueError, OSError) as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"{func.__name__} failed on attempt {attempt}/{self.retries}: {e}")
+            sleep(2 ** attempt)
+
+    # Transfer
+    def download(self, url, save_path):
+        """Streams url to save_path through a .part file. Returns the size and md5 of the body."""
+        os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+        part_path = f'{save_path}.part'
+        md5 = hashlib.md5()
+        size = 0
+        with self.client.stream('GET', url) as response:
+            response.raise_for_status()
+            expected = response.headers.get('Content-Length')
+            with open(part_path, 'wb') as file:
+                for chunk in response.iter_bytes(self.chunk_size):
+                    file.write(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+            # Content-Length counts encoded bytes, so only compare it for identity-encoded bodies
+            if expected and not response.headers.get('Content-Encoding') and int(expected) != size:
+                raise ValueError(f"Truncated download of {url}: {size} of {expected} bytes")
+        os.replace(part_path, save_path)
+
+        return {'size': size, 'md5': md5.hexdigest()}
+
+    def upload(self, upload_url, form, file_path, md5=None):
+        """Posts a file from disk to a staged upload target, streamed as multipart form data."""
+        with open(file_path, 'rb') as file:
+            response = self.client.post(upload_url, data=form, files={'file': (os.path.basename(file_path), file)})
+        response.raise_for_status()
+
+        # Cloud Storage answers with the MD5 of the stored object as ETag for plain uploads
+        etag = response.headers.get('ETag', '').strip('"')
+        if md5 and len(etag) == 32 and etag != md5:
+            raise ValueError(f"Checksum mismatch after uploading {file_path}: {etag} != {md5}")
+
+        return response
+
+    def resolve_target(self, item):
+        """Fills upload_url/form/resource_url from item['target'], a staged target or a Future of one."""
+        target = item.get('target')
+        if target is None:
+            return item
+        if isinstance(target, Future):
+            target = target.result()
+
+        return dict(
+            item,
+            target=None,
+            upload_url=target['url'],
+            resource_url=target['resourceUrl'],
+            form={parameter['name']: parameter['value'] for parameter in target['parameters']}
+        )
+
+    def transfer(self, item):
+        """
+        Downloads item['url'] to item['save_path'] and uploads it to item['upload_url'] with item['form'].
+        When the item carries a pending 'target' instead, it is awaited only once the download is done.
+        """
+        result = {'url': item['url'], 'save_path': item['save_path'], 'resource_url': item.get('resource_url'), 'status': 'failed', 'error': None}
+        try:
+            downloaded = self.retry(self.download, item['url'], item['save_path'])
+            result.update(downloaded)
+            item = self.resolve_target(item)
+            result['resource_url'] = item.get('resource_url')
+            self.retry(self.upload, item['upload_url'], item['form'], item['save_path'], md5=downloaded['md5'])
+            result['status'] = 'uploaded'
+        except Exception as e:
+            logging.error(f"Failed to transfer {item['url']}: {e}")
+            result['error'] = str(e)
+
+        return result
+
+    def pipe(self, url, upload_url, form, filename):
+        """
+        Streams url straight into a staged upload POST without touching the disk.
+
+        The multipart body is generated around the source stream, so at most one chunk is
+        held in memory. Cloud Storage needs the body length up front; returns None when the
+        source does not announce a usable Content-Length, so the caller can stage it instead.
+        """
+        boundary = os.urandom(16).hex()
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+            for name, value in form.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        md5 = hashlib.md5()
+        sent = {'size': 0}
+        with self.client.stream('GET', url) as source:
+            source.raise_for_status()
+            length = source.headers.get('Content-Length')
+            if not length or source.headers.get('Content-Encoding'):
+                return None
+
+            def body():
+                yield head
+                for chunk in source.iter_bytes(self.chunk_size):
+                    md5.update(chunk)
+                    sent['size'] += len(chunk)
+                    yield chunk
+                if sent['size'] != int(length):
+                    raise ValueError(f"Truncated download of {url}: {sent['size']} of {length} bytes")
+                yield tail
+
+            headers = {
+                'Content-Type': f'multipart/form-data; boundary={boundary}',
+                'Content-Length': str(len(head) + int(length) + len(tail)),
+            }
+            response = self.client.post(upload_url, content=body(), headers=headers)
+            response.raise_for_status()
+
+        etag = response.headers.get('ETag', '').strip('"')
+        if len(etag) == 32 and etag != md5.hexdigest():
+            raise ValueError(f"Checksum mismatch after piping {url}: {etag} != {md5.hexdigest()}")
+
+        return {'size': sent['size'], 'md5': md5.hexdigest()}
+
+    def pipe_transfer(self, item):
+        """Same contract as transfer, but streams source to target; stages on disk only when it has to."""
+        result = {'url': item['url'], 'save_path': None, 'resource_url': item.get('resource_url'), 'status': 'failed', 'error': None}
+        try:
+            item = self.resolve_target(item)
+            result['resource_url'] = item.get('resource_url')
+            piped = self.retry(self.pipe, item['url'], item['upload_url'], item['form'], os.path.basename(item['save_path']))
+            if piped is None:
+                logging.info(f"No Content-Length for {item['url']}, staging it on disk")
+                return self.transfer(item)
+            result.update(piped)
+            result['status'] = 'uploaded'
+        except Exception as e:
+            logging.error(f"Failed to pipe {item['url']}: {e}")
+            result['error'] = str(e)
+
+        return result
+
+    def transfer_all(self, items, transfer=None):
+        """Runs transfers on a bounded thread pool. Results come back in the order of items."""
+        transfer = transfer or self.transfer
+        results = [None] * len(items)
+        print(f'Transferring {len(items)} file(s) with {self.max_workers} workers...')
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(transfer, item): i for i, item in enumerate(items)}
+            for done, future in enumerate(as_completed(futures), 1):
+                results[futures[future]] = future.result()
+                if done % 50 == 0 or done == len(items):
+                    print(f'{done}/{len(items)} transfers finished')
+
+        failed = sum(1 for result in results if result['status'] != 'uploaded')
+        if failed:
+            print(f'{failed} transfer(s) failed')
+
+        return results
+
+
+@dataclass
+class StagedTargetAllocator:
+    """
+    Requests staged upload targets in the background, in batches as large as the API accepts.
+
+    generate takes a list of StagedUploadInput dicts and returns the stagedUploadsCreate
+    response JSON. A rejected batch is halved and retried, and the next batch waits for the
+    throttle bucket to refill when the last response says it is running low.
+    """
+    generate: Callable
+    batch_size: int = 250
+    min_batch_size: int = 10
+
+    def __post_init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=False)
+
+    def allocate(self, inputs):
+        """Returns one Future per input, resolved with the staged target issued for that file."""
+        futures = [Future() for _ in inputs]
+        self.executor.submit(self._allocate, list(inputs), futures)
+
+        return futures
+
+    def _allocate(self, inputs, futures):
+        start = 0
+        size = self.batch_size
+        while start < len(inputs):
+            batch = inputs[start:start + size]
+            try:
+                response = self.generate(batch)
+                result = (response.get('data') or {}).get('stagedUploadsCreate') or {}
+                targets = result.get('stagedTargets') or []
+                if response.get('errors') or result.get('userErrors') or len(targets) != len(batch):
+                    if size > self.min_batch_size:
+                        size = max(size // 2, self.min_batch_size)
+                        logging.warning(f"Staged upload batch rejected, retrying with {size} inputs")
+                        self.wait_for_throttle(response)
+                        continue
+                    raise RuntimeError(f"stagedUploadsCreate failed: {response.get('errors') or result.get('userErrors')}")
+
+                for future, target in zip(futures[start:start + len(batch)], self.pair(batch, targets)):
+                    future.set_result(target)
+                start += len(batch)
+                self.wait_for_throttle(response)
+            except Exception as e:
+                for future in futures[start:]:
+                    future.set_exception(e)
+                return
+
+    def pair(self, batch, targets):
+        """
+        Matches targets to inputs by the filename in their resourceUrl; inputs without a match get
+        the unclaimed targets in response order. Each target goes to one input only.
+        """
+        by_filename = {}
+        for target in targets:
+            filename = os.path.basename(unquote(urlparse(target['resourceUrl']).path))
+            by_filename.setdefault(filename, []).append(target)
+
+        paired = [None] * len(batch)
+        claimed = set()
+        for i, staged_input in enumerate(batch):
+            matches = by_filename.get(staged_input['filename'])
+            if matches:
+                paired[i] = matches.pop(0)
+                claimed.add(id(paired[i]))
+        unclaimed = iter([target for target in targets if id(target) not in claimed])
+        for i, staged_input in enumerate(batch):
+            if paired[i] is None:
+                paired[i] = next(unclaimed, None)
+                if paired[i] is None:
+                    raise RuntimeError(f"No staged target left for {staged_input['filename']}")
+
+        return paired
+
+    def wait_for_throttle(self, response):
+        # Imported here: shopifyapi imports this module
+        from shopifyapi import throttle_wait
+
+        sleep(throttle_wait(response))
+
+
+@dataclass
+class SizeProber:
+    """
+    Looks up remote file sizes concurrently: HEAD first, a one-byte range GET when HEAD is
+    refused or has no Content-Length. Sizes are cached per URL with their ETag and revalidated
+    with If-None-Match, so unchanged files cost a 304 (or nothing with revalidate=False).
+    """
+    max_concurrency: int = 64
+    per_host: int = 8
+    timeout: float = 15
+    cache_path: str = 'data/file_sizes.json'
+    revalidate: bool = True
+    cache: dict = field(default_factory=dict)
+
+    def load_cache(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path, 'r', encoding='utf-8') as file:
+                self.cache = json.load(file)
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = f'{self.cache_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.cache, file)
+        os.replace(tmp_path, self.cache_path)
+
+    def probe_all(self, urls):
+        """Returns {url: size} with sizes as strings ("0" when unknown), like get_remote_file_size."""
+        urls = list(dict.fromkeys(url for url in urls if isinstance(url, str) and url))
+        print(f'Probing size of {len(urls)} file(s)...')
+        self.load_cache()
+        sizes = asyncio.run(self._probe_all(urls))
+        self.save_cache()
+
+        return sizes
+
+    async def _probe_all(self, urls):
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        overall = asyncio.Semaphore(self.max_concurrency)
+        hosts = {}
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits, follow_redirects=True) as client:
+            async def bounded(url):
+                host = hosts.setdefault(urlparse(url).netloc, asyncio.Semaphore(self.per_host))
+                # The host slot first, so a saturated host never holds global slots while it waits
+                async with host, overall:
+                    return url, await self._probe(client, url)
+
+            results = await asyncio.gather(*(bounded(url) for url in urls))
+
+        return dict(results)
+
+    async def _probe(self, client, url):
+        cached = self.cache.get(url)
+        if cached and not self.revalidate:
+            return cached['size']
+        headers = {'If-None-Match': cached['etag']} if cached and cached.get('etag') else {}
+
+        try:
+            response = await client.head(url, headers=headers)
+            if response.status_code == 304 and cached:
+                return cached['size']
+            size = response.headers.get('Content-Length') if response.status_code == 200 else None
+
+            if not size:
+                async with client.stream('GET', url, headers={'Range': 'bytes=0-0'}) as response:
+                    if response.status_code == 206:
+                        match = re.search(r'/(\d+)$', response.headers.get('Content-Range', ''))
+                        size = match.group(1) if match else None
+                    elif response.status_code == 200:
+                        size = response.headers.get('Content-Length')
+
+            if not size:
+                print(f"Failed to fetch file size for {url}. Status code: {response.status_code}")
+                return "0"
+
+            self.cache[url] = {'etag': response.headers.get('ETag'), 'size': str(size)}
+            return str(size)
+        except Exception as e:
+            print(f"Error fetching file size for {url}: {e}")
+            return "0"
@@ -0,0 +1,276 @@
+from dataclasses import dataclass, field
+from time import time
+import os
+import re
+import sqlite3
+import threading
+import logging
+import webhooks
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ORDER_MIRROR_PATH = 'data/order_mirror.db'
+
+# orders_fts mirrors the searchable columns of orders through the triggers below
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS orders (
+        id TEXT PRIMARY KEY,
+        shop TEXT,
+        name TEXT,
+        created_at TEXT,
+        customer_name TEXT,
+        email TEXT,
+        phone TEXT,
+        zip TEXT,
+        total_price TEXT,
+        financial_status TEXT,
+        fulfillment_status TEXT,
+        shipping_address TEXT,
+        updated_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS orders_shop_created_at ON orders (shop, created_at);
+    CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+        name, customer_name, email, phone, zip,
+        content='orders', content_rowid='rowid'
+    );
+    CREATE TRIGGER IF NOT EXISTS orders_ai AFTER INSERT ON orders BEGIN
+        INSERT INTO orders_fts (rowid, name, customer_name, email, phone, zip)
+        VALUES (new.rowid, new.name, new.customer_name, new.email, new.phone, new.zip);
+    END;
+    CREATE TRIGGER IF NOT EXISTS orders_ad AFTER DELETE ON orders BEGIN
+        INSERT INTO orders_fts (orders_fts, rowid, name, customer_name, email, phone, zip)
+        VALUES ('delete', old.rowid, old.name, old.customer_name, old.email, old.phone, old.zip);
+    END;
+    CREATE TRIGGER IF NOT EXISTS orders_au AFTER UPDATE ON orders BEGIN
+        INSERT INTO orders_fts (orders_fts, rowid, name, customer_name, email, phone, zip)
+        VALUES ('delete', old.rowid, old.name, old.customer_name, old.email, old.phone, old.zip);
+        INSERT INTO orders_fts (rowid, name, customer_name, email, phone, zip)
+        VALUES (new.rowid, new.name, new.customer_name, new.email, new.phone, new.zip);
+    END;
+'''
+
+COLUMNS = ('id', 'shop', 'name', 'created_at', 'customer_name', 'email', 'phone', 'zip',
+           'total_price', 'financial_status', 'fulfillment_status', 'shipping_address')
+# Headers from bulk exports and webhooks are complete, so an upsert overwrites every column and a
+# removed email, phone or address is cleared; only these keep the stored value when missing
+# (a webhook delivered without X-Shopify-Shop-Domain has no shop)
+KEPT_WHEN_MISSING = ('shop',)
+
+
+# Trailing digits of a phone number indexed on their own, so a search for the last 4, the
+# local 7 or the 10 digits without country code matches as a prefix
+PHONE_SUFFIXES = (4, 7, 10)
+# Bump when phone_terms changes, so existing mirrors re-derive their phone terms
+PHONE_TERMS_VERSION = 1
+
+
+def phone_terms(*phones):
+    """Phone numbers as searchable digit strings: the full number and its PHONE_SUFFIXES."""
+    terms = []
+    for phone in phones:
+        digits = re.sub(r'\D', '', phone or '')
+        if digits:
+            terms.extend([digits, *(digits[-length:] for length in PHONE_SUFFIXES if len(digits) > length)])
+
+    return ' '.join(dict.fromkeys(terms))
+
+
+def format_address(address):
+    if not address:
+        return None
+    return f"{address.get('address1')}, {address.get('city')}, {address.get('country')}, {address.get('zip')}"
+
+
+def header_from_graphql(node, shop):
+    """Mirror row for an order node from ShopifyApp.bulk_get_order_headers."""
+    customer = node.get('customer') or {}
+    address = node.get('shippingAddress') or {}
+
+    return {
+        'id': node['id'],
+        'shop': shop,
+        'name': node.get('name'),
+        'created_at': node.get('createdAt'),
+        'customer_name': f"{customer.get('firstName') or ''} {customer.get('lastName') or ''}".strip() or None,
+        'email': node.get('email') or customer.get('email'),
+        'phone': phone_terms(node.get('phone'), customer.get('phone'), address.get('phone')),
+        'zip': address.get('zip'),
+        'total_price': (node.get('totalPriceSet') or {}).get('shopMoney', {}).get('amount'),
+        'financial_status': node.get('displayFinancialStatus'),
+        'fulfillment_status': node.get('displayFulfillmentStatus'),
+        'shipping_address': format_address(address),
+    }
+
+
+def header_from_webhook(payload, shop):
+    """Mirror row for an orders/create or orders/updated REST payload."""
+    customer = payload.get('customer') or {}
+    address = payload.get('shipping_address') or {}
+
+    return {
+        'id': payload.get('admin_graphql_api_id') or f"gid://shopify/Order/{payload.get('id')}",
+        'shop': shop,
+        'name': payload.get('name'),
+        'created_at': payload.get('created_at'),
+        'customer_name': f"{customer.get('first_name') or ''} {customer.get('last_name') or ''}".strip() or None,
+        'email': payload.get('email') or customer.get('email'),
+        'phone': phone_terms(payload.get('phone'), customer.get('phone'), address.get('phone')),
+        'zip': address.get('zip'),
+        'total_price': payload.get('total_price'),
+        'financial_status': (payload.get('financial_status') or '').upper() or None,
+        'fulfillment_status': (payload.get('fulfillment_status') or 'unfulfilled').upper(),
+        'shipping_address': format_address(address),
+    }
+
+
+# A North American style number however it is grouped: +1 (555) 123-4567, 555 123 4567, 555.123.4567
+PHONE_NUMBER = re.compile(r'(?:\+?\d{1,3}[\s.\-]*)?(?:\(\d{3}\)|\d{3})[\s.\-]*\d{3}[\s.\-]*\d{4}\b')
+
+
+def collapse_phone_numbers(text):
+    """Joins the digit groups of phone numbers in text, including a bare local number like 123-4567, into one."""
+    text = PHONE_NUMBER.sub(lambda match: re.sub(r'\D', '', match.group()), text or '')
+
+    return re.sub(r'(?<!\d)(\d{3})[.\-](\d{4})\b', r'\1\2', text)
+
+
+def fts_query(text):
+    """Turns free text into an FTS5 query: every word must match as a prefix of some field."""
+    words = re.findall(r'\w+', collapse_phone_numbers(text))
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+@dataclass
+class OrderMirror:
+    """
+    Local SQLite copy of order headers (name, customer, email, phone, zip, totals, statuses)
+    with an FTS5 index, so /search_order answers from disk and only opening an order goes to Shopify.
+    """
+    path: str = ORDER_MIRROR_PATH
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    connection: sqlite3.Connection = field(default=None, repr=False)
+
+    def __post_init__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.migrate_phone_terms()
+
+    def migrate_phone_terms(self):
+        """Re-derives the phone terms of rows mirrored by an older phone_terms (the full number is always among them)."""
+        with self.lock, self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] >= PHONE_TERMS_VERSION:
+                return
+            rows = self.connection.execute('SELECT id, phone FROM orders WHERE phone IS NOT NULL').fetchall()
+            self.connection.executemany(
+                'UPDATE orders SET phone = ? WHERE id = ?',
+                [(phone_terms(*row['phone'].split()), row['id']) for row in rows]
+            )
+            self.connection.execute(f'PRAGMA user_version = {PHONE_TERMS_VERSION}')
+
+    def upsert(self, headers):
+        """Inserts or replaces complete order headers."""
+        assignments = [
+            f'{column} = COALESCE(excluded.{column}, orders.{column})' if column in KEPT_WHEN_MISSING else f'{column} = excluded.{column}'
+            for column in COLUMNS[1:]
+        ]
+        rows = [tuple(header.get(column) for column in COLUMNS) + (time(),) for header in headers]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f'''
+                INSERT INTO orders ({', '.join(COLUMNS)}, updated_at) VALUES ({', '.join('?' * (len(COLUMNS) + 1))})
+                ON CONFLICT(id) DO UPDATE SET
+                    {', '.join(assignments)},
+                    updated_at = excluded.updated_at
+                ''',
+                rows
+            )
+
+        return len(rows)
+
+    def delete(self, order_id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM orders WHERE id = ?', (order_id,))
+
+    def get(self, order_id):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
+
+        return dict(row) if row else None
+
+    def count(self, shop):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM orders WHERE shop = ?', (shop,)).fetchone()[0]
+
+    def search(self, shop, text, limit=50):
+        """Orders of a shop matching every word of text in name, customer, email, phone or zip, newest first."""
+        match = fts_query(text)
+        if not match:
+            return []
+        with self.lock:
+            rows = self.connection.execute(
+                '''
+                SELECT orders.* FROM orders_fts
+                JOIN orders ON orders.rowid = orders_fts.rowid
+                WHERE orders_fts MATCH ? AND orders.shop = ?
+                ORDER BY orders.created_at DESC
+                LIMIT ?
+                ''',
+                (match, shop, limit)
+            ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def seed(self, app, client, shop, created_after=None):
+        """Loads every order header of a shop (or those created after a date) with one bulk query."""
+        print(f'Seeding order mirror for {shop}...')
+        count = 0
+        batch = []
+        for node in app.bulk_get_order_headers(client, created_after=created_after):
+            batch.append(header_from_graphql(node, shop))
+            if len(batch) >= 1000:
+                count += self.upsert(batch)
+                batch = []
+        count += self.upsert(batch)
+        print(f'{count} order(s) mirrored')
+
+        return count
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_mirror(path=ORDER_MIRROR_PATH):
+    """Process-wide OrderMirror, opened on first use."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = OrderMirror(path=path)
+
+    return _shared
+
+
+@webhooks.handler('orders/create')
+@webhooks.handler('orders/updated')
+def update_from_webhook(payload, shop=None):
+    shared_mirror().upsert([header_from_webhook(payload, shop)])
+
+
+@webhooks.handler('orders/delete')
+def delete_from_webhook(payload, shop=None):
+    shared_mirror().delete(payload.get('admin_graphql_api_id') or f"gid://shopify/Order/{payload.get('id')}")
+
+
+if __name__ == '__main__':
+    from shopifyapi import ShopifyApp
+    from token_store import TokenStore
+
+    # Seeds every shop that installed the app
+    for shop, access_token in TokenStore().tokens.items():
+        s = ShopifyApp(store_name=shop.split('.')[0], access_token=access_token, api_version='2025-01')
+        client = s.create_session()
+        shared_mirror().seed(s, client, shop)
@@ -0,0 +1,216 @@
+"""
+Declarative projection of a Shopify order node into the voice answers.
+
+FIELDS maps every output field to its path in the GraphQL order node. compile_projection()
+turns a list of field names into one extractor, and order_selection() builds the matching
+(minimal) GraphQL selection set, so a caller asking for fewer fields also fetches less.
+"""
+from functools import lru_cache
+
+# Output field -> path in the order node (ints index into lists/connections)
+FIELDS = {
+    'order_number': ('name',),
+    'items': ('lineItems', 'edges'),
+    'currency': ('lineItems', 'edges', 0, 'node', 'originalUnitPriceSet', 'shopMoney', 'currencyCode'),
+    'subtotal_quantity': ('currentSubtotalLineItemsQuantity',),
+    'subtotal_price': ('currentSubtotalPriceSet', 'shopMoney', 'amount'),
+    'total_weight': ('currentTotalWeight',),
+    'payment_gateway': ('paymentGatewayNames', 0),
+    'shipping_method': ('shippingLines', 'edges', 0, 'node', 'title'),
+    'shipping_cost': ('shippingLines', 'edges', 0, 'node', 'currentDiscountedPriceSet', 'shopMoney', 'amount'),
+    'financial_status': ('displayFinancialStatus',),
+    'fulfillment_status': ('fulfillments', 0, 'displayStatus'),
+    'delivered_at': ('fulfillments', 0, 'deliveredAt'),
+    'estimated_delivery_at': ('fulfillments', 0, 'estimatedDeliveryAt'),
+    'tracking_company': ('fulfillments', 0, 'trackingInfo', 0, 'company'),
+    'tracking_number': ('fulfillments', 0, 'trackingInfo', 0, 'number'),
+    'tracking_url': ('fulfillments', 0, 'trackingInfo', 0, 'url'),
+    'return_status': ('returnStatus',),
+    'cancelled': ('cancellation',),
+    'cancel_reason': ('cancelReason',),
+    'cancelled_at': ('cancelledAt',),
+    'created_at': ('createdAt',),
+    'closed_at': ('closedAt',),
+}
+
+# Sub-selections of fields whose value is an object or list rather than a scalar
+SUBSELECTIONS = {
+    ('lineItems', 'edges'): {'node': {'name': {}, 'currentQuantity': {}, 'originalUnitPriceSet': {'shopMoney': {'amount': {}, 'currencyCode': {}}}}},
+    ('cancellation',): {'staffNote': {}},
+}
+
+# Line items fetched per order; Shopify's maximum page size
+LINE_ITEMS = 250
+
+# Arguments of list/connection fields
+ARGUMENTS = {
+    'lineItems': f'(first: {LINE_ITEMS})',
+    'shippingLines': '(first: 5)',
+    'fulfillments': '(first: 5)',
+    'trackingInfo': '(first: 5)',
+}
+
+# Everything the spoken answer and the structured payload use
+VOICE_FIELDS = tuple(FIELDS)
+
+# Distinct field sets whose extractor and selection set are kept compiled
+COMPILED_FIELD_SETS = 64
+
+
+def _getter(path):
+    def get(node):
+        try:
+            for key in path:
+                node = node[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return node
+
+    return get
+
+
+def project_items(edges):
+    return [
+        {
+            'name': edge['node']['name'],
+            'quantity': edge['node']['currentQuantity'],
+            'price': edge['node']['originalUnitPriceSet']['shopMoney']['amount'],
+        }
+        for edge in edges or []
+    ]
+
+
+@lru_cache(maxsize=COMPILED_FIELD_SETS)
+def compile_projection(fields=VOICE_FIELDS):
+    """Returns a function mapping an order node to {field: value} for the given fields."""
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown order fields: {sorted(unknown)}")
+    getters = [(name, _getter(FIELDS[name])) for name in fields]
+
+    def project(node):
+        projection = {name: get(node) for name, get in getters}
+        if 'items' in projection:
+            projection['items'] = project_items(projection['items'])
+        return projection
+
+    return project
+
+
+def _render(tree, indent, arguments):
+    lines = []
+    for name, children in tree.items():
+        if children:
+            lines.append(f"{indent}{name}{arguments.get(name, '')} {{")
+            lines.extend(_render(children, indent + '    ', arguments))
+            lines.append(f"{indent}}}")
+        else:
+            lines.append(f"{indent}{name}")
+    return lines
+
+
+def _merge(tree, subtree):
+    for name, children in subtree.items():
+        _merge(tree.setdefault(name, {}), children)
+
+
+@lru_cache(maxsize=COMPILED_FIELD_SETS)
+def order_selection(fields=VOICE_FIELDS, line_items=LINE_ITEMS):
+    """
+    GraphQL selection set (the inside of an order node) covering just the given fields.
+    line_items caps the lineItems page, which dominates the query cost.
+    """
+    tree = {}
+    for name in fields:
+        path = FIELDS[name]
+        keys = tuple(key for key in path if not isinstance(key, int))
+        node = tree
+        for key in keys:
+            node = node.setdefault(key, {})
+        _merge(node, SUBSELECTIONS.get(keys, {}))
+
+    return '\n'.join(_render(tree, '    ', {**ARGUMENTS, 'lineItems': f'(first: {line_items})'})) + '\n'
+
+
+def _date(value):
+    return value.split('T')[0] if value else None
+
+
+def items_description(items, currency):
+    items_list = [f"{item['quantity']} {item['name']} for {currency}{item['price']}" for item in items]
+    if not items_list:
+        return "no items"
+    if len(items_list) == 1:
+        return items_list[0]
+    if len(items_list) == 2:
+        return f"{items_list[0]} and {items_list[1]}"
+
+    return ", ".join(items_list[:-1]) + f", and {items_list[-1]}"
+
+
+def to_sentence(p):
+    """Natural-language answer spoken by the voice agent (flask /getorder)."""
+    currency = p['currency'] or ''
+    fulfillment_status = (p['fulfillment_status'] or 'unfulfilled').lower()
+    cancel_reason = 'No cancellation reason was provided.' if p['cancel_reason'] is None else f"The cancellation reason was: {p['cancel_reason']}."
+    cancelled_at = 'No cancellation date was recorded.' if p['cancelled_at'] is None else f"The order was cancelled on {_date(p['cancelled_at'])}."
+    completed = f"completed on {_date(p['closed_at'])}" if p['closed_at'] else "is not completed yet"
+    if p['fulfillment_status'] == 'DELIVERED':
+        delivery = f"The order was delivered on {_date(p['delivered_at'])}."
+    elif p['estimated_delivery_at']:
+        delivery = f"The estimated delivery date is {_date(p['estimated_delivery_at'])}."
+    else:
+        delivery = "No estimated delivery date is available yet."
+
+    return (
+        f"Your order #{p['order_number']} includes {items_description(p['items'], currency)}. "
+        f"The subtotal for {p['subtotal_quantity']} item(s) is {currency}{p['subtotal_price']}, and the total weight is {p['total_weight']} lbs. "
+        f"It was paid via {p['payment_gateway']} and {fulfillment_status} via {p['shipping_method']} for {currency}{p['shipping_cost']}. "
+        f"The financial status is {(p['financial_status'] or 'unknown').lower()}, and the return status is {(p['return_status'] or 'no return').lower().replace('_', ' ')}. "
+        f"The order was created on {_date(p['created_at'])} and {completed}. "
+        f"{'The order was not cancelled.' if p['cancelled'] is None else 'The order was cancelled.'} "
+        f"{cancel_reason} "
+        f"{cancelled_at} "
+        f"The fulfillment status is {fulfillment_status}, and the tracking company is {p['tracking_company'] or 'not available'}, with tracking number {p['tracking_number'] or 'not available'}."
+        f"{delivery}"
+    )
+
+
+def to_payload(p):
+    """Structured answer (FastAPI /getorder) in the nested shape the agent's tools expect."""
+    return {
+        "data": {
+            "order_number": p['order_number'],
+            "items_description": items_description(p['items'], p['currency'] or ''),
+            "subtotal": {
+                "quantity": p['subtotal_quantity'],
+                "subtotal_price": p['subtotal_price']
+            },
+            "weight": {
+                "total": p['total_weight'],
+                "unit": 'lbs'
+            },
+            "payment_gateway": p['payment_gateway'],
+            "fulfillment": {
+                "status": p['fulfillment_status'],
+                "delivered_at": p['delivered_at'],
+                "estimated_delivery_at": p['estimated_delivery_at']
+            },
+            "shipping": {
+                "method": p['shipping_method'],
+                "shipping_cost": p['shipping_cost']
+            },
+            "financial_status": p['financial_status'],
+            "return_status": p['return_status'],
+            "cancellation": p['cancelled'],
+            "tracking": {
+                "company": p['tracking_company'],
+                "number": p['tracking_number']
+            },
+            "cancel_reason": p['cancel_reason'],
+            "cancelled_at": p['cancelled_at'],
+            "created_at": p['created_at'],
+            "closed_at": p['closed_at'],
+            "currency": p['currency']
+        }
+    }
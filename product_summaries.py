@@ -0,0 +1,191 @@
+import os
+import re
+import logging
+from shopifyapi import gid_type
+from sku_index import shared_index
+import webhooks
+
+logger = logging.getLogger(__name__)
+
+# Variants per page of a voice summary; keeps TTS responses short for products with hundreds of variants
+PAGE_SIZE = int(os.getenv('SUMMARY_PAGE_SIZE', 10))
+
+
+def normalize_graphql_product(node):
+    """Flattens a product node (from get_product_details_by_query or bulk_get_product_details) for summarizing."""
+    if 'variants' in node:
+        variants = [edge.get('node', {}) for edge in node['variants'].get('edges', [])]
+    else:
+        variants = [child for child in node.get('__children', []) if gid_type(child.get('id')) == 'ProductVariant']
+
+    return {
+        'id': node.get('id'),
+        'handle': node.get('handle'),
+        'title': node.get('title', 'N/A'),
+        'vendor': node.get('vendor', 'N/A'),
+        'description': node.get('description') or 'N/A',
+        'total_inventory': node.get('totalInventory', 0),
+        'variants_count': node.get('variantsCount', {}).get('count', len(variants)),
+        'variants_precision': node.get('variantsCount', {}).get('precision', 'N/A'),
+        'variants': [
+            {
+                'display_name': v.get('displayName', 'N/A'),
+                'sku': v.get('sku', 'N/A'),
+                'price': v.get('price'),
+                'compare_at_price': v.get('compareAtPrice'),
+                'available': v.get('availableForSale', False),
+                'inventory': v.get('inventoryQuantity', 0),
+                'color': ((v.get('selectedOptions') or [{}])[0].get('optionValue') or {}).get('name'),
+                'weight': v.get('inventoryItem', {}).get('measurement', {}).get('weight', {}).get('value', 'N/A'),
+                'weight_unit': v.get('inventoryItem', {}).get('measurement', {}).get('weight', {}).get('unit', ''),
+                'requires_shipping': v.get('inventoryItem', {}).get('requiresShipping', False),
+            }
+            for v in variants
+        ],
+    }
+
+
+def normalize_webhook_product(payload):
+    """Flattens a products/create or products/update REST payload for summarizing."""
+    variants = payload.get('variants') or []
+
+    return {
+        'id': payload.get('admin_graphql_api_id'),
+        'handle': payload.get('handle'),
+        'title': payload.get('title') or 'N/A',
+        'vendor': payload.get('vendor') or 'N/A',
+        'description': re.sub(r'<[^>]+>', ' ', payload.get('body_html') or '').strip() or 'N/A',
+        'total_inventory': sum(v.get('inventory_quantity') or 0 for v in variants),
+        'variants_count': len(variants),
+        'variants_precision': 'EXACT',
+        'variants': [
+            {
+                'display_name': f"{payload.get('title')} - {v.get('title')}",
+                'sku': v.get('sku') or 'N/A',
+                'price': v.get('price'),
+                'compare_at_price': v.get('compare_at_price'),
+                'available': (v.get('inventory_quantity') or 0) > 0 or v.get('inventory_policy') == 'continue',
+                'inventory': v.get('inventory_quantity') or 0,
+                'color': v.get('option1'),
+                'weight': v.get('weight', 'N/A'),
+                'weight_unit': v.get('weight_unit', ''),
+                'requires_shipping': v.get('requires_shipping', True),
+            }
+            for v in variants
+        ],
+    }
+
+
+def render_header(product):
+    variants = product['variants']
+    colors = list(set(v['color'] for v in variants if v['color']))
+    available_colors = [v['color'] for v in variants if v['available'] and v['color']]
+    prices = [float(v['price']) for v in variants if v['price']]
+    price_range = f"${min(prices):.2f}-${max(prices):.2f}" if prices else "Price not available"
+    compare_at_price = (
+        f"${float(variants[0]['compare_at_price']):.2f}"
+        if variants and variants[0]['compare_at_price']
+        else "Not available"
+    )
+
+    return (
+        f"Product: {product['title']}\n"
+        f"Vendor: {product['vendor']}\n"
+        f"Description: {product['description'][:200]}...\n"
+        f"Total Inventory: {product['total_inventory']}\n"
+        f"Variants Count: {product['variants_count']} ({product['variants_precision']})\n"
+        f"Available Colors: {', '.join(available_colors) if available_colors else 'N/A'} "
+        f"({len(available_colors)} of {len(colors)})\n"
+        f"Price Range: {price_range} (Compare at: {compare_at_price})\n"
+    )
+
+
+def render_variant(i, v):
+    return (
+        f"  {i}. {v['display_name']}\n"
+        f"     SKU: {v['sku']}\n"
+        f"     Price: ${float(v['price'] or 0):.2f}\n"
+        f"     Available: {'Yes' if v['available'] else 'No'}\n"
+        f"     Inventory: {v['inventory']}\n"
+        f"     Weight: {v['weight']} {v['weight_unit']}\n"
+        f"     Requires Shipping: {'Yes' if v['requires_shipping'] else 'No'}\n\n"
+    )
+
+
+def render(product):
+    """Returns (header, [variant blocks]) for a normalized product."""
+    return render_header(product), [render_variant(i, v) for i, v in enumerate(product['variants'], 1)]
+
+
+def page_summary(header, variants, page=1, page_size=PAGE_SIZE):
+    """Joins the header with one page of variant blocks. Returns (text, page, pages)."""
+    pages = max(1, -(-len(variants) // page_size))
+    page = min(max(1, int(page)), pages)
+    if not variants:
+        return header + "No variants available\n", 1, 1
+
+    start = (page - 1) * page_size
+    text = header + "Variant Details:\n" + ''.join(variants[start:start + page_size])
+    if pages > 1:
+        text += f"Showing variants {start + 1}-{min(start + page_size, len(variants))} of {len(variants)}. Page {page} of {pages}.\n"
+
+    return text, page, pages
+
+
+def summarize_product(product_data: dict) -> str:
+    """Summarizes a get_product_details_by_query response with proper error handling for missing fields."""
+    try:
+        node = product_data.get('data', {}).get('products', {}).get('edges', [{}])[0].get('node', {})
+        if not node:
+            return "Error: No product data found"
+        header, variants = render(normalize_graphql_product(node))
+
+        return page_summary(header, variants, page_size=max(len(variants), 1))[0]
+
+    except Exception as e:
+        return f"Error generating product summary: {str(e)}"
+
+
+def store_summary(product, index=None):
+    index = index or shared_index()
+    header, variants = render(product)
+    index.put_summary(product['id'], product['handle'], product['title'], header, variants)
+
+    return header, variants
+
+
+def refresh_summaries(app, client, index=None):
+    """Regenerates the stored summary of every product from one bulk export."""
+    print('Generating product summaries...')
+    index = index or shared_index()
+    count = 0
+    for node in app.bulk_get_product_details(client):
+        try:
+            store_summary(normalize_graphql_product(node), index)
+            count += 1
+        except Exception as e:
+            logger.error(f"Failed to summarize {node.get('handle')}: {e}")
+    print(f'{count} product summaries stored')
+
+    return count
+
+
+def refresh_catalog(app, client, index=None):
+    """Refreshes the SKU index and, with it, the precomputed product summaries."""
+    index = index or shared_index()
+    index.refresh(app, client)
+    refresh_summaries(app, client, index)
+
+
+@webhooks.handler('products/create')
+@webhooks.handler('products/update')
+def update_summary_from_webhook(payload):
+    store_summary(normalize_webhook_product(payload))
+
+
+if __name__ == '__main__':
+    from shopifyapi import ShopifyApp
+
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version='2025-01')
+    client = s.create_session()
+    refresh_catalog(s, client)
@@ -0,0 +1,367 @@
+"""
+Registry of the GraphQL queries behind the order and product lookups.
+
+Each query is composed once, at import, from the selection fragments its endpoint actually
+renders, minified and kept as a module constant, so calls send a prebuilt string. Queries
+composed at runtime (per field set or alias count) are kept for the MAX_RUNTIME_QUERIES most
+recently used. Every
+registered query carries a static cost estimate, and send_request records the cost Shopify
+reports for it (extensions.cost), so cost_report() shows what each endpoint pays.
+
+    python queries.py   # lists registered queries with their estimated cost
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import re
+import threading
+from order_projection import VOICE_FIELDS, order_selection
+
+
+@dataclass(frozen=True)
+class RegisteredQuery:
+    name: str
+    text: str
+    estimated_cost: int
+
+
+# Minified query text -> RegisteredQuery, so a response can be attributed to its query
+REGISTRY = {}
+observed_costs = {}
+_costs_lock = threading.Lock()
+
+# Cache key -> text of the queries composed at runtime, least recently used first
+MAX_RUNTIME_QUERIES = 128
+_runtime_queries = OrderedDict()
+_runtime_lock = threading.Lock()
+
+# Shopify rejects a single query whose requested cost is over this
+MAX_QUERY_COST = 1000
+
+TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|\.\.\.|\$?[A-Za-z_]\w*|-?\d+|[{}():,!=\[\]@]')
+# Selection wrappers that add no cost of their own
+WRAPPERS = {'edges', 'pageInfo'}
+
+
+def minify(text):
+    text = re.sub(r'\s+', ' ', text).strip()
+    return re.sub(r'\s*([{}():,!=\[\]])\s*', r'\1', text)
+
+
+def _argument_size(tokens, start, variables):
+    """Value of a first/last argument inside the parentheses starting at tokens[start], or None."""
+    depth, i, size = 0, start, None
+    while True:
+        token = tokens[i]
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+            if depth == 0:
+                return size, i + 1
+        elif depth == 1 and token in ('first', 'last') and tokens[i + 1] == ':':
+            value = tokens[i + 2]
+            size = int(value) if value.lstrip('-').isdigit() else int(variables.get(value.lstrip('$'), 1))
+        i += 1
+
+
+def _selection_cost(tokens, i, variables):
+    """Cost of the selection set opened at tokens[i] == '{' and the index after its closing brace."""
+    cost = 0
+    i += 1
+    while tokens[i] != '}':
+        name = tokens[i]
+        i += 1
+        if tokens[i] == ':':  # alias: the field name follows
+            name = tokens[i + 1]
+            i += 2
+        size = None
+        if tokens[i] == '(':
+            size, i = _argument_size(tokens, i, variables)
+        if tokens[i] == '{':
+            children, i = _selection_cost(tokens, i, variables)
+            if size is not None:
+                cost += 2 + size * children
+            elif name in WRAPPERS:
+                cost += children
+            else:
+                cost += 1 + children
+        if tokens[i] == ',':
+            i += 1
+
+    return cost, i + 1
+
+
+def estimate_cost(text, variables=None):
+    """
+    Rough requested cost following Shopify's rules: objects cost 1, scalars 0, and a connection
+    or list 2 plus first/last times the cost of each node. Variables supply $first-style sizes.
+    """
+    tokens = TOKEN.findall(text)
+    cost, i = 0, 0
+    while i < len(tokens):
+        if tokens[i] == '(':
+            _, i = _argument_size(tokens, i, {})
+        elif tokens[i] == '{':
+            selection, i = _selection_cost(tokens, i, variables or {})
+            cost += selection
+        else:
+            i += 1
+
+    return cost
+
+
+def register(name, text, variables=None):
+    """Minifies and registers a query under a name and returns the text to send."""
+    text = minify(text)
+    REGISTRY[text] = RegisteredQuery(name=name, text=text, estimated_cost=estimate_cost(text, variables))
+
+    return text
+
+
+def runtime_query(key, name, compose):
+    """
+    Text of a query composed at runtime by compose(), registered under name on first use. Past
+    MAX_RUNTIME_QUERIES, the least recently used one is dropped from the registry and its costs.
+    """
+    with _runtime_lock:
+        text = _runtime_queries.get(key)
+        if text is not None:
+            _runtime_queries.move_to_end(key)
+            return text
+    text = register(name, compose())
+    with _runtime_lock:
+        _runtime_queries[key] = text
+        while len(_runtime_queries) > MAX_RUNTIME_QUERIES:
+            _, evicted = _runtime_queries.popitem(last=False)
+            if evicted not in _runtime_queries.values():
+                registered = REGISTRY.pop(evicted, None)
+                if registered and all(other.name != registered.name for other in list(REGISTRY.values())):
+                    with _costs_lock:
+                        observed_costs.pop(registered.name, None)
+
+    return text
+
+
+def record_cost(query, data):
+    """Adds the cost Shopify reported for a registered query's response to observed_costs."""
+    registered = REGISTRY.get(query)
+    cost = (data.get('extensions') or {}).get('cost') if isinstance(data, dict) else None
+    if registered is None or not cost:
+        return
+    with _costs_lock:
+        stats = observed_costs.setdefault(registered.name, {'calls': 0, 'requested': 0, 'actual': 0, 'max_actual': 0})
+        stats['calls'] += 1
+        stats['requested'] += cost.get('requestedQueryCost') or 0
+        stats['actual'] += cost.get('actualQueryCost') or 0
+        stats['max_actual'] = max(stats['max_actual'], cost.get('actualQueryCost') or 0)
+
+
+def cost_report():
+    """Per registered query: estimated cost and, once called, the average requested/actual cost Shopify reported."""
+    with _costs_lock:
+        observed = {name: dict(stats) for name, stats in observed_costs.items()}
+    report = []
+    for registered in sorted(REGISTRY.values(), key=lambda registered: registered.name):
+        stats = observed.get(registered.name, {})
+        calls = stats.get('calls', 0)
+        report.append({
+            'name': registered.name,
+            'estimated_cost': registered.estimated_cost,
+            'calls': calls,
+            'avg_requested_cost': round(stats['requested'] / calls, 1) if calls else None,
+            'avg_actual_cost': round(stats['actual'] / calls, 1) if calls else None,
+            'max_actual_cost': stats.get('max_actual'),
+        })
+
+    return report
+
+
+## Fragments
+MONEY = 'shopMoney { amount }'
+
+ORDER_HEADER = '''
+    id
+    name
+    createdAt
+    displayFinancialStatus
+    displayFulfillmentStatus
+'''
+
+ORDER_LIST_CUSTOMER = 'customer { firstName lastName }'
+
+ORDER_CONTACT = 'customer { firstName lastName email phone }'
+
+ORDER_LIST_ADDRESS = 'shippingAddress { address1 city country zip }'
+
+ORDER_FULL_ADDRESS = '''
+    shippingAddress {
+        address1
+        address2
+        city
+        province
+        provinceCode
+        zip
+        country
+        countryCode
+        phone
+    }
+'''
+
+ORDER_TOTALS = '\n'.join(
+    f'{name} {{ {MONEY} }}'
+    for name in (
+        'currentTotalAdditionalFeesSet', 'currentTotalDiscountsSet', 'currentShippingPriceSet',
+        'currentTotalDutiesSet', 'currentTotalTaxSet', 'currentSubtotalPriceSet',
+        'currentTotalPriceSet', 'totalReceivedSet',
+    )
+) + '''
+    currentSubtotalLineItemsQuantity
+    currentTotalWeight
+'''
+
+# Line items with the first variant's weight, for the Maersk rating request
+LINE_ITEM_WEIGHTS = '''
+    title
+    currentQuantity
+    product {
+        variants(first: 1) {
+            edges {
+                node {
+                    inventoryItem { measurement { weight { unit value } } }
+                }
+            }
+        }
+    }
+'''
+
+TRACKING_URLS = 'fulfillments(first: 5) { trackingInfo(first: 5) { url } }'
+
+
+## Admin (ShopifyApi)
+ORDER_LIST = register('order_list', '''
+    query getOrders($first: Int!, $cursor: String, $query: String) {
+        orders(first: $first, after: $cursor, sortKey: CREATED_AT, reverse: true, query: $query) {
+            pageInfo { hasNextPage endCursor }
+            edges {
+                node {
+                    ''' + ORDER_HEADER + '''
+                    totalPriceSet { ''' + MONEY + ''' }
+                    ''' + ORDER_LIST_CUSTOMER + '''
+                    ''' + ORDER_LIST_ADDRESS + '''
+                }
+            }
+        }
+    }
+''', variables={'first': 25})
+
+ORDER_ID_BY_NAME = register('order_id_by_name', '''
+    query getOrderId($query: String!) {
+        orders(first: 1, query: $query) { edges { node { id } } }
+    }
+''')
+
+ORDER_DETAILS = register('order_details', '''
+    query getOrder($id: ID!) {
+        order(id: $id) {
+            ''' + ORDER_HEADER + '''
+            ''' + ORDER_FULL_ADDRESS + '''
+            ''' + ORDER_TOTALS + '''
+            lineItems(first: 20) {
+                edges {
+                    node {
+                        name
+                        variant { price }
+                        ''' + LINE_ITEM_WEIGHTS + '''
+                    }
+                }
+            }
+            ''' + ORDER_CONTACT + '''
+        }
+    }
+''')
+
+ORDER_SEARCH = register('order_search', '''
+    query getOrder($id: ID!) {
+        order(id: $id) {
+            ''' + ORDER_HEADER + '''
+            totalPriceSet { ''' + MONEY + ''' }
+            ''' + ORDER_LIST_CUSTOMER + '''
+            shippingAddress { address1 address2 city country zip }
+            lineItems(first: 5) {
+                edges { node { title currentQuantity variant { price } } }
+            }
+        }
+    }
+''')
+
+ORDER_SHIPPING_ITEMS = register('order_shipping_items', '''
+    query getOrder($id: ID!) {
+        order(id: $id) {
+            id
+            shippingAddress { zip }
+            lineItems(first: 20) { edges { node { ''' + LINE_ITEM_WEIGHTS + ''' } } }
+        }
+    }
+''')
+
+
+## Voice agent (ShopifyApp)
+# Order names are unique, so lookups by name ask for one node
+def orders_by_name_text(selection, first=1):
+    return '''
+        query getOrders($query: String!) {
+            orders(first: ''' + str(first) + ''', query: $query) {
+                edges { node { ''' + selection + ''' } }
+            }
+        }
+    '''
+
+
+ORDERS_BY_NAME = register('orders_by_name', orders_by_name_text(order_selection(VOICE_FIELDS)))
+
+
+def orders_by_name(fields=VOICE_FIELDS):
+    """get_orders query for a set of order_projection fields, registered on first use."""
+    fields = tuple(sorted(set(fields)))
+    if fields == tuple(sorted(VOICE_FIELDS)):
+        return ORDERS_BY_NAME
+    name = f"orders_by_name[{','.join(fields)}]"
+
+    return runtime_query(('orders_by_name', fields), name, lambda: orders_by_name_text(order_selection(fields)))
+
+
+TRACKING_LINKS_BY_NAME = register('tracking_links_by_name', orders_by_name_text(TRACKING_URLS))
+
+ONLINE_STORE_URL_BY_SKU = register('online_store_url_by_sku', '''
+    query getProducts($query: String!) {
+        products(first: 5, query: $query) { edges { node { onlineStoreUrl } } }
+    }
+''')
+
+
+def aliased_search(name, root, count, selection, first=10):
+    """One query running count searches on a connection: q0: root(query: $q0) ... q<count-1>."""
+    def compose():
+        aliases = [f'q{i}' for i in range(count)]
+        return (
+            'query batch(' + ', '.join(f'${alias}: String!' for alias in aliases) + ') {\n'
+            + '\n'.join(f'{alias}: {root}(first: {first}, query: ${alias}) {{ edges {{ node {{ {selection} }} }} }}' for alias in aliases)
+            + '\n}'
+        )
+
+    return runtime_query(('aliased_search', name, root, count, selection, first), f'{name}[x{count}]', compose)
+
+
+def alias_cost(root, selection, first=10):
+    """Estimated cost of one alias of an aliased_search."""
+    return estimate_cost(f'{{ q0: {root}(first: {first}, query: $q0) {{ edges {{ node {{ {selection} }} }} }} }}')
+
+
+def aliases_per_query(root, selection, first=10):
+    """How many aliases of a selection fit in one query under MAX_QUERY_COST (0 if not even one does)."""
+    return MAX_QUERY_COST // max(alias_cost(root, selection, first), 1)
+
+
+if __name__ == '__main__':
+    for row in cost_report():
+        print(f"{row['name']}: estimated cost {row['estimated_cost']}")
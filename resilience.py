@@ -0,0 +1,253 @@
+"""
+Circuit breakers and bulkheads for the app's outside dependencies (Shopify, Maersk/Pilot, SMTP).
+
+Each Dependency bounds how many calls may be in flight at once (the bulkhead), so a slow
+service ties up at most that many worker threads, and stops calling a service whose recent
+calls mostly failed (the circuit breaker) until a trial call succeeds. Both reject with a
+DependencyUnavailable right away instead of letting the caller wait on a timeout.
+
+GuardedAdapter (requests) and GuardedTransport (httpx) put a dependency under an HTTP client.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from time import monotonic
+import os
+import threading
+import logging
+import httpx
+import requests.adapters
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class DependencyUnavailable(RuntimeError):
+    """A call was rejected without reaching the dependency."""
+
+    def __init__(self, name, reason, retry_after=None):
+        super().__init__(f"{name} is unavailable ({reason})")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitOpen(DependencyUnavailable):
+    pass
+
+
+class BulkheadFull(DependencyUnavailable):
+    pass
+
+
+@dataclass
+class CircuitBreaker:
+    """
+    Opens when at least failure_rate of the last window calls failed (and min_calls were made),
+    rejects calls for open_seconds, then lets half_open_calls trial calls through: a success
+    closes it again, a failure re-opens it.
+    """
+    name: str
+    failure_rate: float = 0.5
+    min_calls: int = 10
+    window: int = 20
+    open_seconds: float = 30
+    half_open_calls: int = 1
+    state: str = CLOSED
+    outcomes: deque = field(default=None, repr=False)
+    opened_at: float = 0
+    trials: int = 0
+    times_opened: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self.outcomes = deque(maxlen=self.window)
+
+    def current_failure_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def before_call(self):
+        with self.lock:
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - monotonic()
+                if remaining > 0:
+                    raise CircuitOpen(self.name, 'circuit open', retry_after=remaining)
+                self.state = HALF_OPEN
+                self.trials = 0
+                logger.info(f"Circuit {self.name} half-open")
+            if self.state == HALF_OPEN:
+                if self.trials >= self.half_open_calls:
+                    raise CircuitOpen(self.name, 'circuit half-open, trial call in flight', retry_after=1)
+                self.trials += 1
+
+    def record(self, success):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if success:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                    logger.info(f"Circuit {self.name} closed")
+                else:
+                    self.open()
+                return
+            self.outcomes.append(success)
+            if (self.state == CLOSED and len(self.outcomes) >= self.min_calls
+                    and self.current_failure_rate() >= self.failure_rate):
+                self.open()
+
+    def open(self):
+        self.state = OPEN
+        self.opened_at = monotonic()
+        self.times_opened += 1
+        logger.warning(f"Circuit {self.name} opened (failure rate {self.current_failure_rate():.0%})")
+
+
+@dataclass
+class Bulkhead:
+    """At most max_concurrent calls in flight; a caller waits up to max_wait seconds for a slot."""
+    name: str
+    max_concurrent: int = 10
+    max_wait: float = 0.1
+    in_flight: int = 0
+    semaphore: threading.BoundedSemaphore = field(default=None, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self.semaphore = threading.BoundedSemaphore(self.max_concurrent)
+
+    def acquire(self):
+        if not self.semaphore.acquire(timeout=self.max_wait):
+            raise BulkheadFull(self.name, f'{self.max_concurrent} calls already in flight', retry_after=1)
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.semaphore.release()
+
+
+@dataclass
+class Dependency:
+    name: str
+    breaker: CircuitBreaker
+    bulkhead: Bulkhead
+    calls: int = 0
+    failures: int = 0
+    rejected: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def call(self, fn, *args, is_failure=None, **kwargs):
+        """
+        Runs fn through the bulkhead and breaker. An exception counts as a failure, as does a
+        result for which is_failure(result) is true (e.g. a 5xx response); either way the
+        result or exception is passed on unchanged.
+        """
+        try:
+            self.bulkhead.acquire()
+            try:
+                self.breaker.before_call()
+            except DependencyUnavailable:
+                self.bulkhead.release()
+                raise
+        except DependencyUnavailable:
+            with self.lock:
+                self.rejected += 1
+            raise
+
+        success = False
+        try:
+            result = fn(*args, **kwargs)
+            success = not (is_failure and is_failure(result))
+            return result
+        finally:
+            self.bulkhead.release()
+            self.breaker.record(success)
+            with self.lock:
+                self.calls += 1
+                self.failures += not success
+
+    def metrics(self):
+        with self.lock:
+            counts = {'calls': self.calls, 'failures': self.failures, 'rejected': self.rejected}
+
+        return {
+            'state': self.breaker.state,
+            'failure_rate': round(self.breaker.current_failure_rate(), 3),
+            'times_opened': self.breaker.times_opened,
+            'in_flight': self.bulkhead.in_flight,
+            'max_concurrent': self.bulkhead.max_concurrent,
+            **counts,
+        }
+
+
+DEPENDENCIES = {}
+_dependencies_lock = threading.Lock()
+
+
+def dependency(name, max_concurrent=10, max_wait=0.1, **breaker_options):
+    """The process-wide Dependency for a name, created with these limits on first use."""
+    with _dependencies_lock:
+        if name not in DEPENDENCIES:
+            DEPENDENCIES[name] = Dependency(
+                name=name,
+                breaker=CircuitBreaker(name=name, **breaker_options),
+                bulkhead=Bulkhead(name=name, max_concurrent=max_concurrent, max_wait=max_wait),
+            )
+
+        return DEPENDENCIES[name]
+
+
+def shopify_dependency(store_name):
+    """One breaker and bulkhead per store, shared by its ShopifyApp and ShopifyApi clients."""
+    return dependency(f'shopify:{store_name}', max_concurrent=int(os.getenv('SHOPIFY_MAX_CONCURRENCY', 16)), max_wait=0.5)
+
+
+def maersk_dependency():
+    """Pilot/Maersk rating, shipment and label calls."""
+    return dependency('maersk', max_concurrent=int(os.getenv('MAERSK_MAX_CONCURRENCY', 4)))
+
+
+def mailer_dependency():
+    """Outgoing SMTP."""
+    return dependency('smtp', max_concurrent=int(os.getenv('SMTP_MAX_CONCURRENCY', 4)))
+
+
+def metrics():
+    """State and counters of every dependency, for the /metrics endpoint."""
+    with _dependencies_lock:
+        dependencies = list(DEPENDENCIES.values())
+
+    return {dep.name: dep.metrics() for dep in dependencies}
+
+
+def server_error(response):
+    return response.status_code >= 500
+
+
+class GuardedAdapter(requests.adapters.HTTPAdapter):
+    """requests adapter sending every request through a Dependency, with a default timeout."""
+
+    def __init__(self, dependency, timeout=None, **kwargs):
+        self.dependency = dependency
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return self.dependency.call(super().send, request, is_failure=server_error, **kwargs)
+
+
+class GuardedTransport(httpx.BaseTransport):
+    """httpx transport sending every request through a Dependency."""
+
+    def __init__(self, dependency, transport=None):
+        self.dependency = dependency
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        return self.dependency.call(self.transport.handle_request, request, is_failure=server_error)
+
+    def close(self):
+        self.transport.close()
@@ -1,14 +1,21 @@
 import requests
+import requests.adapters
 from dataclasses import dataclass
 from dotenv import load_dotenv
 import os
 from urllib.parse import urljoin
 import logging
 from requests.exceptions import RequestException, Timeout
+from singleflight import SingleFlight, is_read, request_key
+import queries
+from resilience import shopify_dependency, GuardedAdapter
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
+# Concurrent identical queries share one in-flight request; each caller gets its own copy of the parsed JSON
+request_flight = SingleFlight(copy_result=True)
+
 
 @dataclass
 class ShopifyApi():
@@ -19,11 +26,13 @@ class ShopifyApi():
 	session: requests.Session = None
 	retries: int = 3
 	timeout: float = 10.0
+	pool_size: int = 10
 
 	# Support
 	def send_request(self, query, variables=None):
 		"""
-		Sends an HTTP POST request to the Shopify API.
+		Sends an HTTP POST request to the Shopify API. Identical queries already in flight
+		from other threads are not sent again; their result is shared.
 
 		Args:
 		query (str): The GraphQL query string.
@@ -35,6 +44,13 @@ class ShopifyApi():
 		Raises:
 		ValueError: If the response contains an error.
 		"""
+		if not is_read(query):
+			return self.post_graphql(query, variables)
+
+		key = request_key(self.api_url, query, variables=variables)
+		return request_flight.do(key, lambda: self.post_graphql(query, variables))
+
+	def post_graphql(self, query, variables=None):
 		for attempt in range(1, self.retries + 1):
 			try:
 				response = self.session.post(
@@ -48,6 +64,7 @@ class ShopifyApi():
 
 				# Parse the JSON response
 				json_response = response.json()
+				queries.record_cost(query, json_response)
 
 				# Check for API-specific errors
 				if 'errors' in json_response:
@@ -75,6 +92,10 @@ class ShopifyApi():
 			'Content-Type': 'application/json'
 		}
 		self.session = requests.Session()
+		# Keep-alive pool sized for concurrent Flask request threads sharing this client,
+		# behind the shop's circuit breaker and bulkhead
+		adapter = GuardedAdapter(shopify_dependency(self.store_name), timeout=self.timeout, pool_connections=1, pool_maxsize=self.pool_size)
+		self.session.mount('https://', adapter)
 		self.session.headers.update(headers)
 		self.api_url = f'https://{self.store_name}.myshopify.com/admin/api/{self.version}/graphql.json'
 
@@ -204,299 +225,47 @@ class ShopifyApi():
 
 		return response
 
-	def orders(self, cursor=None, order_name=None):
+	def orders(self, cursor=None, order_name=None, first=25):
+		"""
+		Fetches one page of orders, newest first, with only the fields the order list shows.
+
+		Pass the previous page's pageInfo.endCursor as cursor to get the next page,
+		and order_name to search by order name.
+		"""
 		print("Fetching Orders...")
-		variables = {}
-		if cursor and order_name:
-			return None
-		elif cursor and not order_name:
-			query = """
-				query getOrders($cursor: String) {
-					orders(first: 10, after: $cursor, sortKey: CREATED_AT, reverse: true) {
-						pageInfo {
-							hasNextPage
-							endCursor
-						}
-						edges {
-							node {
-								id
-								name
-								createdAt
-								totalPriceSet{
-									shopMoney{
-										amount
-									}
-								}
-								customer {
-									firstName
-									lastName
-								}
-								displayFinancialStatus
-								displayFulfillmentStatus
-								shippingAddress {
-									address1
-									city
-									country
-									zip
-								}
-								lineItems(first: 5) {
-									edges {
-										node {
-											title
-											quantity
-										}
-									}
-								}
-							}
-						}
-					}
-				}
-			"""
-			variables["after"] = cursor
-		
-		elif not cursor and order_name:
-			query = """
-				query getOrders($query: String) {
-					orders(first: 10, sortKey: CREATED_AT, reverse: true, query: $query) {
-						pageInfo {
-							hasNextPage
-							endCursor
-						}
-						edges {
-							node {
-								id
-								name
-								createdAt
-								totalPriceSet{
-									shopMoney{
-										amount
-									}
-								}
-								customer {
-									firstName
-									lastName
-								}
-								displayFinancialStatus
-								displayFulfillmentStatus
-								shippingAddress {
-									address1
-									city
-									country
-									zip
-								}
-								lineItems(first: 5) {
-									edges {
-										node {
-											title
-											quantity
-										}
-									}
-								}
-							}
-						}
-					}
-				}
-			"""
-			variables["query"] = f"name:{order_name}"
-		
-		elif not cursor and not order_name:
-			query = """
-				query {
-					orders(first: 10, sortKey: CREATED_AT, reverse: true) {
-						pageInfo {
-							hasNextPage
-							endCursor
-						}
-						edges {
-							node {
-								id
-								name
-								createdAt
-								totalPriceSet{
-									shopMoney{
-										amount
-									}
-								}
-								customer {
-									firstName
-									lastName
-								}
-								displayFinancialStatus
-								displayFulfillmentStatus
-								shippingAddress {
-									address1
-									city
-									country
-									zip
-								}
-								lineItems(first: 5) {
-									edges {
-										node {
-											title
-											quantity
-										}
-									}
-								}
-							}
-						}
-					}
-				}
-			"""
-			variable = None
+		query = queries.ORDER_LIST
+		variables = {
+			"first": first,
+			"cursor": cursor,
+			"query": f"name:{order_name}" if order_name else None
+		}
 
 		response = self.send_request(query, variables=variables)
 
 		return response
 
+	def order_id(self, order_name):
+		"""Admin GraphQL id of the order with this name."""
+		response = self.send_request(queries.ORDER_ID_BY_NAME, variables={"query": f"name:{order_name}"})
+
+		return response['data']['orders']['edges'][0]['node']['id']
+
 	def order(self, order_id, mode):
+		"""
+		Fetches one order with the fields a page renders: 'details' for the order details page,
+		'search' for a search result row and 'shipping' for the line item weights and destination zip
+		the Maersk rating request needs.
+		"""
 		print(f'Fetching Order {order_id}...')
+		query = {
+			'details': queries.ORDER_DETAILS,
+			'search': queries.ORDER_SEARCH,
+			'shipping': queries.ORDER_SHIPPING_ITEMS,
+		}.get(mode)
+		if query is None:
+			return None
 		try:
-			if mode == 'details':
-				query = """
-					query getOrder($id: ID!) {
-						order(id: $id) {
-							id
-							name
-							createdAt
-							shippingAddress {
-								address1
-								address2
-								city
-								province
-								provinceCode
-								zip
-								country
-								countryCode
-								phone
-							}
-							displayFinancialStatus
-							displayFulfillmentStatus
-							currentTotalAdditionalFeesSet{
-								shopMoney{
-									amount
-								}
-							}
-							currentTotalDiscountsSet{
-								shopMoney{
-									amount
-								}
-							}
-							currentShippingPriceSet{
-								shopMoney{
-									amount
-								}
-							}
-							currentTotalDutiesSet{
-								shopMoney{
-									amount
-								}
-							}
-							currentTotalTaxSet{
-								shopMoney{
-									amount
-								}
-							}
-							currentSubtotalPriceSet{
-								shopMoney{
-									amount
-								}
-							}
-							currentTotalPriceSet{
-								shopMoney{
-									amount
-								}
-							}
-							totalReceivedSet{
-								shopMoney{
-									amount
-								}
-							}
-							lineItems(first: 20) {
-								edges {
-									node {
-										title
-										name
-										currentQuantity
-										variant{
-											price
-										}
-										product{
-											variants(first: 1){
-												edges{
-													node{
-														price
-														inventoryItem{
-															measurement{
-																weight{
-																	unit
-																	value
-																}
-															}
-														}
-													}
-												}
-											}
-										}
-									}
-								}
-							}
-							currentSubtotalLineItemsQuantity
-							currentTotalWeight
-							customer {
-								firstName
-								lastName
-								email
-								phone
-							}
-						}
-					}
-				"""
-				variables = {"id": order_id}
-
-				return self.send_request(query=query, variables=variables)
-
-			elif mode == 'search':
-				query = """
-					query getOrder($id: ID!) {
-						order(id: $id) {
-							id
-							name
-							createdAt
-							totalPriceSet{
-								shopMoney{
-									amount
-								}
-							}
-							customer {
-								firstName
-								lastName
-							}
-							displayFinancialStatus
-							displayFulfillmentStatus
-							shippingAddress {
-								address1
-								address2
-								city
-								country
-								zip
-							}
-							lineItems(first: 5) {
-								edges {
-									node {
-										title
-										currentQuantity
-										variant{
-											price
-										}
-									}
-								}
-							}
-						}
-					}
-				"""
-				variables = {"id": order_id}
-
-				return self.send_request(query=query, variables=variables)
+			return self.send_request(query=query, variables={"id": order_id})
 		except Exception as e:
 			return None
 
@@ -1,13 +1,19 @@
 from glob import glob
-from time import sleep
+from time import sleep, monotonic
 import httpx
 from dataclasses import dataclass
+import csv
 import json
 import os
 import pandas as pd
 from dotenv import load_dotenv
 from datetime import datetime, date
 from converter import csv_to_jsonl, get_handles
+from media_transfer import MediaTransfer, SizeProber, StagedTargetAllocator
+from order_projection import VOICE_FIELDS, order_selection
+from singleflight import SingleFlight, is_read, request_key
+import queries
+from resilience import GuardedTransport, shopify_dependency
 import re
 import logging
 
@@ -15,6 +21,91 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 
+# Bulk operation results
+BULK_FINISHED_STATUSES = ('COMPLETED', 'FAILED', 'CANCELED', 'EXPIRED')
+
+
+@dataclass(frozen=True)
+class ProductHandle:
+    id: str
+    handle: str
+
+
+@dataclass(frozen=True)
+class BulkMutationResult:
+    line_number: int
+    data: dict
+    errors: list
+
+
+def gid_type(gid):
+    # gid://shopify/ProductVariant/123 -> ProductVariant
+    parts = str(gid or '').split('/')
+    return parts[-2] if len(parts) >= 2 else None
+
+
+def assemble_bulk_objects(rows):
+    """
+    Nests __parentId rows under their parent and yields each top-level object once complete.
+
+    Bulk query output lists every child after its parent and before the next top-level
+    object, so only the current top-level object and its descendants are held in memory.
+    Children are collected in the parent's '__children' list; use gid_type to tell them apart.
+    """
+    current = None
+    index = {}
+    for row in rows:
+        parent_id = row.pop('__parentId', None)
+        if parent_id is None:
+            if current is not None:
+                yield current
+            current = row
+            index = {}
+        else:
+            parent = index.get(parent_id)
+            if parent is None:
+                logging.warning(f"Skipping bulk row whose parent {parent_id} was not seen")
+                continue
+            parent.setdefault('__children', []).append(row)
+        if row.get('id'):
+            index[row['id']] = row
+
+    if current is not None:
+        yield current
+
+
+def is_throttled(data):
+    return any((error.get('extensions') or {}).get('code') == 'THROTTLED' for error in data.get('errors') or [])
+
+
+def throttle_wait(data):
+    """Seconds until the cost bucket can pay for the request again, from a response's extensions.cost."""
+    cost = (data.get('extensions') or {}).get('cost') or {}
+    throttle = cost.get('throttleStatus') or {}
+    requested = cost.get('requestedQueryCost') or 0
+    available = throttle.get('currentlyAvailable')
+    restore_rate = throttle.get('restoreRate') or 50
+    if available is None or available >= requested:
+        return 0
+
+    return (requested - available) / restore_rate
+
+
+# Concurrent identical queries share one in-flight request; the httpx response is shared, each caller parses its own json()
+request_flight = SingleFlight()
+
+
+# Order fields behind the voice order answers, shared by get_orders and get_recent_orders_by_phone
+ORDER_FIELDS = order_selection(VOICE_FIELDS)
+# Line items per order in batched lookups; the full 250 would leave room for one order per query
+BATCH_LINE_ITEMS = int(os.getenv('BATCH_LINE_ITEMS', 20))
+
+
+def orders_per_query(fields=VOICE_FIELDS):
+    """How many orders one batch_get_orders request fits under the query cost limit (at least 1)."""
+    return max(queries.aliases_per_query('orders', order_selection(fields, line_items=BATCH_LINE_ITEMS), first=1), 1)
+
+
 @dataclass
 class ShopifyApp:
     store_name: str = None
@@ -32,6 +123,13 @@ class ShopifyApp:
 
     ## Send Request
     def send_request(self, client, query, variables=None):
+        if not is_read(query):
+            return self.post_graphql(client, query, variables)
+
+        key = request_key(self.api_url, query, variables=variables)
+        return request_flight.do(key, lambda: self.post_graphql(client, query, variables))
+
+    def post_graphql(self, client, query, variables=None):
         for attempt in range(1, self.retries + 1):
             try:
                 response = client.post(
@@ -44,6 +142,7 @@ class ShopifyApp:
                 response.raise_for_status()
 
                 data = response.json()
+                queries.record_cost(query, data)
 
                 # Check for API-specific errors
                 if 'errors' in data:
@@ -67,7 +166,7 @@ class ShopifyApp:
     ## Session
     def create_session(self):
         print("Creating session...")
-        client = httpx.Client()
+        client = httpx.Client(transport=GuardedTransport(shopify_dependency(self.store_name)))
         headers = {
             'X-Shopify-Access-Token': self.access_token,
             'Content-Type': 'application/json'
@@ -193,6 +292,8 @@ class ShopifyApp:
         print(response.json())
         print('')
 
+        return response.json()
+
     ## Variants
     def create_variants(self, client, staged_target):
         print('Creating products...')
@@ -246,6 +347,8 @@ class ShopifyApp:
         print(response.json())
         print('')
 
+        return response.json()
+
     ## Collection
     def create_collection(self, client, descriptionHtml, image_src, title, appliedDisjuntively, column, relation, condition):
         if pd.isna(descriptionHtml):
@@ -451,6 +554,44 @@ class ShopifyApp:
 
         return response.json()
 
+    def get_variant_ids_by_sku(self, client, sku):
+        """Looks up the ids, handle and online store url for one SKU; returns the flat record or None."""
+        query = '''
+            query($query: String) {
+                productVariants(first: 10, query: $query) {
+                    edges {
+                        node {
+                            id
+                            sku
+                            product {
+                                id
+                                handle
+                                onlineStoreUrl
+                            }
+                            inventoryItem {
+                                id
+                            }
+                        }
+                    }
+                }
+            }
+        '''
+        response = self.send_request(client, query=query, variables={'query': 'sku:"{}"'.format(sku)})
+        for edge in response.json()['data']['productVariants']['edges']:
+            node = edge['node']
+            # The search is token based, so only an exact SKU match counts
+            if node.get('sku') == sku:
+                return {
+                    'sku': node['sku'],
+                    'variant_id': node['id'],
+                    'product_id': node['product']['id'],
+                    'handle': node['product']['handle'],
+                    'inventory_item_id': (node.get('inventoryItem') or {}).get('id'),
+                    'online_store_url': node['product'].get('onlineStoreUrl'),
+                }
+
+        return None
+
     def get_products_id_by_sku(self, client, skus):
         print('Getting product id...')
         query = '''
@@ -521,7 +662,10 @@ class ShopifyApp:
                 products(first: 1, query: $query){
                     edges{
                         node{
+                            id
+                            handle
                             description
+                            onlineStoreUrl
                             title
                             totalInventory
                             variants(first: 10){
@@ -914,25 +1058,271 @@ class ShopifyApp:
         else:
             print('File Type is Invalid')
 
-    def bulk_get_file(self):
-        # print("Getting bulk file...")
-        # mutation = """
-        # mutation bulkOperationRunQuery($query: String!) {
-        #     bulkOperationRunQuery(query: $query) {
-        #         bulkOperation {
-        #             # BulkOperation fields
-        #             }
-        #         userErrors {
-        #             field
-        #             message
-        #         }
-        #     }
-        # }
-        # """
-        #
-        # response = client.post(f'https://{self.store_name}.myshopify.com/admin/api/{self.api_version}/graphql.json',
-        #                        json={'query': mutation, 'variables': variables})
-        pass
+    def bulk_get_file(self, client, created_at, media_type="Not defined"):
+        """Exports every file of a media type created since created_at with one bulk query."""
+        print("Getting bulk file...")
+        if media_type == 'IMAGE':
+            fields = 'preview { image { altText url } }'
+        elif media_type == 'VIDEO':
+            fields = 'alt ... on Video { sources { url } }'
+        elif media_type == 'GenericFile':
+            fields = 'alt ... on GenericFile { url }'
+        else:
+            print('File Type is Invalid')
+            return
+
+        query = """
+            {
+                files(query: "(created_at:>=%s) AND (media_type:%s)") {
+                    edges {
+                        node {
+                            id
+                            fileStatus
+                            %s
+                        }
+                    }
+                }
+            }
+        """ % (created_at, media_type, fields)
+
+        operation = self.run_bulk_export(client, query)
+        for node in self.iter_bulk_objects(operation['url']) if operation.get('url') else []:
+            if media_type == 'IMAGE':
+                image = (node.get('preview') or {}).get('image') or {}
+                alt_text, url = image.get('altText', ''), image.get('url', '')
+            elif media_type == 'VIDEO':
+                sources = node.get('sources') or [{}]
+                alt_text, url = node.get('alt', ''), sources[0].get('url', '')
+            else:
+                alt_text, url = node.get('alt', ''), node.get('url', '')
+            yield {'id': node['id'], 'altText': alt_text, 'url': url, 'status': node.get('fileStatus', '')}
+
+    ## Bulk Export
+    def run_bulk_query(self, client, query):
+        print("Running bulk query...")
+        mutation = '''
+            mutation bulkOperationRunQuery($query: String!) {
+                bulkOperationRunQuery(query: $query) {
+                    bulkOperation {
+                        id
+                        status
+                    }
+                    userErrors {
+                        field
+                        message
+                    }
+                }
+            }
+        '''
+        variables = {'query': query}
+
+        response = self.send_request(client, query=mutation, variables=variables)
+        result = response.json()['data']['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise ValueError(f"Bulk query was rejected: {result['userErrors']}")
+
+        return result['bulkOperation']
+
+    def wait_bulk_operation(self, client, bulk_operation_id, min_poll_interval=2, max_poll_interval=60, finished_hint=None):
+        """
+        Polls a bulk operation with a doubling interval until it reaches a final status.
+
+        finished_hint is an optional callable (e.g. a webhook marker check) looked at every
+        second; the first time it returns something truthy the operation is polled right away.
+        """
+        interval = min_poll_interval
+        next_poll = monotonic()
+        hinted = False
+        while True:
+            if not hinted and finished_hint and finished_hint():
+                hinted = True
+                next_poll = monotonic()
+            if monotonic() >= next_poll:
+                operation = self.get_bulk_operation(client, bulk_operation_id)
+                print(f"Bulk operation {bulk_operation_id}: {operation['status']} ({operation.get('objectCount')} objects)")
+                if operation['status'] in BULK_FINISHED_STATUSES:
+                    return operation
+                interval = min(interval * 2, max_poll_interval)
+                next_poll = monotonic() + interval
+            sleep(1)
+
+    def run_bulk_export(self, client, query):
+        """Runs a bulk query to completion and returns the finished operation (its url holds the JSONL)."""
+        bulk_operation = self.run_bulk_query(client, query)
+        operation = self.wait_bulk_operation(client, bulk_operation['id'])
+        if operation['status'] != 'COMPLETED':
+            raise RuntimeError(f"Bulk query {operation['id']} ended as {operation['status']}: {operation.get('errorCode')}")
+
+        return operation
+
+    def bulk_export(self, client, query):
+        """Yields the objects of a bulk query, children nested under their parents."""
+        operation = self.run_bulk_export(client, query)
+        if operation.get('url'):
+            yield from self.iter_bulk_objects(operation['url'])
+
+    def bulk_get_product_ids(self, client, csv_path='data/product_ids.csv'):
+        query = """
+            {
+                products {
+                    edges {
+                        node {
+                            id
+                            handle
+                        }
+                    }
+                }
+            }
+        """
+        operation = self.run_bulk_export(client, query)
+        if not operation.get('url'):
+            return 0
+
+        return self.save_product_ids(operation['url'], csv_path=csv_path)
+
+    def bulk_get_variants(self, client):
+        """Yields one flat record per variant: sku, variant id, product id/handle/online store url and inventory item id."""
+        query = """
+            {
+                productVariants {
+                    edges {
+                        node {
+                            id
+                            sku
+                            product {
+                                id
+                                handle
+                                onlineStoreUrl
+                            }
+                            inventoryItem {
+                                id
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        for node in self.bulk_export(client, query):
+            yield {
+                'sku': node.get('sku'),
+                'variant_id': node['id'],
+                'product_id': (node.get('product') or {}).get('id'),
+                'handle': (node.get('product') or {}).get('handle'),
+                'inventory_item_id': (node.get('inventoryItem') or {}).get('id'),
+                'online_store_url': (node.get('product') or {}).get('onlineStoreUrl'),
+            }
+
+    def bulk_get_collections(self, client):
+        query = """
+            {
+                collections {
+                    edges {
+                        node {
+                            handle
+                            id
+                            title
+                        }
+                    }
+                }
+            }
+        """
+
+        return list(self.bulk_export(client, query))
+
+    def bulk_get_product_details(self, client):
+        """Yields every product with the fields voice summaries need; variants are in '__children'."""
+        query = """
+            {
+                products {
+                    edges {
+                        node {
+                            id
+                            handle
+                            title
+                            vendor
+                            description
+                            totalInventory
+                            onlineStoreUrl
+                            variantsCount {
+                                count
+                                precision
+                            }
+                            variants {
+                                edges {
+                                    node {
+                                        id
+                                        sku
+                                        displayName
+                                        price
+                                        compareAtPrice
+                                        availableForSale
+                                        inventoryQuantity
+                                        selectedOptions {
+                                            name
+                                            optionValue {
+                                                name
+                                            }
+                                        }
+                                        inventoryItem {
+                                            requiresShipping
+                                            measurement {
+                                                weight {
+                                                    unit
+                                                    value
+                                                }
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        """
+
+        return self.bulk_export(client, query)
+
+    def bulk_get_order_headers(self, client, created_after=None):
+        """Yields the header fields of every order (optionally created after an ISO date) for the local order mirror."""
+        search = f'(query: "created_at:>={created_after}")' if created_after else ''
+        query = """
+            {
+                orders%s {
+                    edges {
+                        node {
+                            id
+                            name
+                            createdAt
+                            email
+                            phone
+                            customer {
+                                firstName
+                                lastName
+                                email
+                                phone
+                            }
+                            totalPriceSet {
+                                shopMoney {
+                                    amount
+                                }
+                            }
+                            displayFinancialStatus
+                            displayFulfillmentStatus
+                            shippingAddress {
+                                address1
+                                city
+                                country
+                                zip
+                                phone
+                            }
+                        }
+                    }
+                }
+            }
+        """ % search
+
+        return self.bulk_export(client, query)
 
     ## Access Scopes
     def check_access_scopes(self, client):
@@ -981,101 +1371,46 @@ class ShopifyApp:
         return response.json()
 
     ## Order
-    def get_orders(self, client, order_number):
+    def get_orders(self, client, order_number, fields=None):
+        """Orders matching an order name; fields (order_projection names) narrows the selection set."""
+        query = queries.ORDERS_BY_NAME if fields is None else queries.orders_by_name(fields)
+
+        variables = {'query': "name:{}".format(order_number)}
+
+        response = self.send_request(client, query=query, variables=variables)
+
+        return response
+
+    def get_recent_orders_by_phone(self, client, phone, first=5):
+        """Most recent orders (same fields as get_orders) of the customer with this phone number."""
         query = '''
-                query getOrders($query:String!){
-                    orders(first:250, query:$query) {
+                query getRecentOrders($query:String!, $first:Int!){
+                    customers(first:1, query:$query) {
                         edges {
                             node {
-                                name
-                                lineItems(first: 250){
-                                    edges{
-                                        node{
-                                            name
-                                            currentQuantity
-                                            originalUnitPriceSet{
-                                                shopMoney{
-                                                    amount
-                                                    currencyCode
-                                                }
-                                            }
-                                        }
-                                    }
-                                }
-                                currentSubtotalLineItemsQuantity
-                                currentSubtotalPriceSet{
-                                    shopMoney{
-                                        amount
-                                        currencyCode
-                                    }
-                                }
-                                currentTotalWeight
-                                paymentGatewayNames
-                                shippingLines(first: 250){
-                                    edges{
-                                        node{
-                                            title
-                                            currentDiscountedPriceSet{
-                                                shopMoney{
-                                                    amount
-                                                    currencyCode
-                                                }
-                                            }
+                                orders(first:$first, sortKey:CREATED_AT, reverse:true) {
+                                    edges {
+                                        node {
+                                        ''' + ORDER_FIELDS + '''
                                         }
                                     }
                                 }
-                                fulfillments(first:250){
-                                    name
-                                    createdAt
-                                    deliveredAt
-                                    inTransitAt
-                                    estimatedDeliveryAt
-                                    displayStatus
-                                    trackingInfo(first:250){
-                                        company
-                                        number
-                                        url
-                                    }
-                                }
-                                displayFinancialStatus
-                                returnStatus
-                                cancellation{
-                                    staffNote
-                                }
-                                cancelReason
-                                currentTotalWeight
-                                cancelledAt
-                                createdAt
-                                closedAt
                             }
                         }
                     }
                 }
                 '''
 
-        variables = {'query': "name:{}".format(order_number)}
+        variables = {'query': "phone:{}".format(phone), 'first': first}
 
         response = self.send_request(client, query=query, variables=variables)
+        customers = response.json()['data']['customers']['edges']
 
-        return response
+        return [edge['node'] for edge in customers[0]['node']['orders']['edges']] if customers else []
 
     ## Tracking Link
     def get_tracking_link(self, client, order_number):
-        query = '''
-                query getOrders($query:String!){
-                    orders(first:250, query:$query) {
-                        edges {
-                            node {
-                                fulfillments(first:250){
-                                    trackingInfo(first:250){
-                                        url
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-                '''
+        query = queries.TRACKING_LINKS_BY_NAME
 
         variables = {'query': "name:{}".format(order_number)}
 
@@ -1085,17 +1420,7 @@ class ShopifyApp:
 
     ## Online Store Url
     def get_online_store_url(self, client, item_number):
-        query = '''
-                query getProducts($query:String!){
-                    products(first:250, query:$query) {
-                        edges {
-                            node {
-                                onlineStoreUrl
-                            }
-                        }
-                    }
-                }
-                '''
+        query = queries.ONLINE_STORE_URL_BY_SKU
 
         variables = {'query': "sku:{}".format(item_number)}
 
@@ -1103,6 +1428,52 @@ class ShopifyApp:
 
         return response
 
+    ## Batched lookups
+    def search_aliased(self, client, name, root, searches, selection, first=10):
+        """
+        Runs several searches on one connection (orders, products, ...) as aliased queries,
+        e.g. q0: orders(query:"name:#1001"), q1: orders(query:"name:#1002"), and returns one
+        connection per search, in order. Searches are split over as many queries as it takes to
+        keep each under queries.MAX_QUERY_COST; each is registered in queries as name[x<count>].
+        """
+        size = max(queries.aliases_per_query(root, selection, first), 1)
+        connections = []
+        for start in range(0, len(searches), size):
+            chunk = searches[start:start + size]
+            query = queries.aliased_search(name, root, len(chunk), selection, first)
+            variables = {f'q{i}': search for i, search in enumerate(chunk)}
+
+            data = self.send_request(client, query=query, variables=variables).json()['data']
+            connections.extend(data[alias] for alias in variables)
+
+        return connections
+
+    def batch_get_orders(self, client, order_numbers, fields=None):
+        """get_orders for several order names in as few requests as the cost limit allows: {order_number: get_orders(...).json()}."""
+        fields = VOICE_FIELDS if fields is None else tuple(sorted(fields))
+        selection = order_selection(fields, line_items=BATCH_LINE_ITEMS)
+        if not queries.aliases_per_query('orders', selection, first=1):
+            # Not even one alias fits under the cost limit: one get_orders per order
+            return {number: self.get_orders(client, number, fields=fields).json() for number in order_numbers}
+        searches = [f'name:{number}' for number in order_numbers]
+        connections = self.search_aliased(client, 'orders_by_name', 'orders', searches, selection, first=1)
+
+        return {number: {'data': {'orders': connection}} for number, connection in zip(order_numbers, connections)}
+
+    def batch_get_tracking_links(self, client, order_numbers):
+        """get_tracking_link for several order names in one request, keyed by order name."""
+        searches = [f'name:{number}' for number in order_numbers]
+        connections = self.search_aliased(client, 'tracking_links_by_name', 'orders', searches, queries.TRACKING_URLS, first=1)
+
+        return {number: {'data': {'orders': connection}} for number, connection in zip(order_numbers, connections)}
+
+    def batch_get_online_store_urls(self, client, item_numbers):
+        """get_online_store_url for several SKUs in one request, keyed by SKU."""
+        searches = [f'sku:{sku}' for sku in item_numbers]
+        connections = self.search_aliased(client, 'online_store_url_by_sku', 'products', searches, 'onlineStoreUrl', first=5)
+
+        return {sku: {'data': {'products': connection}} for sku, connection in zip(item_numbers, connections)}
+
     # Update
     ## Product
     def update_product(self, client, handle, tags):
@@ -1188,6 +1559,8 @@ class ShopifyApp:
         print(response.json())
         print('')
 
+        return response.json()
+
     def update_variants(self, client, staged_target):
         print('Creating products...')
         mutation = '''
@@ -1240,7 +1613,13 @@ class ShopifyApp:
         print(response.json())
         print('')
 
-    def update_inventories(self, client, quantities):
+        return response.json()
+
+    def update_inventories(self, client, quantities, reason='correction'):
+        """
+        Sets the available quantity of up to 250 inventory item/location pairs in one call.
+        Throttled and failed requests are retried a bounded number of times; returns the response JSON.
+        """
         mutation = '''
         mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
                              inventorySetQuantities(input: $input)
@@ -1248,6 +1627,7 @@ class ShopifyApp:
                                 userErrors {
                                             field
                                             message
+                                            code
                                 }
                              }
         }
@@ -1258,20 +1638,25 @@ class ShopifyApp:
                 "ignoreCompareQuantity": True,
                 "name": "available",
                 "quantities": quantities,
-                "reason": "correction"
+                "reason": reason
             }
         }
 
-        while 1:
+        for attempt in range(1, self.retries + 2):
             try:
                 response = client.post(f'https://{self.store_name}.myshopify.com/admin/api/{self.api_version}/graphql.json',
-                                       json={'query': mutation, 'variables': variables})
-                print(response)
-                print(response.json())
-                print('')
-                break
-            except Exception as e:
-                print(e)
+                                       json={'query': mutation, 'variables': variables}, timeout=self.timeout)
+                response.raise_for_status()
+                data = response.json()
+                if not is_throttled(data):
+                    return data
+                logging.warning(f"Inventory update throttled on attempt {attempt}/{self.retries + 1}")
+                sleep(max(throttle_wait(data), 1))
+            except httpx.HTTPError as e:
+                logging.error(f"Inventory update failed on attempt {attempt}/{self.retries + 1}: {e}")
+                sleep(attempt)
+
+        raise RuntimeError("Failed to update inventories after multiple attempts.")
 
     ## Collections
     def publish_collection(self, client):
@@ -1395,6 +1780,8 @@ class ShopifyApp:
         print(response.json())
         print('')
 
+        return response.json()
+
     def remove_scheduled_publish_date_updated(self, client, product_id, publication_id=None):
         print(f'Removing scheduled publish date for product {product_id}...')
         mutation = '''
@@ -1599,7 +1986,8 @@ class ShopifyApp:
         converted_df['mimeType'] = "video/mp4"
         converted_df.rename(columns={'file_type': 'resource'}, inplace=True)
         converted_df['httpMethod'] = 'POST'
-        converted_df['fileSize'] = converted_df['actual_video_links'].apply(lambda x: self.get_remote_file_size(x))
+        sizes = SizeProber().probe_all(converted_df['actual_video_links'])
+        converted_df['fileSize'] = converted_df['actual_video_links'].map(sizes).fillna("0")
         converted_df.drop(columns='actual_video_links', inplace=True)
         result = converted_df.to_json(orient="records")
 
@@ -1611,7 +1999,8 @@ class ShopifyApp:
         converted_df['mimeType'] = "application/pdf"
         converted_df.rename(columns={'file_type': 'resource'}, inplace=True)
         converted_df['httpMethod'] = 'POST'
-        converted_df['fileSize'] = converted_df['actual_doc_links'].apply(lambda x: self.get_remote_file_size(x))
+        sizes = SizeProber().probe_all(converted_df['actual_doc_links'])
+        converted_df['fileSize'] = converted_df['actual_doc_links'].map(sizes).fillna("0")
         converted_df.drop(columns='actual_doc_links', inplace=True)
         result = converted_df.to_json(orient="records")
 
@@ -1619,11 +2008,12 @@ class ShopifyApp:
 
     def download_file(self, url, save_path):
         try:
-            with httpx.Client() as client:
-                response = client.get(url)
-                response.raise_for_status()
-                with open(save_path, "wb") as file:
-                    file.write(response.content)
+            with httpx.Client(follow_redirects=True) as client:
+                with client.stream('GET', url) as response:
+                    response.raise_for_status()
+                    with open(save_path, "wb") as file:
+                        for chunk in response.iter_bytes(1024 * 1024):
+                            file.write(chunk)
             print(f"File downloaded successfully to {save_path}")
         except Exception as e:
             print(f"Failed to download file: {e}")
@@ -1716,24 +2106,32 @@ class ShopifyApp:
         files = dict()
         for parameter in parameters:
             files[f"{parameter['name']}"] = (None, parameter['value'])
-        files['file'] = open(jsonl_path, 'rb')
 
         # with httpx.Client(timeout=None, follow_redirects=True) as sess:
-        response = httpx.post(url, files=files)
+        with open(jsonl_path, 'rb') as jsonl_file:
+            files['file'] = jsonl_file
+            response = httpx.post(url, files=files, timeout=None)
 
         print(response)
         print(response.content)
         print('')
+        response.raise_for_status()
+
+        return response
 
-    def webhook_subscription(self, client):
+    def webhook_subscription(self, client, callback_url=None):
+        """Subscribes callback_url (default: the BULK_WEBHOOK_URL env var) to BULK_OPERATIONS_FINISH."""
+        callback_url = callback_url or os.getenv('BULK_WEBHOOK_URL')
+        if not callback_url:
+            raise ValueError("BULK_WEBHOOK_URL is not set")
         print("Subscribing webhook...")
         mutation = '''
-                    mutation {
+                    mutation ($callbackUrl: URL!) {
                         webhookSubscriptionCreate(
                             topic: BULK_OPERATIONS_FINISH
                             webhookSubscription: {
                                 format: JSON,
-                                callbackUrl: "https://12345.ngrok.io/"
+                                callbackUrl: $callbackUrl
                                 }
                         )
                         {
@@ -1748,12 +2146,16 @@ class ShopifyApp:
                     }
         '''
 
+        variables = {'callbackUrl': callback_url}
+
         response = client.post(f'https://{self.store_name}.myshopify.com/admin/api/{self.api_version}/graphql.json',
-                               json={"query": mutation})
+                               json={"query": mutation, "variables": variables})
         print(response)
         print(response.json())
         print('')
 
+        return response.json()
+
     def pool_operation_status(self, client):
         print("Pooling operation status...")
         query = '''
@@ -1786,79 +2188,73 @@ class ShopifyApp:
         self.upload_jsonl(staged_target=staged_target, jsonl_path=jsonl_filename)
         self.create_products(client, staged_target=staged_target)
 
-    def import_bulk_video(self, client, video_df):
-        # Generate Stage Target
-        video_json = self.video_to_json(video_df)
-        video_json_list = json.loads(video_json)
-        chunked_video_json = [video_json_list[i:i + 10] for i in range(0, len(video_json_list), 10)]
-        for i, json_video in enumerate(chunked_video_json):
-            staged_target = self.generate_staged_target_video(client, json_video)
-            with open(f'data/staged_target_{i}.json', 'w', encoding='utf-8') as file:
-                json.dump(staged_target, file)
-
-        # Download Video File to Local
-        df = video_df.copy()
-        df['save_path'] = df['filename'].apply(lambda x: 'data/downloads/video/' + x)
-        df.apply(lambda x: self.download_file(x['actual_video_links'], save_path=x["save_path"]), axis=1)
-        df.to_csv('data/downloaded_video.csv', index=False)
-
-        # Upload Video
-        df = pd.read_csv('data/downloaded_video.csv')
-        staged_target = self.read_staged_target_files('data')
-        staged_target_df = pd.DataFrame().from_records(staged_target)
-        concated_df = pd.concat([df, staged_target_df], axis=1)
-        concated_df.to_csv('data/concated_df.csv', index=False)
-        concated_df.apply(lambda x: s.upload_video_file(x['GoogleAccessId'], x['key'], x['policy'], x['signature'], x['save_path'], x['uploadUrl']), axis=1)
-
-    def import_bulk_doc(self, client, doc_df):
-        # Generate Stage Target
+    def transfer_media(self, client, df, staged_inputs, link_column, download_dir, csv_path, max_workers=8, pipe=False):
+        """
+        Requests staged targets for staged_inputs while the files in df download, then uploads each
+        file to the target issued for it. With pipe=True the bytes go straight from source to target.
+        """
+        df = df.reset_index(drop=True)
+        df['save_path'] = df['filename'].apply(lambda x: download_dir + x)
+
+        allocator = StagedTargetAllocator(generate=lambda inputs: self.generate_staged_target_video(client, inputs))
+        with allocator, MediaTransfer(max_workers=max_workers) as transfer:
+            targets = allocator.allocate(staged_inputs)
+            items = [
+                {'url': df.loc[i, link_column], 'save_path': df.loc[i, 'save_path'], 'target': targets[i]}
+                for i in df.index
+            ]
+            results = transfer.transfer_all(items, transfer=transfer.pipe_transfer if pipe else None)
+
+        df['resourceUrl'] = [result.get('resource_url') for result in results]
+        df['transfer_status'] = [result['status'] for result in results]
+        df['md5'] = [result.get('md5') for result in results]
+        df.to_csv(csv_path, index=False)
+
+        return df
+
+    def import_bulk_video(self, client, video_df, max_workers=8, pipe=False):
+        video_json_list = json.loads(self.video_to_json(video_df))
+
+        return self.transfer_media(client, video_df, video_json_list, 'actual_video_links', 'data/downloads/video/', 'data/concated_df.csv', max_workers=max_workers, pipe=pipe)
+
+    def import_bulk_doc(self, client, doc_df, max_workers=8, pipe=False):
         doc_df.drop_duplicates('actual_doc_links', inplace=True)
-        doc_json = self.doc_to_json(doc_df)
-        doc_json_list = json.loads(doc_json)
-        chunked_doc_json = [doc_json_list[i:i + 10] for i in range(0, len(doc_json_list), 10)]
-        for i, json_doc in enumerate(chunked_doc_json):
-            staged_target = self.generate_staged_target_video(client, json_doc)
-            with open(f'data/staged_target_{i}.json', 'w', encoding='utf-8') as file:
-                json.dump(staged_target, file)
-
-        # Download Document File to Local
-        df = doc_df.copy()
-        df['save_path'] = df['filename'].apply(lambda x: 'data/downloads/doc/' + x)
-        df.apply(lambda x: self.download_file(x['actual_doc_links'], save_path=x["save_path"]), axis=1)
-        df.to_csv('data/downloaded_doc.csv', index=False)
-
-        # Upload Video
-        df = pd.read_csv('data/downloaded_doc.csv')
-        staged_target = self.read_staged_target_files('data')
-        staged_target_df = pd.DataFrame().from_records(staged_target)
-        concated_df = pd.concat([df, staged_target_df], axis=1)
-        concated_df.to_csv('data/concated_doc_df.csv', index=False)
-        concated_df.apply(lambda x: s.upload_doc_file(x['Content-Type'], x['success_action_status'], x['acl'], x['key'], x['x-goog-date'], x['x-goog-credential'], x['x-goog-algorithm'], x['x-goog-signature'], x['policy'], x['save_path'], x['uploadUrl']), axis=1)
+        doc_json_list = json.loads(self.doc_to_json(doc_df))
 
-    def check_bulk_operation_status(self, client, bulk_operation_id):
-        query = f'''
-            query {{
-                node(id: "{bulk_operation_id}") {{
-                    ... on BulkOperation {{
+        return self.transfer_media(client, doc_df, doc_json_list, 'actual_doc_links', 'data/downloads/doc/', 'data/concated_doc_df.csv', max_workers=max_workers, pipe=pipe)
+
+    def get_bulk_operation(self, client, bulk_operation_id):
+        query = '''
+            query getBulkOperation($id: ID!) {
+                node(id: $id) {
+                    ... on BulkOperation {
                         id
+                        type
                         status
-                    }}
-                }}
-            }}
+                        errorCode
+                        createdAt
+                        completedAt
+                        objectCount
+                        fileSize
+                        url
+                        partialDataUrl
+                    }
+                }
+            }
         '''
+        variables = {'id': bulk_operation_id}
 
-        response = client.post(f'https://{self.store_name}.myshopify.com/admin/api/{self.api_version}/graphql.json',
-                               json={"query": query})
+        response = self.send_request(client, query=query, variables=variables)
 
-        response_data = response.json()
-        status = response_data['data']['node']['status']
-        return status
+        return response.json()['data']['node']
+
+    def check_bulk_operation_status(self, client, bulk_operation_id):
+        return self.get_bulk_operation(client, bulk_operation_id)['status']
 
     def import_status(self, client):
         # Check Bulk Import status
         print('Checking')
-        global s
-        response = s.pool_operation_status(client)
+        response = self.pool_operation_status(client)
         if response['data']['currentBulkOperation']['status'] == 'COMPLETED':
             created = True
         else:
@@ -1867,6 +2263,44 @@ class ShopifyApp:
 
         return created
 
+    ## Bulk Results
+    def iter_bulk_result(self, url):
+        """Streams a bulk operation result file, yielding one decoded JSONL row at a time."""
+        print('Streaming bulk result...')
+        with httpx.stream('GET', url, timeout=None, follow_redirects=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    def iter_bulk_objects(self, url):
+        return assemble_bulk_objects(self.iter_bulk_result(url))
+
+    def iter_bulk_mutation_results(self, url):
+        for row in self.iter_bulk_result(url):
+            errors = list(row.get('errors') or [])
+            for payload in (row.get('data') or {}).values():
+                errors.extend((payload or {}).get('userErrors') or [])
+            yield BulkMutationResult(line_number=row.get('__lineNumber'), data=row.get('data'), errors=errors)
+
+    def iter_product_handles(self, url):
+        for row in self.iter_bulk_result(url):
+            if gid_type(row.get('id')) == 'Product' and row.get('handle'):
+                yield ProductHandle(id=row['id'], handle=row['handle'])
+
+    def save_product_ids(self, url, csv_path='data/product_ids.csv'):
+        """Writes the handle/id pairs of a product bulk query in the layout fill_product_id reads."""
+        count = 0
+        with open(csv_path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(['handle', 'id'])
+            for record in self.iter_product_handles(url):
+                writer.writerow([record.handle, record.id])
+                count += 1
+        print(f'{count} product ids saved to {csv_path}')
+
+        return count
+
     # Delete
     ## File
     def delete_file(self, client, fileIds):
@@ -1989,6 +2423,10 @@ if __name__ == '__main__':
     #     df.to_csv(filename, index=False)
 
     # =================================get all collections==============================
+    # One bulk query instead of paging 250 at a time:
+    # results_df = pd.DataFrame.from_records(s.bulk_get_collections(client))
+    # results_df.to_csv('data/existing_collection_list.csv', index=False)
+
     # has_next_page = True
     # cursor = None
     # results = list()
@@ -2062,6 +2500,8 @@ if __name__ == '__main__':
     # s.get_publications(client)
 
     # ============================================get product id by handle===============================
+    # s.bulk_get_product_ids(client, csv_path='data/product_ids.csv')
+
     # collection_df = pd.read_csv('data/collection_list.csv')
     # chunked_handles = get_handles('data/collection_list.csv')
     # product_ids = list()
@@ -2112,6 +2552,8 @@ if __name__ == '__main__':
     # files_data.apply(lambda x: s.create_file(client, x['origin_doc_links'], x['filename'], x['file_type'], x['resourceUrl']), axis=1)
 
     # =================================== get file ====================================
+    # master_shopify_images_df = pd.DataFrame().from_records(s.bulk_get_file(client, created_at='2025-03-03T00:00:00Z', media_type='IMAGE'))
+
     ## Image
     # sleep(300)
     # updated_at = '2025-02-25T20:00:00Z'
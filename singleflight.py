@@ -0,0 +1,74 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import asyncio
+import copy
+import json
+import re
+import threading
+
+
+def request_key(*parts, variables=None):
+    """Key for a GraphQL request: whitespace-insensitive query text plus variables in a stable order."""
+    normalized = [re.sub(r'\s+', ' ', part).strip() if isinstance(part, str) else part for part in parts]
+
+    return (*normalized, json.dumps(variables or {}, sort_keys=True, separators=(',', ':'), default=str))
+
+
+def is_read(query):
+    """Only queries are coalesced; a mutation must run once per caller."""
+    return not query.lstrip().startswith('mutation')
+
+
+@dataclass
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls across threads: the first caller for a key runs the
+    function, callers arriving while it is in flight wait for and share its result (or error).
+    """
+    copy_result: bool = False
+    calls: dict = field(default_factory=dict, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+
+        if not leader:
+            result = call.result()
+            # Followers get their own copy when callers may mutate the result
+            return copy.deepcopy(result) if self.copy_result else result
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+
+@dataclass
+class AsyncSingleFlight:
+    """SingleFlight for coroutines within one event loop."""
+    copy_result: bool = False
+    calls: dict = field(default_factory=dict, repr=False)
+
+    async def do(self, key, fn):
+        """fn is a zero-argument callable returning an awaitable."""
+        task = self.calls.get(key)
+        if task is not None:
+            result = await asyncio.shield(task)
+            return copy.deepcopy(result) if self.copy_result else result
+
+        task = asyncio.ensure_future(fn())
+        self.calls[key] = task
+        task.add_done_callback(lambda _: self.calls.pop(key, None))
+
+        return await asyncio.shield(task)
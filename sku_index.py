@@ -0,0 +1,244 @@
+from dataclasses import dataclass, field
+from time import time
+import os
+import sqlite3
+import threading
+import json
+import logging
+import webhooks
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SKU_INDEX_PATH = 'data/sku_index.db'
+COLUMNS = ('sku', 'variant_id', 'product_id', 'handle', 'inventory_item_id', 'online_store_url')
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS variants (
+        sku TEXT PRIMARY KEY,
+        variant_id TEXT NOT NULL,
+        product_id TEXT,
+        handle TEXT,
+        inventory_item_id TEXT,
+        online_store_url TEXT,
+        updated_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS variants_product_id ON variants (product_id);
+    CREATE TABLE IF NOT EXISTS summaries (
+        product_id TEXT PRIMARY KEY,
+        handle TEXT,
+        title TEXT COLLATE NOCASE,
+        header TEXT,
+        variants TEXT,
+        updated_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS summaries_title ON summaries (title);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+'''
+
+
+@dataclass
+class SkuIndex:
+    """
+    Persistent SKU -> product/variant/inventory item id, handle and online store url map.
+
+    Backed by SQLite so the Flask workers and the bulk tools share one file. Rebuilt in full
+    with refresh(), kept current by the products/* webhooks and by resolve() on a miss.
+    """
+    path: str = SKU_INDEX_PATH
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    connection: sqlite3.Connection = field(default=None, repr=False)
+
+    def __post_init__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    # Read
+    def get(self, sku):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM variants WHERE sku = ?', (str(sku).strip(),)).fetchone()
+
+        return dict(row) if row else None
+
+    def product_skus(self, product_id):
+        with self.lock:
+            rows = self.connection.execute('SELECT sku FROM variants WHERE product_id = ?', (product_id,)).fetchall()
+
+        return [row['sku'] for row in rows]
+
+    def inventory_items(self):
+        """Returns {sku: inventory item id} for every indexed variant."""
+        with self.lock:
+            rows = self.connection.execute('SELECT sku, inventory_item_id FROM variants WHERE inventory_item_id IS NOT NULL').fetchall()
+
+        return {row['sku']: row['inventory_item_id'] for row in rows}
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM variants').fetchone()[0]
+
+    def refreshed_at(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'refreshed_at'").fetchone()
+
+        return float(row['value']) if row else None
+
+    def age(self):
+        refreshed_at = self.refreshed_at()
+        return time() - refreshed_at if refreshed_at else None
+
+    # Write
+    def upsert(self, records):
+        """Inserts or updates flat variant records; a missing online store url keeps the stored one."""
+        rows = [
+            tuple(str(record.get(column)).strip() if column == 'sku' else record.get(column) for column in COLUMNS) + (time(),)
+            for record in records
+            if record.get('sku') and record.get('variant_id')
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                '''
+                INSERT INTO variants (sku, variant_id, product_id, handle, inventory_item_id, online_store_url, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(sku) DO UPDATE SET
+                    variant_id = excluded.variant_id,
+                    product_id = excluded.product_id,
+                    handle = excluded.handle,
+                    inventory_item_id = COALESCE(excluded.inventory_item_id, variants.inventory_item_id),
+                    online_store_url = COALESCE(excluded.online_store_url, variants.online_store_url),
+                    updated_at = excluded.updated_at
+                ''',
+                rows
+            )
+
+        return len(rows)
+
+    def delete_product(self, product_id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM variants WHERE product_id = ?', (product_id,))
+            self.connection.execute('DELETE FROM summaries WHERE product_id = ?', (product_id,))
+
+    def replace_product(self, product_id, records):
+        """Swaps in the current variants of a product, dropping SKUs it no longer has."""
+        skus = [str(record['sku']).strip() for record in records if record.get('sku')]
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"DELETE FROM variants WHERE product_id = ? AND sku NOT IN ({','.join('?' * len(skus))})",
+                (product_id, *skus)
+            )
+        self.upsert(records)
+
+    # Summaries
+    def put_summary(self, product_id, handle, title, header, variants):
+        """Stores a pre-rendered product summary: the header text plus one text block per variant."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO summaries (product_id, handle, title, header, variants, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (product_id, handle, title, header, json.dumps(variants), time())
+            )
+
+    def get_summary(self, product_id=None, sku=None, title=None):
+        """Looks a stored summary up by product id, by one of its SKUs or by exact (case-insensitive) title."""
+        if sku is not None:
+            where, value = 'product_id = (SELECT product_id FROM variants WHERE sku = ?)', str(sku).strip()
+        elif title is not None:
+            where, value = 'title = ?', title.strip()
+        else:
+            where, value = 'product_id = ?', product_id
+        with self.lock:
+            row = self.connection.execute(f'SELECT * FROM summaries WHERE {where}', (value,)).fetchone()
+        if row is None:
+            return None
+        summary = dict(row)
+        summary['variants'] = json.loads(summary['variants'] or '[]')
+
+        return summary
+
+    def refresh(self, app, client):
+        """Rebuilds the whole index from a bulk export of every variant."""
+        print('Refreshing SKU index...')
+        started_at = time()
+        count = 0
+        batch = []
+        for record in app.bulk_get_variants(client):
+            batch.append(record)
+            if len(batch) >= 1000:
+                count += self.upsert(batch)
+                batch = []
+        count += self.upsert(batch)
+
+        with self.lock, self.connection:
+            # Anything not touched by this export no longer exists in the shop
+            self.connection.execute('DELETE FROM variants WHERE updated_at < ?', (started_at,))
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('refreshed_at', ?)", (str(time()),))
+        print(f'{count} SKU(s) indexed')
+
+        return count
+
+    def resolve(self, app, client, sku):
+        """Returns the index entry for a SKU, asking Shopify (and remembering the answer) on a miss."""
+        record = self.get(sku)
+        if record is None:
+            record = app.get_variant_ids_by_sku(client, str(sku).strip())
+            if record:
+                self.upsert([record])
+
+        return record
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_index(path=SKU_INDEX_PATH):
+    """Process-wide SkuIndex, opened on first use."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SkuIndex(path=path)
+
+    return _shared
+
+
+def records_from_webhook(payload):
+    """Flattens a products/create or products/update payload into index records."""
+    product_id = payload.get('admin_graphql_api_id')
+    records = []
+    for variant in payload.get('variants') or []:
+        inventory_item_id = variant.get('inventory_item_id')
+        records.append({
+            'sku': variant.get('sku'),
+            'variant_id': variant.get('admin_graphql_api_id') or f"gid://shopify/ProductVariant/{variant.get('id')}",
+            'product_id': product_id,
+            'handle': payload.get('handle'),
+            'inventory_item_id': f'gid://shopify/InventoryItem/{inventory_item_id}' if inventory_item_id else None,
+            'online_store_url': None,
+        })
+
+    return records
+
+
+@webhooks.handler('products/create')
+@webhooks.handler('products/update')
+def update_from_webhook(payload):
+    shared_index().replace_product(payload.get('admin_graphql_api_id'), records_from_webhook(payload))
+
+
+@webhooks.handler('products/delete')
+def delete_from_webhook(payload):
+    product_id = payload.get('admin_graphql_api_id') or f"gid://shopify/Product/{payload.get('id')}"
+    shared_index().delete_product(product_id)
+
+
+if __name__ == '__main__':
+    from shopifyapi import ShopifyApp
+
+    s = ShopifyApp(store_name=os.getenv('TRENDTIME_STORE_NAME'), access_token=os.getenv('TRENDTIME_ACCESS_TOKEN'), api_version='2025-01')
+    client = s.create_session()
+    shared_index().refresh(s, client)
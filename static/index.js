@@ -50,7 +50,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const orderId = searchBox.value.trim();
 
         if (!orderId) {
-            alert('Please enter an Order ID to search.');
+            alert('Please enter an order number, customer, email, phone or zip to search.');
             return;
         }
 
@@ -68,6 +68,74 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // Infinite scroll: load the next page of orders when the sentinel below the table comes into view
+    const orderTableBody = document.getElementById('orderTableBody');
+    const sentinel = document.getElementById('orderListSentinel');
+    let nextCursor = orderTableBody ? orderTableBody.dataset.nextCursor : '';
+    let loading = false;
+    // Same margin as the observer, so a sentinel it would report is also in view here
+    const sentinelMargin = 200;
+
+    function sentinelInView() {
+        return sentinel.getBoundingClientRect().top < window.innerHeight + sentinelMargin;
+    }
+
+    function appendOrderRow(order) {
+        const row = document.createElement('tr');
+        ['no', 'date', 'customer', 'totalPrice', 'paymentStatus', 'fulfillmentStatus', 'shippingAddress'].forEach((key) => {
+            const cell = document.createElement('td');
+            cell.textContent = order[key];
+            row.appendChild(cell);
+        });
+        const actionCell = document.createElement('td');
+        const button = document.createElement('button');
+        button.className = 'action-button';
+        button.textContent = 'View Details';
+        button.addEventListener('click', () => viewOrderDetails(order.no));
+        actionCell.appendChild(button);
+        row.appendChild(actionCell);
+        orderTableBody.appendChild(row);
+    }
+
+    async function loadNextPage() {
+        if (loading || !nextCursor) {
+            return;
+        }
+        loading = true;
+        try {
+            const response = await fetch(`/api/orders?cursor=${encodeURIComponent(nextCursor)}`);
+            const data = await response.json();
+            if (!response.ok) {
+                displayError(data.error || 'Failed to load more orders.');
+                nextCursor = '';
+                return;
+            }
+            data.orders.forEach(appendOrderRow);
+            nextCursor = data.nextCursor || '';
+        } catch (error) {
+            console.error('Error loading orders:', error);
+            nextCursor = '';
+        } finally {
+            loading = false;
+            sentinel.style.display = nextCursor ? 'block' : 'none';
+        }
+        // The observer only fires when visibility changes, so a page too short to push the
+        // sentinel out of view would otherwise stop loading here
+        if (nextCursor && sentinelInView()) {
+            loadNextPage();
+        }
+    }
+
+    if (sentinel && nextCursor) {
+        sentinel.style.display = 'block';
+        const observer = new IntersectionObserver((entries) => {
+            if (entries.some((entry) => entry.isIntersecting)) {
+                loadNextPage();
+            }
+        }, { rootMargin: `${sentinelMargin}px` });
+        observer.observe(sentinel);
+    }
+
     // Function to display error messages
     function displayError(message) {
         errorContainer.style.display = 'block';
@@ -0,0 +1,51 @@
+import os
+import pandas as pd
+import pytest
+import catalog_sync
+
+
+def write_catalog(rows):
+    pd.DataFrame(rows).to_csv('data/temp.csv', index=False)
+
+
+def read_skus(path):
+    return [str(sku) for sku in pd.read_csv(path)['Variant SKU']]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    pd.DataFrame({'handle': ['shirt'], 'id': ['gid://shopify/Product/1']}).to_csv('data/product_ids.csv', index=False)
+
+
+def catalog(title='Shirt', price='10.00', qoh=5):
+    return [{
+        'Handle': 'shirt', 'Variant SKU': 'SH-1', 'Title': title, 'Option1 Value': 'M',
+        'Variant Price': price, 'Variant Inventory Qty': qoh,
+    }]
+
+
+def test_first_sync_emits_every_kind_of_change(workdir):
+    write_catalog(catalog())
+    summary = catalog_sync.sync_changes()
+
+    assert summary['update_products'] == summary['update_variants'] == summary['inventory'] == 1
+    assert read_skus('data/inventory_changes.csv') == ['SH-1']
+
+
+def test_row_with_several_changes_goes_to_every_file(workdir):
+    write_catalog(catalog())
+    catalog_sync.sync_changes()
+    catalog_sync.commit_sync()
+
+    write_catalog(catalog(title='Shirt (new)', price='12.00', qoh=3))
+    summary = catalog_sync.sync_changes()
+
+    assert summary['unchanged'] == 0
+    assert read_skus('data/update_products.csv') == ['SH-1']
+    assert read_skus('data/update_variants.csv') == ['SH-1']
+    assert read_skus('data/inventory_changes.csv') == ['SH-1']
+
+    catalog_sync.commit_sync()
+    assert catalog_sync.sync_changes()['unchanged'] == 1
@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import json
+import os
+import tempfile
+import threading
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock applies
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+TOKEN_FILE_PATH = 'shopify_tokens.json'
+
+
+@dataclass
+class TokenStore:
+    """
+    Shop -> access token map kept in memory and backed by shopify_tokens.json.
+
+    Writes take a file lock, re-read the file and atomically replace it, so several
+    workers can save tokens without losing each other's. Lookups are dict reads; the file
+    is only re-read when its mtime or size changes (another worker wrote it).
+    """
+    path: str = TOKEN_FILE_PATH
+    tokens: dict = field(default_factory=dict, repr=False)
+    signature: tuple = None
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False)
+
+    def __post_init__(self):
+        self.reload()
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self, force=True):
+        with self.lock:
+            signature = self.file_signature()
+            if not force and signature == self.signature:
+                return
+            tokens = {}
+            if signature is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as file:
+                        tokens = json.load(file)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to read {self.path}: {e}")
+                    return
+            self.tokens = tokens
+            self.signature = signature
+
+    @contextmanager
+    def file_lock(self):
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Read
+    def get(self, shop):
+        self.reload(force=False)
+        return self.tokens.get(shop)
+
+    # Write
+    def set(self, shop, access_token):
+        with self.lock, self.file_lock():
+            self.reload()
+            tokens = {**self.tokens, shop: access_token}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp', encoding='utf-8') as tmp:
+                json.dump(tokens, tmp, indent=4)
+            os.replace(tmp.name, self.path)
+            self.tokens = tokens
+            self.signature = self.file_signature()
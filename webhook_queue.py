@@ -0,0 +1,246 @@
+from dataclasses import dataclass, field
+from time import time
+import json
+import os
+import sqlite3
+import threading
+import logging
+import webhooks
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_QUEUE_PATH = 'data/webhook_queue.db'
+
+# Shopify retries a delivery for up to 48 hours, so ids are remembered a while longer
+DEDUPE_WINDOW = 7 * 24 * 3600
+# Seconds between purges of deliveries past the dedupe window
+PURGE_INTERVAL = 3600
+# Seconds a worker that has found nothing claimable waits before looking again, at least
+IDLE_WAIT = 0.5
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS deliveries (
+        webhook_id TEXT PRIMARY KEY,
+        topic TEXT,
+        shop TEXT,
+        payload TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        error TEXT,
+        received_at REAL,
+        available_at REAL,
+        claimed_at REAL,
+        resource TEXT
+    );
+    CREATE INDEX IF NOT EXISTS deliveries_status_available_at ON deliveries (status, available_at);
+'''
+# Columns added after the first release, for queues created before them
+MIGRATIONS = {
+    'claimed_at': 'ALTER TABLE deliveries ADD COLUMN claimed_at REAL',
+    'resource': 'ALTER TABLE deliveries ADD COLUMN resource TEXT',
+}
+RESOURCE_INDEX = 'CREATE INDEX IF NOT EXISTS deliveries_resource ON deliveries (resource, status)'
+
+
+def resource_key(topic, shop, body):
+    """Shop, resource type and id a delivery is about (e.g. shop:orders:gid://shopify/Order/1), or None."""
+    try:
+        payload = json.loads(body or '{}')
+    except ValueError:
+        return None
+    resource_id = isinstance(payload, dict) and (payload.get('admin_graphql_api_id') or payload.get('id'))
+    if not resource_id:
+        return None
+
+    return f"{shop}:{(topic or '').split('/')[0].lower()}:{resource_id}"
+
+
+@dataclass
+class WebhookQueue:
+    """
+    Durable queue of webhook deliveries in SQLite, deduplicated by X-Shopify-Webhook-Id.
+
+    The /webhooks receiver only verifies and enqueues, so Shopify gets its 200 right away;
+    worker threads run the registered webhooks handlers. A delivery whose handlers fail is
+    retried with backoff up to max_attempts times, and deliveries a crashed process left
+    running are picked up again once their processing_timeout lease runs out. Deliveries about
+    the same resource (e.g. one order) run one at a time, in the order they were received.
+    Workers purge finished deliveries past the dedupe window every PURGE_INTERVAL seconds.
+    """
+    path: str = WEBHOOK_QUEUE_PATH
+    workers: int = int(os.getenv('WEBHOOK_WORKERS', 2))
+    max_attempts: int = 5
+    retry_delay: float = 30
+    processing_timeout: float = float(os.getenv('WEBHOOK_PROCESSING_TIMEOUT', 300))
+    threads: list = field(default_factory=list, repr=False)
+    wakeup: threading.Condition = field(default_factory=threading.Condition, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    connection: sqlite3.Connection = field(default=None, repr=False)
+    purged_at: float = 0
+
+    def __post_init__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # WAL with NORMAL sync survives a process crash and keeps enqueue to a few ms
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(deliveries)')}
+        with self.lock, self.connection:
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    self.connection.execute(statement)
+            if 'claimed_at' not in columns:
+                # Claimed before leases existed: treated as expired
+                self.connection.execute("UPDATE deliveries SET claimed_at = 0 WHERE status = 'processing'")
+            self.connection.execute(RESOURCE_INDEX)
+
+    # Receive
+    def enqueue(self, webhook_id, topic, shop, body):
+        """Stores a delivery unless its webhook id was seen before. Returns False for a duplicate."""
+        now = time()
+        body = body.decode('utf-8') if isinstance(body, bytes) else body
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                '''
+                INSERT OR IGNORE INTO deliveries (webhook_id, topic, shop, payload, received_at, available_at, resource)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''',
+                (webhook_id, topic, shop, body, now, now, resource_key(topic, shop, body))
+            )
+        if cursor.rowcount:
+            self.start()
+            with self.wakeup:
+                self.wakeup.notify()
+
+        return bool(cursor.rowcount)
+
+    # Process
+    def claim(self):
+        """
+        Marks the oldest due delivery as processing and returns it, or None. A delivery is due when
+        pending and past its backoff, or processing under a lease older than processing_timeout
+        (its worker died). One whose resource has an earlier delivery still to run is skipped.
+        """
+        now = time()
+        expired = now - self.processing_timeout
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                '''
+                SELECT webhook_id, topic, shop, payload, attempts FROM deliveries AS delivery
+                WHERE ((status = 'pending' AND available_at <= :now) OR (status = 'processing' AND claimed_at < :expired))
+                AND (resource IS NULL OR NOT EXISTS (
+                    SELECT 1 FROM deliveries AS other
+                    WHERE other.resource = delivery.resource AND other.webhook_id != delivery.webhook_id
+                    AND (
+                        (other.status = 'processing' AND other.claimed_at >= :expired)
+                        OR (other.status IN ('pending', 'processing') AND other.received_at < delivery.received_at)
+                    )
+                ))
+                ORDER BY available_at LIMIT 1
+                ''',
+                {'now': now, 'expired': expired}
+            ).fetchone()
+            if row is None:
+                return None
+            # Conditional on status and lease so a worker of another process cannot claim it too
+            claimed = self.connection.execute(
+                '''
+                UPDATE deliveries SET status = 'processing', attempts = attempts + 1, claimed_at = ?
+                WHERE webhook_id = ? AND (status = 'pending' OR (status = 'processing' AND claimed_at < ?))
+                ''',
+                (now, row[0], expired)
+            ).rowcount
+            if not claimed:
+                return None
+
+        return {'webhook_id': row[0], 'topic': row[1], 'shop': row[2], 'payload': row[3], 'attempts': row[4] + 1, 'claimed_at': now}
+
+    def complete(self, delivery):
+        with self.lock, self.connection:
+            # A lease that ran out may have been claimed again; the new claim owns the row then
+            self.connection.execute(
+                "UPDATE deliveries SET status = 'done', payload = NULL, error = NULL WHERE webhook_id = ? AND claimed_at = ?",
+                (delivery['webhook_id'], delivery['claimed_at'])
+            )
+        self.notify_all()
+
+    def fail(self, delivery, error):
+        attempts = delivery['attempts']
+        status = 'failed' if attempts >= self.max_attempts else 'pending'
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE deliveries SET status = ?, error = ?, available_at = ? WHERE webhook_id = ? AND claimed_at = ?',
+                (status, str(error), time() + self.retry_delay * 2 ** (attempts - 1), delivery['webhook_id'], delivery['claimed_at'])
+            )
+        logger.warning(f"Webhook {delivery['topic']} {delivery['webhook_id']} attempt {attempts} failed ({status}): {error}")
+        self.notify_all()
+
+    def notify_all(self):
+        """Wakes the workers, e.g. for deliveries that waited on the one just finished."""
+        with self.wakeup:
+            self.wakeup.notify_all()
+
+    def process(self, delivery):
+        try:
+            webhooks.dispatch(delivery['topic'], json.loads(delivery['payload'] or '{}'), shop=delivery['shop'], strict=True)
+        except Exception as e:
+            self.fail(delivery, e)
+        else:
+            self.complete(delivery)
+
+    def next_due_in(self):
+        """Seconds until a pending delivery's backoff or a processing delivery's lease runs out, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                '''
+                SELECT MIN(due) FROM (
+                    SELECT available_at AS due FROM deliveries WHERE status = 'pending'
+                    UNION ALL
+                    SELECT claimed_at + ? FROM deliveries WHERE status = 'processing'
+                )
+                ''',
+                (self.processing_timeout,)
+            ).fetchone()
+
+        return None if row[0] is None else max(row[0] - time(), 0)
+
+    def work(self):
+        while True:
+            if time() - self.purged_at > PURGE_INTERVAL:
+                self.purge()
+            delivery = self.claim()
+            if delivery is not None:
+                self.process(delivery)
+                continue
+            # Checked under the condition so an enqueue's notify cannot slip in before the wait. A due
+            # delivery claim() passed over waits on its resource; complete() and fail() wake the workers
+            with self.wakeup:
+                due_in = self.next_due_in()
+                self.wakeup.wait(timeout=60 if due_in is None else min(max(due_in, IDLE_WAIT), 60))
+
+    def start(self):
+        """Starts the worker threads once per process."""
+        if self.threads:
+            return
+        with self.wakeup:
+            if self.threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f'webhook-worker-{number}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    # Maintenance
+    def purge(self, older_than=DEDUPE_WINDOW):
+        """Forgets finished deliveries past the dedupe window."""
+        self.purged_at = time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM deliveries WHERE status IN ('done', 'failed') AND received_at < ?",
+                (time() - older_than,)
+            )
+
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT status, COUNT(*) FROM deliveries GROUP BY status').fetchall())
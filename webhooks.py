@@ -0,0 +1,87 @@
+import base64
+import hashlib
+import hmac
+import inspect
+import logging
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SECRET = os.getenv('SHOPIFY_WEBHOOK_SECRET') or os.getenv('P_API_SECRET')
+RETELL_API_KEY = os.getenv('RETELL_API_KEY')
+# How old a RetellAI signature's timestamp may be, in seconds
+RETELL_SIGNATURE_TOLERANCE = 5 * 60
+
+# topic (e.g. "bulk_operations/finish") -> list of callables taking the decoded payload
+HANDLERS = {}
+
+
+def verify_hmac(body, hmac_header, secret=None):
+    """Checks the X-Shopify-Hmac-Sha256 header against the raw request body."""
+    secret = secret or WEBHOOK_SECRET
+    if not secret or not hmac_header:
+        return False
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    computed = base64.b64encode(digest).decode('utf-8')
+
+    return hmac.compare_digest(computed, hmac_header)
+
+
+def verify_retell_signature(body, signature_header, api_key=None):
+    """
+    Checks RetellAI's x-retell-signature header ("v=<ms timestamp>,d=<hex digest>"): an HMAC-SHA256
+    of the raw body followed by the timestamp, keyed with the RetellAI API key, made recently.
+    """
+    api_key = api_key or RETELL_API_KEY
+    if not api_key or not signature_header:
+        return False
+    parts = dict(part.split('=', 1) for part in signature_header.split(',') if '=' in part)
+    timestamp, digest = parts.get('v', ''), parts.get('d', '')
+    if not timestamp.isdigit() or abs(time.time() * 1000 - int(timestamp)) > RETELL_SIGNATURE_TOLERANCE * 1000:
+        return False
+    computed = hmac.new(api_key.encode('utf-8'), body + timestamp.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    return hmac.compare_digest(computed, digest)
+
+
+def handler(topic, first=False):
+    """
+    Registers a function as a handler for a webhook topic. A first handler runs before those
+    registered already, e.g. to read local state another handler is about to delete.
+    """
+    def register(func):
+        handlers = HANDLERS.setdefault(topic.lower(), [])
+        if first:
+            handlers.insert(0, func)
+        else:
+            handlers.append(func)
+        return func
+
+    return register
+
+
+def dispatch(topic, payload, shop=None, strict=False):
+    """
+    Runs every handler registered for the topic. Returns the number of handlers run.
+    Handlers that take a shop argument also get the X-Shopify-Shop-Domain of the delivery.
+    A failing handler is logged and the others still run; with strict, the first failure
+    is re-raised afterwards so the caller can retry the delivery.
+    """
+    handlers = HANDLERS.get((topic or '').lower(), [])
+    errors = []
+    for func in handlers:
+        try:
+            if 'shop' in inspect.signature(func).parameters:
+                func(payload, shop=shop)
+            else:
+                func(payload)
+        except Exception as e:
+            logger.error(f"Webhook handler {func.__name__} failed for {topic}: {e}", exc_info=True)
+            errors.append(e)
+    if strict and errors:
+        raise errors[0]
+
+    return len(handlers)